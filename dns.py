@@ -3,11 +3,35 @@
 
 import logging
 import os
+import re
 import copy
+import hashlib
+import json
+import socket
+import struct
+import tempfile
+import uuid
+from bisect import bisect_left
+from bisect import insort
+from collections import OrderedDict
+from heapq import heapify
+from heapq import heappop
+from heapq import heappush
+from threading import Condition
+from threading import Event
+from threading import Lock
+from threading import RLock
+from threading import Thread
+from threading import current_thread
+from time import time
 from sanji.core import Sanji
 from sanji.core import Route
 from sanji.model_initiator import ModelInitiator
-from sanji.connection.mqtt import Mqtt
+
+from metrics import Metrics
+from metrics import PrometheusDumper
+from metrics import metered_route
+from metrics import timed
 
 from voluptuous import Schema
 from voluptuous import REMOVE_EXTRA
@@ -16,27 +40,1597 @@ from voluptuous import Any
 from voluptuous import Required
 from voluptuous import Optional
 from voluptuous import Length
+from voluptuous import Match
+from voluptuous import Range
+from voluptuous import Invalid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 _logger = logging.getLogger("sanji.dns")
 
 
+def _read_only(*args, **kwargs):
+    raise TypeError("Read-only object cannot be modified.")
+
+
+class ReadOnlyDict(dict):
+    """
+    A dictionary which cannot be modified, copies of it are mutable.
+    """
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+
+class ReadOnlyList(list):
+    """
+    A list which cannot be modified, copies of it are mutable.
+    """
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+
+def freeze(obj):
+    """
+    Get a read-only copy of dictionaries and lists in obj, DNS entries
+    are copied as dictionaries.
+    """
+    if isinstance(obj, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return ReadOnlyList(freeze(v) for v in obj)
+    if isinstance(obj, DnsEntry):
+        return freeze(obj.to_dict())
+    return obj
+
+
+class lazy_schema(object):
+    """
+    A class attribute built by the decorated function on first access, and
+    kept on the class afterwards.
+    """
+    def __init__(self, build):
+        self.build = build
+        self.__name__ = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, obj, cls):
+        schema = self.build(cls)
+        setattr(cls, self.__name__, schema)
+        return schema
+
+
+class PriorityIndex(object):
+    """
+    Sources ordered by priority (lower first), then by the order they are
+    added. Kept sorted by bisection, so a change of a source only moves
+    the source itself.
+    """
+    def __init__(self, default=100):
+        self.default = default
+        self._keys = {}
+        self._order = []
+        self._sequence = 0
+
+    def __iter__(self):
+        return (key[2] for key in self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def update(self, source, entry):
+        key = self._keys.get(source)
+        priority = entry.get("priority", self.default)
+        if key is not None:
+            if key[0] == priority:
+                return
+            del self._order[bisect_left(self._order, key)]
+            key = (priority, key[1], source)
+        else:
+            self._sequence += 1
+            key = (priority, self._sequence, source)
+        self._keys[source] = key
+        insort(self._order, key)
+
+    def remove(self, source):
+        key = self._keys.pop(source, None)
+        if key is not None:
+            del self._order[bisect_left(self._order, key)]
+
+
+def _pack_nameserver(server):
+    for tag, family in _PACKED_FAMILIES:
+        try:
+            address = socket.inet_pton(family, str(server))
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        if socket.inet_ntop(family, address) == server:
+            return tag + address
+    text = server.encode("utf-8")
+    return "\x00" + struct.pack(">H", len(text)) + text
+
+
+def pack_nameservers(servers):
+    """
+    Pack nameserver addresses into a string: IPv4 and IPv6 addresses as
+    "\\x04" or "\\x06" followed by their binary form, others (empty
+    placeholders and scoped addresses) as "\\x00", their length in 2
+    bytes and the UTF-8 text.
+    """
+    parts = []
+    for server in servers:
+        packed = _PACKED_CACHE.get(server)
+        if packed is None:
+            packed = _pack_nameserver(server)
+            if len(_PACKED_CACHE) >= _PACKED_CACHE_SIZE:
+                _PACKED_CACHE.clear()
+            _PACKED_CACHE[server] = packed
+        parts.append(packed)
+    return "".join(parts)
+
+
+def unpack_nameservers(packed):
+    """
+    Unpack nameserver addresses packed by pack_nameservers(), as shared
+    strings.
+    """
+    servers = _UNPACKED_CACHE.get(packed)
+    if servers is not None:
+        return list(servers)
+    servers = []
+    offset = 0
+    while offset < len(packed):
+        tag = packed[offset]
+        if tag == "\x04":
+            server = socket.inet_ntop(socket.AF_INET,
+                                      packed[offset + 1:offset + 5])
+            offset += 5
+        elif tag == "\x06":
+            server = socket.inet_ntop(socket.AF_INET6,
+                                      packed[offset + 1:offset + 17])
+            offset += 17
+        else:
+            length = struct.unpack_from(">H", packed, offset + 1)[0]
+            server = packed[offset + 3:offset + 3 + length].decode("utf-8")
+            offset += 3 + length
+        servers.append(share(server))
+    if len(_UNPACKED_CACHE) >= _PACKED_CACHE_SIZE:
+        _UNPACKED_CACHE.clear()
+    _UNPACKED_CACHE[packed] = tuple(servers)
+    return servers
+
+
+class DnsEntry(object):
+    """
+    DNS list of a source in DNS database, accessed like a dictionary of
+    its fields, for example:
+        {"source": "eth0", "dns": ["8.8.8.8"], "search": ["example.com"]}
+
+    Fields are kept in slots instead of a dictionary per source: the
+    source name and search domains are shared (see share()), nameservers
+    are packed into a single string (see pack_nameservers()) and unpacked
+    on access, and fields other than the known ones are kept in a
+    dictionary only if any. Entries are converted into dictionaries by
+    to_dict() for JSON, i.e. responses, the journal and snapshots.
+    """
+    # known fields in order, with their slots
+    FIELDS = (("source", "source"), ("dns", "_dns"), ("search", "search"),
+              ("options", "options"), ("priority", "priority"),
+              ("lease", "lease"), ("lastSeen", "lastSeen"))
+    SLOTS = dict(FIELDS)
+    __slots__ = ("source", "_dns", "search", "options", "priority",
+                 "lease", "lastSeen", "_extra")
+
+    def __init__(self, fields=None):
+        if fields is not None:
+            for key in fields.keys():
+                self[key] = fields[key]
+
+    def __getitem__(self, key):
+        slot = DnsEntry.SLOTS.get(key)
+        try:
+            if slot is None:
+                return self._extra[key]
+            value = getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key)
+        if slot == "_dns":
+            return unpack_nameservers(value)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = DnsEntry.SLOTS.get(key)
+        if slot == "_dns":
+            value = pack_nameservers(value)
+        elif slot == "source":
+            value = share(value)
+        elif slot == "search":
+            value = [share(domain) for domain in value]
+        elif slot is None:
+            try:
+                self._extra[key] = value
+            except AttributeError:
+                self._extra = {key: value}
+            return
+        setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        slot = DnsEntry.SLOTS.get(key)
+        try:
+            if slot is not None:
+                delattr(self, slot)
+                return
+            del self._extra[key]
+            if not self._extra:
+                del self._extra
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        slot = DnsEntry.SLOTS.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return hasattr(self, "_extra") and key in self._extra
+
+    def items(self):
+        items = []
+        for key, slot in DnsEntry.FIELDS:
+            value = getattr(self, slot, _MISSING)
+            if value is _MISSING:
+                continue
+            if slot == "_dns":
+                value = unpack_nameservers(value)
+            items.append((key, value))
+        if hasattr(self, "_extra"):
+            items.extend(self._extra.items())
+        return items
+
+    def keys(self):
+        keys = [key for key, slot in DnsEntry.FIELDS if hasattr(self, slot)]
+        if hasattr(self, "_extra"):
+            keys.extend(self._extra.keys())
+        return keys
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        return hasattr(self, "source") or len(self) > 0
+
+    def get(self, key, default=None):
+        slot = DnsEntry.SLOTS.get(key)
+        if slot is None:
+            return getattr(self, "_extra", {}).get(key, default)
+        value = getattr(self, slot, _MISSING)
+        if value is _MISSING:
+            return default
+        if slot == "_dns":
+            return unpack_nameservers(value)
+        return value
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def replace(self, fields, keys):
+        """
+        Replace known fields by keys with those in a dictionary, fields
+        not in it are removed.
+
+        Returns:
+            True if any field is changed.
+        """
+        changed = False
+        for key in keys:
+            slot = DnsEntry.SLOTS[key]
+            before = getattr(self, slot, _MISSING)
+            if key in fields:
+                self[key] = fields[key]
+                changed = changed or getattr(self, slot) != before
+            elif before is not _MISSING:
+                delattr(self, slot)
+                changed = True
+        return changed
+
+    def to_dict(self):
+        data = dict(getattr(self, "_extra", ()))
+        for key, slot in DnsEntry.FIELDS:
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                data[key] = value
+        if "dns" in data:
+            data["dns"] = unpack_nameservers(data["dns"])
+        return data
+
+    def copy(self):
+        entry = DnsEntry()
+        for slot in DnsEntry.__slots__:
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                setattr(entry, slot, value)
+        if hasattr(self, "_extra"):
+            entry._extra = dict(self._extra)
+        return entry
+
+    def _state(self):
+        return [getattr(self, slot, _MISSING) for slot in DnsEntry.__slots__]
+
+    def __eq__(self, other):
+        if isinstance(other, DnsEntry):
+            return self._state() == other._state()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "DnsEntry(%r)" % self.to_dict()
+
+
+class DnsDatabase(OrderedDict):
+    """
+    DNS lists indexed by source in insertion order. The revision is
+    increased on every modification, entries modified in place should be
+    reported by touch(). The listener, if any, is called with the source
+    and its entry (None if removed) on every modification.
+
+    The revision of the last change of each source is kept, so changes
+    since a revision can be listed. Removed sources are remembered up to
+    max_removed, changes older than the forgotten ones cannot be listed.
+    Revisions count from the start of each instance identified by a random
+    epoch, those of another epoch, e.g. before a restart, are unknown.
+
+    Sources are also indexed by their "priority" (default_priority if not
+    given) for merging.
+
+    DNS lists are stored as DnsEntry, dictionaries are converted.
+    """
+    def __init__(self, *args, **kwargs):
+        self.listener = None
+        self.index = PriorityIndex(kwargs.pop("default_priority", 100))
+        self.epoch = uuid.uuid4().hex
+        self.revision = 0
+        self.horizon = 0
+        self.max_removed = kwargs.pop("max_removed", 1024)
+        self._changed = OrderedDict()
+        self._removed = OrderedDict()
+        super(DnsDatabase, self).__init__(*args, **kwargs)
+
+    def _change(self, key):
+        self.revision += 1
+        self._changed.pop(key, None)
+        self._changed[key] = self.revision
+        self._removed.pop(key, None)
+        self.index.update(key, self[key])
+        if self.listener is not None:
+            self.listener(key, self[key])
+
+    def _remove(self, key):
+        self._changed.pop(key, None)
+        self._removed.pop(key, None)
+        self._removed[key] = self.revision
+        while len(self._removed) > self.max_removed:
+            _, self.horizon = self._removed.popitem(last=False)
+        self.index.remove(key)
+        if self.listener is not None:
+            self.listener(key, None)
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        if not isinstance(value, DnsEntry):
+            value = DnsEntry(value)
+        super(DnsDatabase, self).__setitem__(key, value, *args, **kwargs)
+        self._change(key)
+
+    def __delitem__(self, key, *args, **kwargs):
+        super(DnsDatabase, self).__delitem__(key, *args, **kwargs)
+        self.revision += 1
+        self._remove(key)
+
+    def clear(self):
+        keys = list(self.keys())
+        super(DnsDatabase, self).clear()
+        self.revision += 1
+        for key in keys:
+            self._remove(key)
+
+    def touch(self, key):
+        """
+        Report the entry of key is modified in place.
+        """
+        self._change(key)
+
+    def changes(self, since, epoch):
+        """
+        Get changes after the revision of the epoch.
+
+        Returns:
+            A tuple of (changed entries, removed sources) ordered by
+            revision, None if the changes are no longer tracked or the
+            revision is of another epoch.
+        """
+        if epoch != self.epoch or since < self.horizon \
+                or since > self.revision:
+            return None
+
+        changed = []
+        for key in reversed(self._changed):
+            if self._changed[key] <= since:
+                break
+            changed.append(self[key])
+        removed = []
+        for key in reversed(self._removed):
+            if self._removed[key] <= since:
+                break
+            removed.append(key)
+        changed.reverse()
+        removed.reverse()
+        return changed, removed
+
+
+_IPV4_RE = re.compile(
+    r"^(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}"
+    r"(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\Z")
+_IPV6_RE = re.compile(r"^[0-9A-Fa-f:.]{2,45}\Z")
+_SCOPE_RE = re.compile(r"^[A-Za-z0-9_.-]{1,15}\Z")
+_LINK_LOCAL_RE = re.compile(r"^fe[89ab][0-9a-f]:", re.I)
+_NAMESERVER_CACHE = {}
+_NAMESERVER_CACHE_SIZE = 256
+
+# shared copies of values held by DNS contexts, see share()
+_SHARED = {}
+_SHARED_SIZE = 16384
+
+# tags and address families of packed nameservers, see pack_nameservers(),
+# and caches of packed and unpacked ones (cleared once full)
+_PACKED_FAMILIES = (("\x04", socket.AF_INET), ("\x06", socket.AF_INET6))
+_PACKED_CACHE = {}
+_UNPACKED_CACHE = {}
+_PACKED_CACHE_SIZE = 1024
+
+# placeholder of fields missing in DNS entries
+_MISSING = object()
+
+
+def _normalize_nameserver(value):
+    if _IPV4_RE.match(value):
+        return value
+
+    address, percent, scope = value.partition("%")
+    if not _IPV6_RE.match(address):
+        return None
+    try:
+        address = socket.inet_ntop(
+            socket.AF_INET6, socket.inet_pton(socket.AF_INET6, address))
+    except (socket.error, ValueError):
+        return None
+    if not percent:
+        return address
+    if not _SCOPE_RE.match(scope) or not _LINK_LOCAL_RE.match(address):
+        return None
+    return "%s%%%s" % (address, scope)
+
+
+def share(value):
+    """
+    Get the shared copy of an immutable value, e.g. a nameserver address
+    or a source name, so equal values held by all DNS contexts are stored
+    once. Byte strings are interned, other values are kept in a table
+    cleared once full, so values no longer used are not kept forever;
+    values shared before are still valid, only stored once more.
+    """
+    if type(value) is str:
+        return intern(value)
+    shared = _SHARED.get(value)
+    if shared is None:
+        if len(_SHARED) >= _SHARED_SIZE:
+            _SHARED.clear()
+        shared = _SHARED[value] = value
+    return shared
+
+
+def nameserver(value):
+    """
+    Validator of a nameserver address for schemas: an IPv4 address in
+    dotted decimal (without leading zeros), an IPv6 address, or a
+    link-local IPv6 address with a scope, e.g. "fe80::1%eth0". An empty
+    string is kept as a placeholder.
+
+    Returns:
+        The address, IPv6 addresses are compressed into lowercase.
+
+    Raises:
+        Invalid: not a valid address.
+    """
+    if not isinstance(value, basestring):
+        raise Invalid("expected a nameserver address")
+    result = _NAMESERVER_CACHE.get(value, False)
+    if result is False:
+        result = _normalize_nameserver(value) if value else value
+        if result is not None:
+            result = share(result)
+        if len(_NAMESERVER_CACHE) >= _NAMESERVER_CACHE_SIZE:
+            _NAMESERVER_CACHE.clear()
+        _NAMESERVER_CACHE[value] = result
+    if result is None:
+        raise Invalid("expected a nameserver address")
+    return result
+
+
+def apply_dns_patch(dns, operations):
+    """
+    Apply JSON Patch (RFC 6902) style operations to a DNS list.
+
+    Supported operations are "add", "remove", "replace" and "test", with
+    paths "/dns/<index>", or "/dns/-" to append for "add".
+
+    Args:
+        dns: the DNS list, which is not modified.
+        operations: a list of operations, for example:
+            [
+              {"op": "test", "path": "/dns/0", "value": "8.8.8.8"},
+              {"op": "remove", "path": "/dns/0"},
+              {"op": "add", "path": "/dns/-", "value": "8.8.4.4"}
+            ]
+
+    Returns:
+        The patched DNS list.
+    """
+    dns = list(dns)
+    for operation in operations:
+        op = operation["op"]
+        index = operation["path"][len("/dns/"):]
+        if index == "-" and op == "add":
+            index = len(dns)
+        elif index.isdigit() and int(index) < len(dns) + (op == "add"):
+            index = int(index)
+        else:
+            raise ValueError("Path %s not found." % operation["path"])
+
+        if op in ["add", "replace", "test"] and "value" not in operation:
+            raise ValueError("Value is required for %s." % op)
+        if op == "add":
+            dns.insert(index, operation["value"])
+        elif op == "remove":
+            del dns[index]
+        elif op == "replace":
+            dns[index] = operation["value"]
+        elif dns[index] != operation["value"]:
+            raise ValueError("Test failed at %s." % operation["path"])
+    return dns
+
+
+def write_file(path, content, fsync_policy="file"):
+    """
+    Replace a file atomically: write into a temporary file under the same
+    directory and rename it to the path, symbolic links are followed and
+    the file mode is kept.
+
+    Args:
+        path: path of the file.
+        content: text content of the file.
+        fsync_policy: "none", "file" or "dir" (file and directory).
+    """
+    path = os.path.realpath(path)
+    dirname = os.path.dirname(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = 0o644
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".%s." % os.path.basename(path), dir=dirname)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            if fsync_policy != "none":
+                os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    if fsync_policy == "dir":
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def stat_file(path):
+    """
+    Get the identity (inode, mtime, size) of a file, None if the file does
+    not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class Journal(object):
+    """
+    Append-only journal of JSON records, one record per line.
+
+    Records are written by the executor if given, in the order appended.
+    """
+    def __init__(self, path, fsync=False, executor=None):
+        self.path = path
+        self.fsync = fsync
+        self.executor = executor
+        self.records = 0
+        self._file = None
+        self._lock = Lock()
+
+    def _run(self, func, *args):
+        if self.executor is None:
+            func(*args)
+        else:
+            self.executor.submit(func, *args)
+
+    def replay(self):
+        """
+        Read records in the journal, a broken record and all records
+        after it are dropped, e.g. the last one written partially.
+        """
+        records = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        _logger.warning("Broken record in %s, %d records "
+                                        "replayed." % (self.path,
+                                                       len(records)))
+                        break
+        except IOError:
+            pass
+        with self._lock:
+            self.records = len(records)
+        return records
+
+    def append(self, record):
+        """
+        Append a record to the journal.
+        """
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            self.records += 1
+        self._run(self._write, line)
+
+    def _write(self, line):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def truncate(self):
+        """
+        Drop all records, e.g. after they are compacted into a snapshot.
+        """
+        with self._lock:
+            self.records = 0
+        self._run(self._truncate)
+
+    def _truncate(self):
+        with self._lock:
+            self.close()
+            self._file = open(self.path, "w")
+
+    def drop(self, records):
+        """
+        Drop all records now, e.g. by the executor after the first records
+        are compacted into a snapshot; records appended later are still
+        counted, and written after it if not written yet.
+        """
+        with self._lock:
+            self.records = max(self.records - records, 0)
+        self._truncate()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class UpdateScheduler(object):
+    """
+    Coalesce update requests into a single callback.
+
+    The callback is invoked once no more request arrives within the quiet
+    window, but no later than max_delay seconds after the first pending
+    request. A quiet window of 0 invokes the callback immediately.
+    """
+    def __init__(self, callback, quiet_window=0.5, max_delay=3):
+        self.callback = callback
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self._cond = Condition(Lock())
+        self._callback_lock = RLock()
+        self._first = None
+        self._last = None
+        self._stopped = False
+        self._thread = None
+
+    def _deadline(self):
+        return min(self._last + self.quiet_window,
+                   self._first + self.max_delay)
+
+    def _invoke(self):
+        with self._callback_lock:
+            self.callback()
+
+    def schedule(self):
+        """
+        Request the callback to be invoked.
+        """
+        if self.quiet_window <= 0:
+            return self._invoke()
+
+        with self._cond:
+            now = time()
+            if self._first is None:
+                self._first = now
+            self._last = now
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = Thread(target=self._run,
+                                      name="thread-dns-update")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self):
+        """
+        Return True if there is a request not handled yet.
+        """
+        with self._cond:
+            return self._first is not None
+
+    def flush(self):
+        """
+        Invoke the callback now if there is a pending request.
+        """
+        with self._cond:
+            pending = self._first is not None
+            self._first = self._last = None
+        if pending:
+            self._invoke()
+
+    def stop(self):
+        """
+        Stop the scheduler, pending request is flushed.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._first is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._deadline() - time()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                self._first = self._last = None
+
+            try:
+                self._invoke()
+            except Exception as e:
+                _logger.warning("Failed to run scheduled update: %s" % e)
+
+
+class ExpiryScheduler(object):
+    """
+    Expire keys at their deadlines (in seconds since the epoch), the
+    callback is invoked with all keys expired at once.
+
+    Deadlines are kept in a heap, so scheduling and expiring a key takes
+    O(log n). Rescheduled and cancelled keys are left in the heap and
+    skipped when popped, the heap is rebuilt once they outnumber the
+    scheduled ones.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self._cond = Condition(Lock())
+        self._heap = []
+        self._deadlines = {}
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._deadlines)
+
+    def deadline(self, key):
+        """
+        Get the deadline of key, None if not scheduled.
+        """
+        with self._cond:
+            return self._deadlines.get(key)
+
+    def schedule(self, key, deadline):
+        """
+        Expire key at the deadline, instead of the previous one if any.
+        """
+        with self._cond:
+            if self._deadlines.get(key) == deadline:
+                return
+            self._deadlines[key] = deadline
+            heappush(self._heap, (deadline, key))
+            self._rebuild()
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = Thread(target=self._run,
+                                      name="thread-dns-expiry")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] == (deadline, key):
+                self._cond.notify()
+
+    def cancel(self, key):
+        """
+        Do not expire key.
+        """
+        with self._cond:
+            if self._deadlines.pop(key, None) is not None:
+                self._rebuild()
+
+    def stop(self):
+        """
+        Stop the scheduler, keys are kept scheduled.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _rebuild(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._heap = [(deadline, key)
+                          for key, deadline in self._deadlines.items()]
+            heapify(self._heap)
+
+    def _pop_expired(self, now):
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                expired.append(key)
+        return expired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired = []
+                while not self._stopped:
+                    now = time()
+                    expired = self._pop_expired(now)
+                    if expired:
+                        break
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - now)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+
+            try:
+                self.callback(expired)
+            except Exception as e:
+                _logger.warning("Failed to expire %s: %s" % (expired, e))
+
+
+class ChangePublisher(object):
+    """
+    Publish changes of a state by the publish function, with a revision
+    increased on every change, on a dedicated thread.
+
+    A state the same as the last one by content is dropped. At most one
+    change is published per interval seconds, the latest state wins and
+    the states replaced before being published are counted as
+    "coalesced". Changes are held until started.
+
+    Revisions count from the start of each publisher identified by a
+    random epoch, revisions of different epochs are not comparable.
+    """
+    def __init__(self, publish, interval=1):
+        self.publish = publish
+        self.interval = interval
+        self.epoch = uuid.uuid4().hex
+        self.revision = 0
+        self.stats = {"published": 0, "coalesced": 0, "duplicates": 0,
+                      "failures": 0}
+        self._cond = Condition(Lock())
+        self._state = None
+        self._digest = None
+        self._pending = None
+        self._published = None
+        self._last = 0
+        self._publishing = False
+        self._stopped = False
+        self._thread = None
+
+    def notify(self, state):
+        """
+        Report the current state, published later if changed.
+        """
+        with self._cond:
+            if state is self._state:
+                return
+            self._state = state
+            digest = hashlib.sha1(
+                json.dumps(state, sort_keys=True)).hexdigest()
+            if digest == self._digest:
+                self.stats["duplicates"] += 1
+                return
+            self._digest = digest
+            self.revision += 1
+            if self._pending is not None:
+                self.stats["coalesced"] += 1
+            self._pending = (state, self.revision, digest)
+            self._cond.notify()
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = Thread(target=self._run, name="thread-dns-event")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop publishing, the pending change is dropped. A publish in
+        progress is not waited, it ends when the connection stops.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            publishing = self._publishing
+        if self._thread is not None:
+            if not publishing:
+                self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._pending is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._last + self.interval - time()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                state, revision, digest = self._pending
+                self._pending = None
+                if digest == self._published:
+                    self.stats["duplicates"] += 1
+                    continue
+                self._last = time()
+                self._publishing = True
+
+            try:
+                self.publish(state, revision)
+            except Exception as e:
+                with self._cond:
+                    self._publishing = False
+                    self.stats["failures"] += 1
+                _logger.warning("Failed to publish revision %d: %s"
+                                % (revision, e))
+                continue
+            with self._cond:
+                self._publishing = False
+                self._published = digest
+                self.stats["published"] += 1
+
+
+class IOExecutor(object):
+    """
+    Run blocking I/O tasks on a dedicated thread one by one, in the order
+    they are submitted. Failed tasks are logged.
+    """
+    def __init__(self, name="thread-dns-io"):
+        self.name = name
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0}
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self.stats["submitted"] += 1
+            self._queue.put((func, args))
+
+    def pending(self):
+        """
+        Return the number of tasks not done yet.
+        """
+        with self._queue.mutex:
+            return self._queue.unfinished_tasks
+
+    def join(self):
+        """
+        Wait until all submitted tasks are done.
+        """
+        self._queue.join()
+
+    def stop(self):
+        """
+        Stop the thread after all submitted tasks are done.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                try:
+                    func(*args)
+                    self.stats["completed"] += 1
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    _logger.warning("Failed to run I/O task %s: %s"
+                                    % (getattr(func, "__name__", func), e))
+            finally:
+                self._queue.task_done()
+
+
+class CommandQueue(IOExecutor):
+    """
+    Run commands modifying the state on a single writer thread one by one,
+    callers wait for the results. A command issued by the writer thread
+    itself runs inline.
+
+    The sequence is odd while a command is running, so lock-free readers
+    can tell if the state is modified under them. on_commit is called by
+    the writer thread after every command, before the sequence turns even.
+    """
+    def __init__(self, on_commit=None):
+        super(CommandQueue, self).__init__(name="thread-dns-writer")
+        self.on_commit = on_commit
+        self.sequence = 0
+
+    def in_writer(self):
+        """
+        Check if the caller is the writer thread.
+        """
+        return current_thread() is self._thread
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run func by the writer thread and return its result, exceptions
+        raised by func are raised to the caller.
+        """
+        if self.in_writer():
+            return func(*args, **kwargs)
+
+        done = Event()
+        result = {}
+
+        def command():
+            self.sequence += 1
+            try:
+                result["value"] = func(*args, **kwargs)
+            except Exception as e:
+                result["error"] = e
+            try:
+                if self.on_commit is not None:
+                    self.on_commit()
+            except Exception as e:
+                _logger.warning("Failed to commit: %s" % e)
+            finally:
+                self.sequence += 1
+                done.set()
+
+        self.submit(command)
+        done.wait()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+
+def is_merged(settings):
+    """
+    Check if DNS is generated by merging all sources by the settings.
+    """
+    return settings.get("enableMerge", False) is True \
+        and settings.get("enableFixed", False) is not True
+
+
+def is_current_source(settings, source):
+    """
+    Check if current DNS is generated by the source by the settings.
+    """
+    if is_merged(settings):
+        return source != "fixed"
+    if settings.get("enableFixed", False) is True:
+        return source == "fixed"
+    return source == settings.get("source")
+
+
+def merge_dns_lists(settings, dns_db):
+    """
+    Merge DNS lists of all sources except fixed in the database by
+    priority into a deduplicated list, capped by settings "mergeMaxDns"
+    and "mergeMaxPerSource". Sources are walked in the order of the
+    priority index and the walk stops once the list is full.
+
+    Search domains of contributing sources are merged in order, and
+    options are taken from the first of them.
+
+    Returns:
+        A dictionary with "dns", "sources" contributing, "search" and
+        "options" if any.
+    """
+    max_dns = settings.get("mergeMaxDns", Dns.MERGE_MAX_DNS)
+    max_per_source = settings.get("mergeMaxPerSource",
+                                  Dns.MERGE_MAX_PER_SOURCE)
+    merged = {"dns": [], "sources": []}
+    search = []
+    for source in dns_db.index:
+        if len(merged["dns"]) >= max_dns:
+            break
+        entry = dns_db.get(source)
+        if source == "fixed" or entry is None:
+            continue
+        count = 0
+        for server in entry.get("dns", []):
+            if count >= max_per_source or len(merged["dns"]) >= max_dns:
+                break
+            if server == "" or server in merged["dns"]:
+                continue
+            merged["dns"].append(server)
+            count += 1
+        if count == 0:
+            continue
+        merged["sources"].append(source)
+        for domain in entry.get("search", []):
+            if domain not in search:
+                search.append(domain)
+        if "options" in entry and "options" not in merged:
+            merged["options"] = entry["options"]
+    if search:
+        merged["search"] = search
+    return merged
+
+
+def build_current_dns(settings, dns_db):
+    """
+    Build current DNS by the settings and DNS lists in the database,
+    forwarding rules and DNS contexts in the settings are left out.
+    """
+    data = dict(settings)
+    data.pop("rules", None)
+    data.pop("namespaces", None)
+    if "enableFixed" not in data:
+        data["enableFixed"] = False
+
+    if data["enableFixed"] is True:
+        data["source"] = "fixed"
+    elif is_merged(settings):
+        data.pop("source", None)
+        data.update(merge_dns_lists(settings, dns_db))
+        return data
+    if "source" in data:
+        dns = dns_db.get(data["source"])
+        servers = dns.get("dns") if dns else None
+        if servers is not None:
+            data["dns"] = servers
+            for key in ["search", "options"]:
+                value = dns.get(key)
+                if value is not None:
+                    data[key] = value
+        elif data["enableFixed"] is True:
+            data["dns"] = data["fixedDns"]
+    return data
+
+
+def generate_resolv_conf(data, servers):
+    """
+    Generate DNS file (resolv.conf) content of current DNS with the
+    nameservers, empty if current DNS has no DNS list.
+    """
+    if "dns" not in data:
+        return ""
+
+    lines = []
+    search = data.get("search", [])
+    if len(search) > Dns.RESOLV_MAXDNSRCH:
+        _logger.warning("Only the first %d search domains are used: %s"
+                        % (Dns.RESOLV_MAXDNSRCH, ", ".join(search)))
+    if search:
+        lines.append("search %s" % " ".join(search))
+
+    if len(servers) > Dns.RESOLV_MAXNS:
+        _logger.warning("Only the first %d nameservers are used: %s"
+                        % (Dns.RESOLV_MAXNS, ", ".join(servers)))
+    lines.extend("nameserver %s" % server for server in servers)
+
+    options = data.get("options", {})
+    flags = []
+    for key, fmt in Dns.RESOLV_OPTIONS:
+        if key in options and options[key] is not False:
+            flags.append(fmt % options[key] if "%" in fmt else fmt)
+    if flags:
+        lines.append("options %s" % " ".join(flags))
+    return "".join(line + "\n" for line in lines)
+
+
+class DnsContext(object):
+    """
+    An independent DNS context, e.g. of a network namespace, with its own
+    settings, DNS lists by source and DNS file.
+
+    Settings are the ones of current DNS (see Dns.PUT_DNS_SCHEMA) except
+    the forwarder, DNS lists are merged by default. Addresses and source
+    names are shared among contexts, see share(). DNS lists of contexts
+    never expire.
+
+    The listener, if any, is called with the name, source and entry (None
+    if removed) on every modification of DNS lists.
+    """
+    def __init__(self, name, path, settings=None):
+        self.name = name
+        self.path = path
+        self.settings = {"enableFixed": False, "enableMerge": True}
+        self.revision = 0
+        self.listener = None
+        self.dns_db = DnsDatabase()
+        self.dns_db.listener = self._changed
+        self._view = None
+        self._digest = None
+        self._stat = None
+        if settings is not None:
+            self.set_settings(settings)
+
+    def _changed(self, source, entry):
+        if self.listener is not None:
+            self.listener(self.name, source, entry)
+
+    def set_settings(self, settings):
+        """
+        Replace the settings, DNS list of fixed DNS is updated by them.
+        """
+        self.settings = settings
+        self.revision += 1
+        if "fixedDns" not in settings and "fixed" not in self.dns_db:
+            return
+        fixed = {"source": "fixed",
+                 "dns": [share(server)
+                         for server in settings.get("fixedDns", [])]}
+        for key in ["search", "options"]:
+            fixed_key = "fixed" + key.capitalize()
+            if fixed_key in settings:
+                fixed[key] = settings[fixed_key]
+        self.add_dns_list(fixed)
+
+    def set_current_dns(self, data):
+        """
+        Update the settings like Dns.set_current_dns().
+        """
+        settings = dict(self.settings)
+        data = dict(data)
+        source = data.pop("source", None)
+        dnslist = data.pop("dns", None)
+        if source and source != "fixed" and dnslist is not None:
+            self.add_dns_list({"source": source, "dns": dnslist})
+        settings.pop("dns", None)
+        if source and source != "fixed":
+            settings["source"] = share(source)
+        elif source is None and dnslist:
+            settings.pop("source", None)
+            settings["dns"] = dnslist
+        settings.update(data)
+        self.set_settings(settings)
+
+    def get_dns_list(self, source):
+        return self.dns_db.get(source)
+
+    def add_dns_list(self, obj):
+        """
+        Add or replace DNS list by source, see Dns.add_dns_list(). Nothing
+        is changed if the DNS list is the same.
+
+        Returns:
+            True if changed.
+        """
+        entry = dict(obj, source=share(obj["source"]),
+                     dns=[share(server) for server in obj["dns"]])
+        entry.pop("lease", None)
+        if self.dns_db.get(entry["source"]) == entry:
+            return False
+        self.dns_db[entry["source"]] = entry
+        return True
+
+    def remove_dns_list(self, source):
+        return self.dns_db.pop(source, None) is not None
+
+    def is_current_source(self, source):
+        """
+        Check if DNS file is generated by the source.
+        """
+        return is_current_source(self.settings, source)
+
+    def get_current_dns(self):
+        """
+        Get current DNS of the context, like Dns.get_current_dns().
+        """
+        key = (self.revision, self.dns_db.revision)
+        if self._view is None or self._view[0] != key:
+            self._view = (key, freeze(build_current_dns(self.settings,
+                                                        self.dns_db)))
+        return self._view[1]
+
+    def generate_config(self):
+        data = self.get_current_dns()
+        return generate_resolv_conf(
+            data, [server for server in data.get("dns", []) if server != ""])
+
+    def update_config(self, fsync_policy="file"):
+        """
+        Write DNS file of the context unless the content is written
+        already and the file is not modified since then, its directory is
+        created if missing.
+
+        Returns:
+            True if written, False if skipped.
+        """
+        return self.apply_config(self.generate_config(), fsync_policy)
+
+    def apply_config(self, content, fsync_policy="file"):
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if digest == self._digest and self._stat is not None \
+                and self._stat == stat_file(self.path):
+            return False
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        write_file(self.path, content, fsync_policy)
+        self._digest = digest
+        self._stat = stat_file(self.path)
+        return True
+
+
 class Dns(Sanji):
     CONFIG_PATH = "/etc/resolv.conf"
 
-    IFACE_SCHEMA = Schema({
-        Required("name"): All(basestring, Length(1, 255)),
-        Required("dns"): [Any("", All(basestring, Length(0, 15)))]
-    }, extra=REMOVE_EXTRA)
+    # coalesce updates triggered by network events (in seconds)
+    UPDATE_QUIET_WINDOW = 0.5
+    UPDATE_MAX_DELAY = 3
+
+    # fsync policy for DNS file: "none", "file" or "dir" (file and directory)
+    FSYNC_POLICIES = ("none", "file", "dir")
+    FSYNC_POLICY = "file"
+
+    # local caching forwarder, enabled by settings "enableForwarder"
+    FORWARDER_ADDRESS = "127.0.0.1"
+    FORWARDER_PORT = 53
+    FORWARDER_CACHE_SIZE = 1024
+    FORWARDER_TIMEOUT = 2
+
+    # write forwarding rules as per-domain servers of dnsmasq
+    # ("server=/<domain>/<address>") into the file if given
+    RULES_CONFIG_PATH = None
+
+    # DNS files of DNS contexts of network namespaces by name, see
+    # DnsContext
+    NETNS_CONFIG_PATH = "/etc/netns/%s/resolv.conf"
+
+    # probe health of nameservers in DNS database to drop unresponsive
+    # ones but fixed DNS, disabled if the interval is 0; they are also
+    # ordered by latency if PROBE_REORDER, moved ahead only if faster by
+    # more than PROBE_REORDER_GAP milliseconds
+    PROBE_INTERVAL = 30
+    PROBE_TIMEOUT = 1
+    PROBE_MAX_FAILURES = 3
+    PROBE_REORDER = False
+    PROBE_REORDER_GAP = 20
+
+    # watch DNS file for edits by others and restore it, checked also every
+    # WATCH_INTERVAL seconds, disabled if the interval is 0; restores are
+    # delayed from WATCH_MIN_BACKOFF up to WATCH_MAX_BACKOFF seconds while
+    # others keep rewriting it
+    WATCH_INTERVAL = 60
+    WATCH_MIN_BACKOFF = 1
+    WATCH_MAX_BACKOFF = 300
+
+    # "sync" writes files in handlers, "async" leaves handlers updating
+    # in-memory state only and writes files on a dedicated I/O thread in
+    # order
+    IO_MODES = ("sync", "async")
+    IO_MODE = "sync"
+
+    # publish changes of current DNS as events of /network/dns, at most
+    # once per EVENT_INTERVAL seconds
+    EVENT_INTERVAL = 1
+
+    # write metrics in Prometheus text format into the file every
+    # METRICS_INTERVAL seconds if given
+    METRICS_PATH = None
+    METRICS_INTERVAL = 60
+
+    # compact the journal of DNS database and settings into snapshots
+    # after the number of records, fsync each record if JOURNAL_FSYNC
+    JOURNAL_MAX_RECORDS = 1000
+    JOURNAL_FSYNC = False
+
+    # lease (in seconds) of DNS lists by interface events without one,
+    # 0 never expires
+    INTERFACE_LEASE = 0
+
+    # back up settings changed since the last backup at most once per
+    # BACKUP_INTERVAL seconds on compaction, and on stop
+    BACKUP_INTERVAL = 3600
+
+    # merge nameservers of all sources by priority if "enableMerge", at most
+    # MERGE_MAX_DNS in total and MERGE_MAX_PER_SOURCE from each source
+    # unless given by settings
+    MERGE_MAX_DNS = 3
+    MERGE_MAX_PER_SOURCE = 2
+
+    # limits of the resolver (MAXNS and MAXDNSRCH of glibc), and options
+    # rendered into DNS file in order
+    RESOLV_MAXNS = 3
+    RESOLV_MAXDNSRCH = 6
+    RESOLV_OPTIONS = (("ndots", "ndots:%d"), ("timeout", "timeout:%d"),
+                      ("attempts", "attempts:%d"), ("rotate", "rotate"))
+
+    SEARCH_SCHEMA = [All(basestring, Length(1, 253),
+                         Match(r"^[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)*\.?$"))]
+
+    NETNS_NAME_SCHEMA = All(basestring, Length(1, 64),
+                            Match(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$"))
+
+    OPTIONS_SCHEMA = {
+        Optional("ndots"): All(int, Range(0, 15)),
+        Optional("timeout"): All(int, Range(1, 30)),
+        Optional("attempts"): All(int, Range(1, 5)),
+        Optional("rotate"): bool
+    }
 
-    PUT_DB_SCHEMA = Schema({
-        Required("source"): All(basestring, Length(1, 255)),
-        Required("dns"): [Any("", All(basestring, Length(0, 15)))]
-    }, extra=REMOVE_EXTRA)
+    # schemas of requests and events, built on first use
+    @lazy_schema
+    def IFACE_SCHEMA(cls):
+        return Schema({
+            Required("name"): All(basestring, Length(1, 255)),
+            Required("dns"): [nameserver],
+            Optional("search"): cls.SEARCH_SCHEMA,
+            Optional("options"): cls.OPTIONS_SCHEMA,
+            Optional("priority"): All(int, Range(0, 65535)),
+            Optional("lease"): All(int, Range(min=1)),
+            Optional("netns"): cls.NETNS_NAME_SCHEMA
+        }, extra=REMOVE_EXTRA)
 
-    PUT_DNS_SCHEMA = Schema({
-        Optional("enableFixed"): bool,
-        Optional("fixedDns"): [Any("", All(basestring, Length(0, 15)))]
-    }, extra=REMOVE_EXTRA)
+    @lazy_schema
+    def PUT_DB_SCHEMA(cls):
+        return Schema({
+            Required("source"): All(basestring, Length(1, 255)),
+            Required("dns"): [nameserver],
+            Optional("search"): cls.SEARCH_SCHEMA,
+            Optional("options"): cls.OPTIONS_SCHEMA,
+            Optional("priority"): All(int, Range(0, 65535)),
+            Optional("lease"): All(int, Range(min=1))
+        }, extra=REMOVE_EXTRA)
+
+    @lazy_schema
+    def PATCH_DB_SCHEMA(cls):
+        return Schema([{
+            Required("op"): Any("add", "remove", "replace", "test"),
+            Required("path"): All(basestring, Match(r"^/dns/(\d+|-)$")),
+            Optional("value"): nameserver
+        }], extra=REMOVE_EXTRA)
+
+    @lazy_schema
+    def PUT_DNS_SCHEMA(cls):
+        return Schema({
+            Optional("enableFixed"): bool,
+            Optional("enableForwarder"): bool,
+            Optional("enableMerge"): bool,
+            Optional("mergeMaxDns"): All(int, Range(1, 16)),
+            Optional("mergeMaxPerSource"): All(int, Range(1, 16)),
+            Optional("fixedDns"): [nameserver],
+            Optional("fixedSearch"): cls.SEARCH_SCHEMA,
+            Optional("fixedOptions"): cls.OPTIONS_SCHEMA
+        }, extra=REMOVE_EXTRA)
+
+    @lazy_schema
+    def PUT_NETNS_SCHEMA(cls):
+        return Schema({
+            Optional("source"): All(basestring, Length(1, 255)),
+            Optional("enableFixed"): bool,
+            Optional("enableMerge"): bool,
+            Optional("mergeMaxDns"): All(int, Range(1, 16)),
+            Optional("mergeMaxPerSource"): All(int, Range(1, 16)),
+            Optional("fixedDns"): [nameserver],
+            Optional("fixedSearch"): cls.SEARCH_SCHEMA,
+            Optional("fixedOptions"): cls.OPTIONS_SCHEMA
+        }, extra=REMOVE_EXTRA)
+
+    @lazy_schema
+    def RULES_SCHEMA(cls):
+        domain = cls.SEARCH_SCHEMA[0]
+        return Schema([Any({
+            Required("domain"): domain,
+            Required("source"): All(basestring, Length(1, 255))
+        }, {
+            Required("domain"): domain,
+            Required("dns"): All([nameserver], Length(min=1))
+        })])
 
     def init(self, *args, **kwargs):
         try:  # pragma: no cover
@@ -44,50 +1638,446 @@ class Dns(Sanji):
         except KeyError:
             bundle_env = os.getenv("BUNDLE_ENV", "debug")
 
+        # seconds spent by phase of startup, see GET /network/dns/metrics
+        self.startup = OrderedDict()
+        start = time()
+
+        # counters and latency histograms, see GET /network/dns/metrics
+        self.metrics = Metrics()
+        self.metrics_dumper = None
+
+        # settings and DNS database are modified by the writer thread only,
+        # readers get views published after every command
+        self.writer = CommandQueue(on_commit=self._publish)
+        self._published = {}
+
+        # changes of current DNS are published to other bundles once the
+        # bundle is running
+        self.events = ChangePublisher(self._publish_event,
+                                      interval=Dns.EVENT_INTERVAL)
+
+        # updates requested by network events, flushed together
+        self._pending_lock = Lock()
+        self._pending_save = False
+        self.update_scheduler = UpdateScheduler(
+            lambda: self.writer.call(self._flush_updates),
+            quiet_window=Dns.UPDATE_QUIET_WINDOW,
+            max_delay=Dns.UPDATE_MAX_DELAY)
+
+        # files are written by the I/O thread in "async" mode
+        if Dns.IO_MODE not in Dns.IO_MODES:
+            raise ValueError("Unknown I/O mode: %s" % Dns.IO_MODE)
+        self.io = IOExecutor() if Dns.IO_MODE == "async" else None
+
+        # content digest and file status of the last written DNS file, and
+        # content digest of the last written rules file
+        self._config_digest = None
+        self._config_stat = None
+        self._rules_digest = None
+        self.config_stats = {"written": 0, "skipped": 0}
+
+        # read-only views of current DNS and DNS database by name, rebuilt
+        # if settings or database are modified
+        self._settings_revision = 0
+        self._views = {}
+        self.view_revision = 0
+
+        # initialize DNS database, indexed by source in insertion order
+        self.dns_db = DnsDatabase()
+
+        # DNS contexts of network namespaces by name, with settings kept in
+        # settings "namespaces"; DNS files of the dirty ones are updated
+        # with the next scheduled update
+        self.contexts = OrderedDict()
+        self._dirty_contexts = set()
+        self._netns_revision = 0
+        self._netns_snapshot_revision = 0
+        self._compacting = False
+
+        # DNS lists with a lease are removed once not renewed in time
+        self.expiry = ExpiryScheduler(
+            lambda sources: self.writer.call(self._expire_dns_lists, sources))
+        self.journal = None
+        self.forwarder = None
+        self.prober = None
+        self.watcher = None
+
         # load configuration
         self.path_root = os.path.abspath(os.path.dirname(__file__))
         if bundle_env == "debug":  # pragma: no cover
             self.path_root = "%s/tests" % self.path_root
 
+        start = self._startup_phase("init", start)
         try:
             self.load(self.path_root)
         except:
             self.stop()
             raise IOError("Cannot load any configuration.")
+        start = time()
+        self._publish()
+        self._startup_phase("publish", start)
 
-        # initialize DNS database
-        self.dns_db = []
-        if "fixedDns" in self.model.db:
-            self.add_dns_list(
-                {"source": "fixed",
-                 "dns": self.model.db["fixedDns"]})
+    def _startup_phase(self, name, start):
+        """
+        Record seconds since start as the startup phase.
+
+        Returns:
+            The current time, start of the next phase.
+        """
+        now = time()
+        self.startup[name] = now - start
+        return now
 
     def run(self):
+        start = time()
         try:
-            self.update_config()
+            self.writer.call(self.update_forwarder)
+            start = self._startup_phase("forwarder", start)
+            self.writer.call(self.update_config)
         except Exception as e:
             _logger.warning("Failed to update %s: %s" % (Dns.CONFIG_PATH, e))
+        self.writer.call(self.update_contexts)
+        start = self._startup_phase("config", start)
+        self.start_watcher()
+        self.start_prober()
+        self.events.start()
+        if Dns.METRICS_PATH and self.metrics_dumper is None:
+            self.metrics_dumper = PrometheusDumper(
+                self.metrics, Dns.METRICS_PATH,
+                lambda path, content: write_file(path, content, "none"),
+                interval=Dns.METRICS_INTERVAL)
+            self.metrics_dumper.start()
+        self._startup_phase("prober", start)
+        _logger.info("Started in %.1f ms (%s)" % (
+            sum(self.startup.values()) * 1e3,
+            ", ".join("%s %.1f ms" % (name, seconds * 1e3)
+                      for name, seconds in self.startup.items())))
+
+    def before_stop(self):
+        self.events.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self.prober is not None:
+            self.prober.stop()
+            self.prober = None
+        self.expiry.stop()
+        self.update_scheduler.stop()
+        if self.forwarder is not None:
+            # point DNS file back to upstream servers before the forwarder
+            # is gone
+            forwarder, self.forwarder = self.forwarder, None
+            try:
+                self.writer.call(self.update_config)
+                if self.io is not None:
+                    self.io.join()
+            except Exception as e:
+                _logger.warning("Failed to update DNS file: %s" % e)
+            forwarder.stop()
+        if self.journal is not None:
+            try:
+                self.writer.call(self.compact, backup=True)
+            except Exception as e:
+                _logger.warning("Failed to compact the journal: %s" % e)
+        self.writer.stop()
+        if self.io is not None:
+            self.io.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.stop()
+            self.metrics_dumper = None
 
     def load(self, path):
         """
         Load the configuration. If configuration is not installed yet,
         initialise them with default value.
 
+        DNS database and settings changed after the last compaction are
+        restored from the journal, and compacted again. Nothing is written
+        if the journal is empty and the snapshots are intact. DNS lists
+        whose lease expired meanwhile are removed.
+
+        Settings are tracked by digest as saved in the journal, written
+        into the snapshot and the backup, so unchanged ones are not
+        written again.
+
         Args:
             path: Path for the bundle, the configuration should be located
                 under "data" directory.
         """
+        start = time()
         self.model = ModelInitiator("dns", path, backup_interval=-1)
         if self.model.db is None:
             raise IOError("Cannot load any configuration.")
-        self.save()
+        start = self._startup_phase("model", start)
+        self._snapshot_settings = self._settings_digest()
+        self._snapshot_revision = None
+        try:
+            with open(self.model.backup_json_db_path) as f:
+                self._backup_settings = self._settings_digest(json.load(f))
+            self._backup_time = os.path.getmtime(
+                self.model.backup_json_db_path)
+        except (IOError, OSError, ValueError):
+            self._backup_settings = None
+            self._backup_time = 0
+
+        self.snapshot_path = "%s/data/dns.sources.json" % path
+        self.netns_snapshot_path = "%s/data/dns.netns.json" % path
+        self.journal = Journal("%s/data/dns.journal" % path,
+                               fsync=Dns.JOURNAL_FSYNC, executor=self.io)
+        clean = self.restore()
+        self._journal_settings = self._settings_digest()
+        start = self._startup_phase("restore", start)
+        if clean:
+            self._snapshot_revision = self.dns_db.revision
+        else:
+            self.compact()
+            self._startup_phase("compact", start)
+        self.dns_db.listener = self._dns_list_changed
+        for context in self.contexts.values():
+            context.listener = self._netns_list_changed
+        now = time()
+        for source, entry in list(self.dns_db.items()):
+            if self._lease_expired(entry, now):
+                _logger.info("DNS list of %s expired." % source)
+                self.remove_dns_list(source)
+                self.metrics.inc("expired")
+            else:
+                self._schedule_expiry(source, entry)
+
+    def restore(self):
+        """
+        Restore DNS database from the snapshot and replay the journal, and
+        DNS contexts by settings "namespaces" with their DNS lists.
+
+        Returns:
+            True if restored from the snapshot only, i.e. the journal is
+            empty and the snapshot is not broken.
+        """
+        self.dns_db.listener = None
+        self.dns_db.clear()
+        if "fixedDns" in self.model.db:
+            self.dns_db["fixed"] = self._fixed_dns_list()
+
+        clean = True
+        try:
+            with open(self.snapshot_path) as f:
+                entries = json.load(f)
+        except IOError:
+            entries = []
+        except ValueError:
+            entries = []
+            clean = False
+        for entry in entries:
+            self.dns_db[entry["source"]] = entry
+
+        netns = {}
+        self._netns_revision = 0
+        try:
+            with open(self.netns_snapshot_path) as f:
+                for name, entries in json.load(f).items():
+                    netns[name] = OrderedDict(
+                        (entry["source"], entry) for entry in entries)
+        except IOError:
+            pass
+        except ValueError:
+            clean = False
+            self._netns_revision += 1
+
+        try:
+            clean = clean and os.path.getsize(self.journal.path) == 0
+        except OSError:
+            pass
+        for record in self.journal.replay():
+            if "namespace" in record:
+                entries = netns.setdefault(record["namespace"], OrderedDict())
+                if record.get("op") == "set":
+                    entries[record["entry"]["source"]] = record["entry"]
+                elif record.get("op") == "remove":
+                    entries.pop(record["source"], None)
+                self._netns_revision += 1
+            elif record.get("op") == "set":
+                self.dns_db[record["entry"]["source"]] = record["entry"]
+            elif record.get("op") == "remove":
+                self.dns_db.pop(record["source"], None)
+            elif record.get("op") == "settings":
+                self.model.db = record["data"]
+
+        self.contexts.clear()
+        for name, settings in sorted(
+                self.model.db.get("namespaces", {}).items()):
+            context = self._create_context(name, settings)
+            for entry in netns.get(name, {}).values():
+                context.add_dns_list(entry)
+        return clean
+
+    def _settings_digest(self, settings=None):
+        """
+        Get the digest of settings (the model if None).
+        """
+        if settings is None:
+            settings = self.model.db
+        return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+    @timed("compact")
+    def compact(self, backup=False):
+        """
+        Save the configuration and DNS database if modified since the last
+        compaction, the journal is truncated since all records are
+        included.
+
+        Settings are backed up if modified since the last backup, and the
+        last backup is Dns.BACKUP_INTERVAL seconds ago or backup is True.
+
+        In "async" mode, snapshots are taken now and written by the I/O
+        thread, no other compaction is triggered by the journal meanwhile.
+        """
+        digest = self._settings_digest()
+        settings = None
+        if digest != self._snapshot_settings:
+            settings = json.dumps(self.model.db, indent=4)
+        snapshot = None
+        if self.dns_db.revision != self._snapshot_revision:
+            snapshot = json.dumps(self.get_dns_database(), indent=2)
+        netns = None
+        if self._netns_revision != self._netns_snapshot_revision:
+            netns = json.dumps(
+                dict((name, [entry.to_dict()
+                             for entry in context.dns_db.values()])
+                     for name, context in self.contexts.items()), indent=2)
+        backup = digest != self._backup_settings and \
+            (backup or time() - self._backup_time >= Dns.BACKUP_INTERVAL)
+
+        args = (settings, snapshot, backup, netns,
+                (digest, self.dns_db.revision, self._netns_revision,
+                 self.journal.records))
+        if self.io is None:
+            self._write_compaction(*args)
+        else:
+            self._compacting = True
+            self.io.submit(self._write_compaction, *args)
+
+    def _write_compaction(self, settings, snapshot, backup, netns, state):
+        """
+        Write snapshots, and truncate the journal only if all of them are
+        written. The state of the compaction (digest, DNS database and DNS
+        contexts revisions, and journal records included) is taken as
+        saved then.
+        """
+        try:
+            self._write_snapshots(settings, snapshot, backup, netns)
+            digest, revision, netns_revision, records = state
+            self.journal.drop(records)
+            self._snapshot_settings = self._journal_settings = digest
+            self._snapshot_revision = revision
+            self._netns_snapshot_revision = netns_revision
+            if backup:
+                self._backup_settings = digest
+                self._backup_time = time()
+        finally:
+            self._compacting = False
+
+    @timed("write_snapshots")
+    def _write_snapshots(self, settings, snapshot, backup, netns=None):
+        """
+        Write snapshots of settings, DNS database and DNS lists of DNS
+        contexts unless None, and backup the settings if required.
+        """
+        if settings is not None:
+            write_file(self.model.json_db_path, settings, Dns.FSYNC_POLICY)
+        if backup:
+            self.model.backup_db()
+            self.metrics.inc("backups")
+        if snapshot is not None:
+            write_file(self.snapshot_path, snapshot, Dns.FSYNC_POLICY)
+        if netns is not None:
+            write_file(self.netns_snapshot_path, netns, Dns.FSYNC_POLICY)
+
+    def _append_journal(self, record):
+        if self.journal is None:
+            return
+        self.journal.append(record)
+        if self.journal.records >= Dns.JOURNAL_MAX_RECORDS \
+                and not self._compacting:
+            self.compact()
+
+    def _dns_list_changed(self, source, entry):
+        self._journal_dns_list(source, entry)
+        self._schedule_expiry(source, entry)
+
+    def _netns_list_changed(self, name, source, entry):
+        self._netns_revision += 1
+        if entry is None:
+            self._append_journal({"op": "remove", "namespace": name,
+                                  "source": source})
+        else:
+            self._append_journal({"op": "set", "namespace": name,
+                                  "entry": entry.to_dict()})
+
+    def _journal_dns_list(self, source, entry):
+        if entry is None:
+            self._append_journal({"op": "remove", "source": source})
+        else:
+            self._append_journal({"op": "set", "entry": entry.to_dict()})
 
+    @timed("save")
     def save(self):
         """
-        Save and backup the configuration.
+        Save the configuration into the journal, unless it is the same as
+        the saved one.
+
+        Returns:
+            True if saved, False if unchanged.
+        """
+        digest = self._settings_digest()
+        if digest == self._journal_settings:
+            self.metrics.inc("save_skips")
+            return False
+        self._append_journal({"op": "settings", "data": self.model.db})
+        self._journal_settings = digest
+        return True
+
+    def schedule_update(self, save=False):
+        """
+        Request to update DNS file later, all requests within the quiet
+        window are coalesced into a single update.
+
+        Args:
+            save: save the configuration along with the update.
+        """
+        with self._pending_lock:
+            self._pending_save = self._pending_save or save
+        self.update_scheduler.schedule()
+
+    def _flush_updates(self):
+        """
+        Apply the requested updates at once.
+        """
+        with self._pending_lock:
+            save, self._pending_save = self._pending_save, False
+        if save:
+            self.save()
+        self.update_config()
+        dirty, self._dirty_contexts = self._dirty_contexts, set()
+        self.update_contexts(dirty)
+
+    def is_current_source(self, source):
+        """
+        Check if DNS file, or the rules file if any, is generated by the
+        source.
         """
-        self.model.save_db()
-        self.model.backup_db()
+        if Dns.RULES_CONFIG_PATH and any(
+                rule.get("source") == source
+                for rule in self.model.db.get("rules", [])):
+            return True
+        return is_current_source(self.model.db, source)
+
+    def is_merged(self):
+        """
+        Check if DNS file is generated by merging all sources.
+        """
+        return is_merged(self.model.db)
 
     def get_dns_list(self, source):
         """
@@ -96,10 +2086,7 @@ class Dns(Sanji):
         Args:
             source: source which the DNS list belongs to.
         """
-        for entry in self.dns_db:
-            if source == entry["source"]:
-                return entry
-        return None
+        return self.dns_db.get(source)
 
     def set_dns_list(self, obj, update=True):
         """
@@ -112,35 +2099,80 @@ class Dns(Sanji):
                     "dns": ["8.8.8.8", "8.8.4.4"]
                 }
         """
-        for entry in self.dns_db:
-            if obj["source"] == entry["source"]:
-                entry["dns"] = obj["dns"]
-                return entry
+        entry = self.dns_db.get(obj["source"])
+        if entry is not None:
+            self._update_dns_list(entry, obj)
+            return entry
         return self.add_dns_list(obj, update)
 
+    def _update_dns_list(self, entry, obj):
+        """
+        Replace DNS list, search domains, options and lease of an entry in
+        database, the entry is left untouched if nothing is changed.
+        """
+        if entry.replace(obj, ["dns", "search", "options", "priority",
+                               "lease", "lastSeen"]):
+            self.dns_db.touch(entry["source"])
+
     def add_dns_list(self, obj, update=True):
         """
         Add DNS list by source into database and update setting if
         required.
 
         Args:
-            obj: a dictionary with "source" and "dns" list, for example:
+            obj: a dictionary with "source" and "dns" list, and optional
+                "search" domains and resolver "options", for example:
                 {
                     "source": "eth0",
-                    "dns": ["8.8.8.8", "8.8.4.4"]
+                    "dns": ["8.8.8.8", "8.8.4.4"],
+                    "search": ["example.com"],
+                    "options": {"timeout": 2, "attempts": 3,
+                                "rotate": True, "ndots": 1}
                 }
+                A DNS list with "lease" (in seconds) is removed if not
+                added again within the lease, the time it is added is kept
+                as "lastSeen".
         """
-        entry = self.get_dns_list(obj["source"])
-        if entry:
-            entry["dns"] = obj["dns"]
+        if "lease" in obj:
+            obj = dict(obj, lastSeen=time())
+        entry = self.dns_db.get(obj["source"])
+        if entry is not None:
+            self._update_dns_list(entry, obj)
         else:
-            self.dns_db.append(obj)
+            self.dns_db[obj["source"]] = obj
 
         # update config if data updated
-        if update and "source" in self.model.db \
-                and obj["source"] == self.model.db["source"]:
+        if update and self.is_current_source(obj["source"]):
             self.update_config()
 
+    def add_dns_lists(self, objs, update=True):
+        """
+        Add DNS lists into database all or nothing, and update setting at
+        most once if any of them is required.
+
+        Args:
+            objs: a list of dictionaries accepted by add_dns_list().
+        """
+        undo = []
+        updated = False
+        try:
+            for obj in objs:
+                entry = self.dns_db.get(obj["source"])
+                undo.append((obj["source"],
+                             None if entry is None else dict(entry)))
+                self.add_dns_list(obj, False)
+                updated = updated or self.is_current_source(obj["source"])
+
+            if update and updated:
+                self.update_config()
+        except Exception:
+            for source, entry in reversed(undo):
+                if entry is None:
+                    self.remove_dns_list(source)
+                else:
+                    self._update_dns_list(self.dns_db[source], entry)
+            raise
+
     def remove_dns_list(self, source):
         """
         Remove DNS list by source from database.
@@ -148,8 +2180,52 @@ class Dns(Sanji):
         Args:
             source: source for the DNS list belongs to.
         """
-        self.dns_db[:] = \
-            [i for i in self.dns_db if i.get("source") != source]
+        self.dns_db.pop(source, None)
+
+    def _lease_expired(self, entry, now):
+        return "lease" in entry and entry["lastSeen"] + entry["lease"] <= now
+
+    def _schedule_expiry(self, source, entry):
+        if entry is None or "lease" not in entry:
+            self.expiry.cancel(source)
+        else:
+            self.expiry.schedule(source, entry["lastSeen"] + entry["lease"])
+
+    def _expire_dns_lists(self, sources):
+        """
+        Remove DNS lists of sources whose lease is expired, DNS file is
+        updated once if any of them is in use.
+        """
+        now = time()
+        update = False
+        for source in sources:
+            entry = self.dns_db.get(source)
+            if entry is None or not self._lease_expired(entry, now):
+                continue
+            _logger.info("DNS list of %s expired." % source)
+            update = update or self.is_current_source(source)
+            self.remove_dns_list(source)
+            self.metrics.inc("expired")
+        if update:
+            self.schedule_update()
+
+    def get_dns_database(self):
+        """
+        Get all DNS lists in database as a list of dictionaries, ordered by
+        insertion.
+        """
+        return [entry.to_dict() for entry in self.dns_db.values()]
+
+    def get_dns_database_view(self):
+        """
+        Get all DNS lists in database like get_dns_database(), safe to be
+        called out of the writer thread.
+
+        The result is read-only and shared by callers until the database
+        is modified.
+        """
+        return self._get_view("database",
+                              lambda: freeze(list(self.dns_db.values())))
 
     def _generate_config(self):
         """
@@ -159,31 +2235,142 @@ class Dns(Sanji):
             2. temporary DNS
             3. by source
         """
-        resolv = ""
         data = self.get_current_dns()
         if "dns" not in data:
-            return resolv
+            return ""
 
-        for server in data["dns"]:
-            if server != "":
-                resolv = resolv + ("nameserver %s\n" % server)
-        return resolv
+        # resolve by the local forwarder if it is running
+        servers = self.get_upstream_dns()
+        if self.forwarder is not None and servers:
+            servers = [Dns.FORWARDER_ADDRESS]
+        return generate_resolv_conf(data, servers)
 
     def _write_config(self, resolv):
         """
         Write DNS configurations into DNS file (/etc/resolv.conf).
 
+        The content is written into a temporary file under the same
+        directory and renamed to DNS file, so readers never see a partial
+        file. Data is flushed to disk by Dns.FSYNC_POLICY.
+
         Args:
             resolv_info: Text content for DNS information.
         """
-        with open(Dns.CONFIG_PATH, "w") as f:
-            f.write(resolv)
+        if Dns.FSYNC_POLICY not in Dns.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: %s" % Dns.FSYNC_POLICY)
+        write_file(Dns.CONFIG_PATH, resolv, Dns.FSYNC_POLICY)
+
+    def _stat_config(self):
+        """
+        Get the identity (inode, mtime, size) of DNS file, None if the file
+        does not exist.
+        """
+        return stat_file(Dns.CONFIG_PATH)
 
+    @timed("update_config")
     def update_config(self):
         """
         Update the DNS configuration by settings.
+
+        The file is left untouched if the generated content is the same as
+        the last written one and the file is not modified since then.
+
+        In "async" mode, the content is generated now and written by the
+        I/O thread.
+
+        Returns:
+            True if DNS file is written, False if skipped, None if left to
+            the I/O thread.
+        """
+        resolv = self._generate_config()
+        rules = None
+        if Dns.RULES_CONFIG_PATH:
+            rules = self._generate_rules_config()
+        if self.io is not None:
+            if rules is not None:
+                self.io.submit(self._apply_rules_config, rules)
+            self.io.submit(self._apply_config, resolv)
+            return None
+        if rules is not None:
+            self._apply_rules_config(rules)
+        return self._apply_config(resolv)
+
+    def _apply_config(self, resolv):
+        """
+        Write the content into DNS file unless it is written already, e.g.
+        by the bundle before restart.
+        """
+        digest = hashlib.sha1(resolv.encode("utf-8")).hexdigest()
+        if self._config_digest is None:
+            stat = self._stat_config()
+            try:
+                with open(Dns.CONFIG_PATH) as f:
+                    if f.read() == resolv.encode("utf-8"):
+                        self._config_digest = digest
+                        self._config_stat = stat
+            except IOError:
+                pass
+        if digest == self._config_digest \
+                and self._config_stat is not None \
+                and self._config_stat == self._stat_config():
+            self.config_stats["skipped"] += 1
+            self.metrics.inc("config_skips")
+            return False
+
+        self._write_config(resolv)
+        self._config_digest = digest
+        self._config_stat = self._stat_config()
+        self.config_stats["written"] += 1
+        self.metrics.inc("config_writes")
+        return True
+
+    def start_watcher(self):
+        """
+        Start watching DNS file for edits by others if
+        Dns.WATCH_INTERVAL is given.
+        """
+        if Dns.WATCH_INTERVAL <= 0 or self.watcher is not None:
+            return
+        from watcher import ConfigWatcher
+        self.watcher = ConfigWatcher(
+            Dns.CONFIG_PATH,
+            lambda: self._config_digest,
+            lambda: self.writer.call(self._restore_config),
+            interval=Dns.WATCH_INTERVAL,
+            min_backoff=Dns.WATCH_MIN_BACKOFF,
+            max_backoff=Dns.WATCH_MAX_BACKOFF)
+        self.watcher.start()
+
+    def _restore_config(self):
+        """
+        Restore DNS file modified by others, it is written once unless
+        already restored by an update meanwhile.
+        """
+        self.metrics.inc("config_restores")
+        self.update_config()
+
+    def _generate_rules_config(self):
+        """
+        Generate forwarding rules as per-domain servers of dnsmasq.
+        """
+        lines = []
+        for rule in self.get_dns_rules():
+            for server in rule["servers"]:
+                lines.append("server=/%s/%s"
+                             % (rule["domain"].rstrip("."), server))
+        return "".join(line + "\n" for line in lines)
+
+    def _apply_rules_config(self, content):
         """
-        self._write_config(self._generate_config())
+        Write forwarding rules into Dns.RULES_CONFIG_PATH unless the
+        content is written already.
+        """
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if digest == self._rules_digest:
+            return False
+        write_file(Dns.RULES_CONFIG_PATH, content, Dns.FSYNC_POLICY)
+        self._rules_digest = digest
+        return True
 
     def get_current_dns(self):
         """
@@ -194,29 +2381,212 @@ class Dns(Sanji):
               "source": "eth0",
               "dns": ["192.168.50.33", "192.168.50.36"]
             }
+
+        The result is read-only and shared by callers until the settings
+        or DNS database are modified, copy it before making changes.
+        """
+        return self._get_view("current", self._build_current_dns)
+
+    def _view_key(self, name):
         """
-        data = copy.deepcopy(self.model.db)
-        if "enableFixed" not in data:
-            data["enableFixed"] = False
-
-        if data["enableFixed"] is True:
-            data["source"] = "fixed"
-        if "source" in data:
-            dns = self.get_dns_list(data["source"])
-            if dns and "dns" in dns:
-                data["dns"] = copy.copy(dns["dns"])
-            elif data["enableFixed"] is True:
-                data["dns"] = data["fixedDns"]
+        Get the key of the state the view by name is built from.
+        """
+        if name == "database":
+            return self.dns_db.revision
+        return (id(self.model.db), self._settings_revision,
+                self.dns_db.revision)
+
+    def _get_view(self, name, build):
+        """
+        Get the read-only view by name, rebuilt by build() if its key is
+        outdated.
+
+        Out of the writer thread, the view published by the last command
+        is given while a command is running, and a view built meanwhile is
+        dropped as it may be inconsistent. If the view is not published,
+        it is built by the writer thread after the running command.
+        """
+        sequence = self.writer.sequence
+        in_writer = self.writer.in_writer()
+        if sequence % 2 == 1 and not in_writer:
+            return self._get_published_view(name, build)
+        key = self._view_key(name)
+        view = self._views.get(name)
+        if view is not None and view[0] == key:
+            return view[1]
+        if in_writer:
+            data = build()
+        else:
+            try:
+                data = build()
+            except Exception:
+                if self.writer.sequence == sequence:
+                    raise
+            if self.writer.sequence != sequence:
+                return self._get_published_view(name, build)
+        self.view_revision += 1
+        self._views[name] = (key, data)
         return data
 
+    def _get_published_view(self, name, build):
+        view = self._published.get(name)
+        if view is None:
+            return self.writer.call(self._get_view, name, build)
+        return view
+
+    def _publish(self):
+        """
+        Publish views of the state for readers out of the writer thread.
+        Current DNS is built now, other views are published only if built
+        for the state already, so a command costs no more than the views
+        read.
+        """
+        published = {"current": self.get_current_dns()}
+        for name in ["database", "rules"]:
+            view = self._views.get(name)
+            if view is not None and view[0] == self._view_key(name):
+                published[name] = view[1]
+        self._published = published
+        self.events.notify(published["current"])
+
+    def _publish_event(self, data, revision):
+        """
+        Publish current DNS with its revision and the epoch of revisions
+        as an event of /network/dns.
+        """
+        data = dict(data)
+        data["epoch"] = self.events.epoch
+        data["revision"] = revision
+        self.publish.event.put("/network/dns", data=data)
+        self.metrics.inc("events_published")
+
+    def _build_current_dns(self):
+        return freeze(build_current_dns(self.model.db, self.dns_db))
+
+    def merge_dns_lists(self):
+        """
+        Merge DNS lists of all sources except fixed by priority, see
+        merge_dns_lists().
+        """
+        return merge_dns_lists(self.model.db, self.dns_db)
+
+    def get_upstream_dns(self):
+        """
+        Get nameservers of current DNS settings, ordered by health if the
+        prober is running. Fixed DNS given by users is kept as it is.
+        """
+        data = self.get_current_dns()
+        servers = [server for server in data.get("dns", []) if server != ""]
+        if self.prober is not None and data.get("source") != "fixed":
+            return self.prober.order(servers)
+        return servers
+
+    def get_probe_servers(self):
+        """
+        Get all nameservers in DNS database.
+        """
+        servers = OrderedDict()
+        for entry in self.get_dns_database_view():
+            for server in entry.get("dns", []):
+                if server != "":
+                    servers[server] = True
+        return list(servers.keys())
+
+    def start_prober(self):
+        """
+        Start probing nameservers if Dns.PROBE_INTERVAL is given.
+        """
+        if Dns.PROBE_INTERVAL <= 0 or self.prober is not None:
+            return
+        from prober import HealthProber
+        self.prober = HealthProber(
+            self.get_probe_servers,
+            interval=Dns.PROBE_INTERVAL,
+            timeout=Dns.PROBE_TIMEOUT,
+            max_failures=Dns.PROBE_MAX_FAILURES,
+            on_change=self.schedule_update,
+            reorder=Dns.PROBE_REORDER,
+            reorder_gap=Dns.PROBE_REORDER_GAP)
+        self.prober.start()
+
+    @Route(methods="get", resource="/network/dns/health")
+    @metered_route("get /network/dns/health")
+    def _get_dns_health(self, message, response):
+        if self.prober is None:
+            return response(data={"enable": False, "servers": []})
+        return response(data={"enable": True,
+                              "interval": self.prober.interval,
+                              "servers": self.prober.get_stats()})
+
+    def update_forwarder(self):
+        """
+        Start or stop the local caching forwarder by settings.
+        """
+        enabled = self.model.db.get("enableForwarder", False)
+        if enabled and self.forwarder is None:
+            from forwarder import Forwarder
+            forwarder = Forwarder(
+                self.get_upstream_dns,
+                address=Dns.FORWARDER_ADDRESS,
+                port=Dns.FORWARDER_PORT,
+                cache_size=Dns.FORWARDER_CACHE_SIZE,
+                timeout=Dns.FORWARDER_TIMEOUT,
+                rules=self.get_dns_rules)
+            try:
+                forwarder.start()
+            except Exception as e:
+                _logger.warning("Failed to start DNS forwarder: %s" % e)
+                return
+            self.forwarder = forwarder
+        elif not enabled and self.forwarder is not None:
+            self.forwarder.stop()
+            self.forwarder = None
+
     @Route(methods="get", resource="/network/dns")
+    @metered_route("get /network/dns")
     def _get_current_dns(self, message, response):
         data = self.get_current_dns()
         return response(data=data)
 
-    def set_current_dns(self, data):
+    def validate(self, route, schema, data):
+        """
+        Validate data by schema, failures are counted by route.
+        """
+        try:
+            return schema(data)
+        except Exception:
+            self.metrics.inc("validation_failures", route)
+            raise
+
+    @Route(methods="get", resource="/network/dns/metrics")
+    @metered_route("get /network/dns/metrics")
+    def _get_metrics(self, message, response):
+        data = self.metrics.snapshot()
+        data["startup"] = dict(self.startup)
+        data["events"] = dict(self.events.stats, revision=self.events.revision)
+        if self.watcher is not None:
+            data["watcher"] = dict(self.watcher.stats,
+                                   backoff=self.watcher.backoff)
+        return response(data=data)
+
+    def _fixed_dns_list(self):
+        """
+        Get the DNS list of fixed DNS by settings.
+        """
+        dns = {"source": "fixed", "dns": self.model.db.get("fixedDns", [])}
+        if "fixedSearch" in self.model.db:
+            dns["search"] = self.model.db["fixedSearch"]
+        if "fixedOptions" in self.model.db:
+            dns["options"] = self.model.db["fixedOptions"]
+        return dns
+
+    def set_current_dns(self, data, update=True):
         """
         Update current DNS configuration by message.
+
+        Args:
+            data: the settings, see Dns.PUT_DNS_SCHEMA.
+            update: save and update DNS file now, or schedule it if False.
         """
         # add to DNS database if data include both source and dns list
         # fixed DNS updated later
@@ -238,80 +2608,449 @@ class Dns(Sanji):
             self.model.db["dns"] = dnslist
 
         self.model.db.update(data)
-        self.save()
+        self._settings_revision += 1
+        if update:
+            self.save()
 
         # update fixed
-        dns = {}
-        dns["source"] = "fixed"
-        if "fixedDns" in self.model.db:
-            dns["dns"] = self.model.db["fixedDns"]
-        else:
-            dns["dns"] = []
-        self.set_dns_list(dns)
+        self.set_dns_list(self._fixed_dns_list(), update)
 
-        self.update_config()
+        self.update_forwarder()
+        if update:
+            self.update_config()
+        else:
+            self.schedule_update(save=True)
 
-    @Route(methods="put", resource="/network/dns", schema=PUT_DNS_SCHEMA)
+    @Route(methods="put", resource="/network/dns")
+    @metered_route("put /network/dns")
     def _put_current_dns(self, message, response):
         try:
-            self.set_current_dns(message.data)
+            message.data = self.validate("put /network/dns",
+                                         self.PUT_DNS_SCHEMA, message.data)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        try:
+            self.writer.call(self.set_current_dns, message.data)
         except Exception as e:
             return response(code=400, data={"message": e.message})
         return response(data=message.data)
 
+    def get_dns_database_changes(self, since, epoch=None):
+        """
+        Get DNS lists changed after the revision of DNS database in the
+        epoch, both as given by the last response.
+            {
+              "epoch": "1f0c5e5b9a6d4c3e8f2a7b6c5d4e3f2a",
+              "revision": 12,
+              "reset": false,
+              "dns": [{"source": "eth0", "dns": ["8.8.8.8"]}],
+              "removed": ["eth1"]
+            }
+
+        All DNS lists are given with "reset" if changes since the revision
+        are not available, e.g. the bundle was restarted so the epoch is
+        another one.
+        """
+        if not self.writer.in_writer():
+            return self.writer.call(self.get_dns_database_changes, since,
+                                    epoch)
+        changes = self.dns_db.changes(since, epoch)
+        if changes is None:
+            return {"epoch": self.dns_db.epoch,
+                    "revision": self.dns_db.revision, "reset": True,
+                    "dns": self.get_dns_database(), "removed": []}
+        return {"epoch": self.dns_db.epoch,
+                "revision": self.dns_db.revision, "reset": False,
+                "dns": [entry.to_dict() for entry in changes[0]],
+                "removed": changes[1]}
+
     @Route(methods="get", resource="/network/dns/db")
+    @metered_route("get /network/dns/db")
     def _get_dns_database(self, message, response):
-        return response(data=self.dns_db)
+        query = getattr(message, "query", {})
+        if "since" not in query:
+            return response(data=self.get_dns_database_view())
+
+        try:
+            since = int(query["since"])
+        except (TypeError, ValueError):
+            return response(code=400,
+                            data={"message": "Invalid revision."})
+        return response(data=self.get_dns_database_changes(
+            since, query.get("epoch")))
+
+    def patch_dns_list(self, source, operations):
+        """
+        Update DNS list of the source by patch operations, see
+        apply_dns_patch(). A source not in database is created by "add".
+        """
+        entry = self.get_dns_list(source)
+        dns = apply_dns_patch([] if entry is None else entry["dns"],
+                              operations)
+        self.add_dns_list({"source": source, "dns": dns})
+        return self.get_dns_list(source).to_dict()
+
+    @Route(methods="put", resource="/network/dns/db/:source")
+    @metered_route("put /network/dns/db/:source")
+    def _patch_dns_list(self, message, response):
+        try:
+            operations = self.validate("put /network/dns/db/:source",
+                                       self.PATCH_DB_SCHEMA, message.data)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        try:
+            entry = self.writer.call(self.patch_dns_list,
+                                     message.param["source"], operations)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        return response(data=entry)
 
     def set_dns_database(self, message, response):
         """
         Update DNS database batch or by source.
+
+        A batch is validated as a whole before being applied, and applied
+        as a single transaction.
         """
-        if type(message.data) is list:
-            for dns in message.data:
-                self.add_dns_list(dns)
-        elif type(message.data) is dict:
-            self.add_dns_list(message.data)
+        if isinstance(message.data, list):
+            entries = message.data
+        elif isinstance(message.data, dict):
+            entries = [message.data]
         else:
+            self.metrics.inc("validation_failures", "put /network/dns/db")
             return response(code=400,
                             data={"message": "Wrong type of DNS database."})
-        return response(data=self.dns_db)
+
+        try:
+            entries = [self.validate("put /network/dns/db",
+                                     self.PUT_DB_SCHEMA, dns)
+                       for dns in entries]
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+
+        try:
+            self.writer.call(self.add_dns_lists, entries)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        return response(data=self.get_dns_database_view())
 
     @Route(methods="put", resource="/network/dns/db")
+    @metered_route("put /network/dns/db")
     def _put_dns_database(self, message, response):
         return self.set_dns_database(message, response)
 
+    def get_dns_rules(self):
+        """
+        Get forwarding rules by domain suffix, with nameservers of their
+        source or given ones as "servers", for example:
+            [
+              {"domain": "corp.example", "source": "tun0",
+               "servers": ["10.8.0.1"]},
+              {"domain": "lan", "dns": ["192.168.1.1"],
+               "servers": ["192.168.1.1"]}
+            ]
+
+        Queries of a domain are forwarded to the servers of the longest
+        matching rule by the local forwarder, or by dnsmasq if the rules
+        are written into Dns.RULES_CONFIG_PATH. Rules without servers are
+        skipped.
+
+        The result is read-only and shared by callers until the settings
+        or DNS database are modified.
+        """
+        return self._get_view("rules", self._build_dns_rules)
+
+    def _build_dns_rules(self):
+        rules = []
+        for rule in self.model.db.get("rules", []):
+            if "source" in rule:
+                entry = self.dns_db.get(rule["source"]) or {}
+                servers = entry.get("dns", [])
+            else:
+                servers = rule["dns"]
+            rules.append(dict(rule, servers=[server for server in servers
+                                             if server != ""]))
+        return freeze(rules)
+
+    def set_dns_rules(self, rules, update=True):
+        """
+        Replace forwarding rules, see Dns.RULES_SCHEMA.
+
+        Args:
+            rules: a list of rules, each with "domain" and either "source"
+                or "dns" list.
+            update: save and update DNS file now, or schedule it if False.
+        """
+        domains = set()
+        for rule in rules:
+            domain = rule["domain"].lower().rstrip(".")
+            if domain in domains:
+                raise ValueError("Duplicate rule of %s." % rule["domain"])
+            domains.add(domain)
+
+        self.model.db["rules"] = rules
+        self._settings_revision += 1
+        if self.forwarder is not None:
+            self.forwarder.cache.clear()
+        if update:
+            self.save()
+            self.update_config()
+        else:
+            self.schedule_update(save=True)
+
+    @Route(methods="get", resource="/network/dns/rules")
+    @metered_route("get /network/dns/rules")
+    def _get_dns_rules(self, message, response):
+        return response(data=self.get_dns_rules())
+
+    @Route(methods="put", resource="/network/dns/rules")
+    @metered_route("put /network/dns/rules")
+    def _put_dns_rules(self, message, response):
+        try:
+            rules = self.validate("put /network/dns/rules",
+                                  self.RULES_SCHEMA, message.data)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        try:
+            self.writer.call(self.set_dns_rules, rules)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        return response(data=self.get_dns_rules())
+
+    def _create_context(self, name, settings=None):
+        context = DnsContext(name, Dns.NETNS_CONFIG_PATH % name, settings)
+        self.contexts[name] = context
+        return context
+
+    def get_contexts(self):
+        """
+        Get current DNS of all DNS contexts with their "name" and DNS file
+        "path", ordered by name.
+        """
+        return [dict(context.get_current_dns(), name=name,
+                     path=context.path)
+                for name, context in sorted(self.contexts.items())]
+
+    def get_context_dns(self, name):
+        """
+        Get current DNS of the DNS context with its DNS lists as "db",
+        None if not found.
+        """
+        context = self.contexts.get(name)
+        if context is None:
+            return None
+        return dict(context.get_current_dns(), name=name, path=context.path,
+                    db=freeze(list(context.dns_db.values())))
+
+    def set_context_dns(self, name, data, update=True):
+        """
+        Update settings of the DNS context by name, see
+        Dns.PUT_NETNS_SCHEMA. The context is created if not found.
+
+        Args:
+            update: save and update its DNS file now, or schedule it if
+                False.
+        """
+        context = self.contexts.get(name)
+        if context is None:
+            context = self._create_context(name)
+            context.listener = self._netns_list_changed
+        context.set_current_dns(data)
+        self.model.db.setdefault("namespaces", {})[name] = context.settings
+        self._settings_revision += 1
+        if update:
+            self.save()
+            self._update_context(context)
+        else:
+            self._dirty_contexts.add(name)
+            self.schedule_update(save=True)
+        return context
+
+    def remove_context(self, name):
+        """
+        Remove the DNS context by name, its DNS file is left as is.
+
+        Returns:
+            True if removed, False if not found.
+        """
+        context = self.contexts.pop(name, None)
+        if context is None:
+            return False
+        for source in list(context.dns_db.keys()):
+            context.remove_dns_list(source)
+        self.model.db.get("namespaces", {}).pop(name, None)
+        self._settings_revision += 1
+        self._dirty_contexts.discard(name)
+        self.save()
+        return True
+
+    def add_context_dns_lists(self, name, objs, update=True):
+        """
+        Add DNS lists into the DNS context by name, created with default
+        settings (merging its DNS lists) if not found. Its DNS file is
+        updated at most once if any of them is in use.
+
+        Args:
+            objs: a list of dictionaries accepted by add_dns_list().
+            update: update DNS file now, or schedule it if False.
+        """
+        context = self.contexts.get(name)
+        if context is None:
+            # saved now, or its DNS lists in the journal are dropped on
+            # restore
+            context = self.set_context_dns(name, {}, update=False)
+            self.save()
+        changed = False
+        for obj in objs:
+            if context.add_dns_list(obj) \
+                    and context.is_current_source(obj["source"]):
+                changed = True
+        if not changed:
+            return context
+        if update:
+            self._update_context(context)
+        else:
+            self._dirty_contexts.add(name)
+            self.schedule_update()
+        return context
+
+    def _update_context(self, context):
+        """
+        Update DNS file of the DNS context, by the I/O thread in "async"
+        mode.
+        """
+        content = context.generate_config()
+        if self.io is not None:
+            self.io.submit(context.apply_config, content, Dns.FSYNC_POLICY)
+            return None
+        return context.apply_config(content, Dns.FSYNC_POLICY)
+
+    def update_contexts(self, names=None):
+        """
+        Update DNS files of DNS contexts by name, all of them if None.
+        Failures are logged, and do not stop updates of others.
+        """
+        if names is None:
+            names = list(self.contexts.keys())
+        for name in names:
+            context = self.contexts.get(name)
+            if context is None:
+                continue
+            try:
+                self._update_context(context)
+            except Exception as e:
+                _logger.warning("Failed to update %s: %s"
+                                % (context.path, e))
+
+    def _validate_netns_name(self, route, name):
+        try:
+            return self.validate(route, self.NETNS_NAME_SCHEMA, name)
+        except Exception:
+            raise ValueError("Invalid namespace name.")
+
+    @Route(methods="get", resource="/network/dns/netns")
+    @metered_route("get /network/dns/netns")
+    def _get_contexts(self, message, response):
+        return response(data=self.writer.call(self.get_contexts))
+
+    @Route(methods="get", resource="/network/dns/netns/:name")
+    @metered_route("get /network/dns/netns/:name")
+    def _get_context_dns(self, message, response):
+        data = self.writer.call(self.get_context_dns, message.param["name"])
+        if data is None:
+            return response(code=404,
+                            data={"message": "Namespace not found."})
+        return response(data=data)
+
+    @Route(methods="put", resource="/network/dns/netns/:name")
+    @metered_route("put /network/dns/netns/:name")
+    def _put_context_dns(self, message, response):
+        route = "put /network/dns/netns/:name"
+        try:
+            name = self._validate_netns_name(route, message.param["name"])
+            data = self.validate(route, self.PUT_NETNS_SCHEMA, message.data)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        try:
+            self.writer.call(self.set_context_dns, name, data)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        return response(data=self.writer.call(self.get_context_dns, name))
+
+    @Route(methods="delete", resource="/network/dns/netns/:name")
+    @metered_route("delete /network/dns/netns/:name")
+    def _delete_context(self, message, response):
+        if not self.writer.call(self.remove_context, message.param["name"]):
+            return response(code=404,
+                            data={"message": "Namespace not found."})
+        return response(data={"name": message.param["name"]})
+
+    @Route(methods="put", resource="/network/dns/netns/:name/db")
+    @metered_route("put /network/dns/netns/:name/db")
+    def _put_context_dns_lists(self, message, response):
+        route = "put /network/dns/netns/:name/db"
+        data = message.data
+        try:
+            name = self._validate_netns_name(route, message.param["name"])
+            if not isinstance(data, list):
+                data = [data]
+            entries = [self.validate(route, self.PUT_DB_SCHEMA, dns)
+                       for dns in data]
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        try:
+            self.writer.call(self.add_context_dns_lists, name, entries)
+        except Exception as e:
+            return response(code=400, data={"message": str(e)})
+        return response(data=self.writer.call(self.get_context_dns, name))
+
     @Route(methods="put", resource="/network/interfaces/:name")
+    @metered_route("put /network/interfaces/:name")
     def _event_network_interface(self, message):
         """
         Listen interface event to update the dns database and settings.
         """
         if not(hasattr(message, "data")):
             raise ValueError("Data cannot be None or empty.")
-        try:
-            self.IFACE_SCHEMA(message.data)
-        except Exception as e:
-            raise e
+        data = self.validate("put /network/interfaces/:name",
+                             self.IFACE_SCHEMA, message.data)
 
         _logger.debug("[/network/interfaces] interface: %s, dns: %s"
-                      % (message.param["name"], message.data["dns"]))
+                      % (message.param["name"], data["dns"]))
 
         dns = {"source": message.param["name"],
-               "dns": message.data["dns"]}
-        self.add_dns_list(dns)
+               "dns": data["dns"]}
+        for key in ["search", "options", "priority", "lease"]:
+            if key in data:
+                dns[key] = data[key]
+        if "netns" in data:
+            self.writer.call(self.add_context_dns_lists, data["netns"],
+                             [dns], False)
+            return
+        if "lease" not in dns and Dns.INTERFACE_LEASE > 0:
+            dns["lease"] = Dns.INTERFACE_LEASE
+        self.writer.call(self._add_interface_dns_list, dns)
+
+    def _add_interface_dns_list(self, dns):
+        self.add_dns_list(dns, False)
+        if self.is_current_source(dns["source"]):
+            self.schedule_update()
 
     @Route(methods="put", resource="/network/wan")
+    @metered_route("put /network/wan")
     def _event_network_wan(self, message):
         """
         Listen wan event to update the dns settings.
         """
         try:
-            self.set_current_dns({"source": message.data["interface"]})
+            self.writer.call(self.set_current_dns,
+                             {"source": message.data["interface"]}, False)
         except Exception as e:
             _logger.info("[/network/wan] %s".format(e.message))
 
 
 def main():
+    from sanji.connection.mqtt import Mqtt
     dns = Dns(connection=Mqtt())
     dns.start()
 
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import random
+import socket
+import struct
+from collections import OrderedDict
+from threading import Lock
+from threading import Thread
+from time import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+_logger = logging.getLogger("sanji.dns.forwarder")
+
+# header flags and codes
+QR = 0x8000
+TC = 0x0200
+RD = 0x0100
+RA = 0x0080
+NOERROR = 0
+SERVFAIL = 2
+NXDOMAIN = 3
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_SOA = 6
+TYPE_OPT = 41
+CLASS_IN = 1
+
+UDP_SIZE = 512
+
+
+def read_name(data, offset):
+    """
+    Read a domain name in wire format, compression pointers are followed.
+
+    Returns:
+        (name in lower case with the trailing dot, offset after the name)
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = struct.unpack_from("!B", data, offset)[0]
+        if length & 0xC0 == 0xC0:
+            if jumps > 16:
+                raise ValueError("Too many compression pointers.")
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3FFF
+            jumps += 1
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(bytes(data[offset:offset + length]))
+        offset += length
+    name = ".".join(label.decode("latin-1") for label in labels) + "."
+    return name.lower(), offset if end is None else end
+
+
+def write_name(name):
+    """
+    Get the wire format of a domain name.
+    """
+    data = b""
+    for label in name.rstrip(".").split("."):
+        if label:
+            label = label.encode("latin-1")
+            data += struct.pack("!B", len(label)) + label
+    return data + b"\0"
+
+
+def build_query(name, qtype=TYPE_A, qid=None, rd=True):
+    """
+    Build a query message of a question.
+    """
+    if qid is None:
+        qid = random.randint(0, 0xFFFF)
+    header = struct.pack("!6H", qid, RD if rd else 0, 1, 0, 0, 0)
+    return header + write_name(name) + struct.pack("!HH", qtype, CLASS_IN)
+
+
+def parse_question(data):
+    """
+    Parse the header and the question of a message.
+
+    Returns:
+        (id, flags, (name, type, class), offset after the question)
+    """
+    qid, flags, qdcount = struct.unpack_from("!3H", data, 0)
+    if qdcount != 1:
+        raise ValueError("Only a single question is supported.")
+    name, offset = read_name(data, 12)
+    qtype, qclass = struct.unpack_from("!HH", data, offset)
+    return qid, flags, (name, qtype, qclass), offset + 4
+
+
+def parse_records(data, offset):
+    """
+    Walk through resource records after the question.
+
+    Returns:
+        (list of (offset of TTL, TTL), minimum TTL of answers, negative TTL
+        from SOA of authority, None if not given)
+    """
+    ancount, nscount, arcount = struct.unpack_from("!3H", data, 6)
+    ttls = []
+    answer_ttl = None
+    negative_ttl = None
+    for index in range(ancount + nscount + arcount):
+        offset = read_name(data, offset)[1]
+        rtype, rclass, ttl, rdlength = \
+            struct.unpack_from("!HHIH", data, offset)
+        if rtype != TYPE_OPT:
+            ttls.append((offset + 4, ttl))
+            if index < ancount:
+                answer_ttl = ttl if answer_ttl is None \
+                    else min(answer_ttl, ttl)
+            elif index < ancount + nscount and rtype == TYPE_SOA:
+                rdata = read_name(data, read_name(data, offset + 10)[1])[1]
+                minimum = struct.unpack_from("!I", data, rdata + 16)[0]
+                negative_ttl = min(ttl, minimum)
+        offset += 10 + rdlength
+    return ttls, answer_ttl, negative_ttl
+
+
+def udp_payload_size(data, offset):
+    """
+    Get the UDP payload size a query accepts, by its EDNS OPT record.
+    """
+    if struct.unpack_from("!H", data, 10)[0] != 1 \
+            or len(data) < offset + 11:
+        return UDP_SIZE
+    name, rtype, rclass = struct.unpack_from("!BHH", data, offset)
+    if name != 0 or rtype != TYPE_OPT:
+        return UDP_SIZE
+    return max(UDP_SIZE, rclass)
+
+
+def build_error(query, offset, rcode=SERVFAIL):
+    """
+    Build an error response of a query.
+    """
+    qid, flags = struct.unpack_from("!2H", query, 0)
+    flags = QR | (flags & RD) | RA | rcode
+    return struct.pack("!6H", qid, flags, 1, 0, 0, 0) + \
+        bytes(query[12:offset])
+
+
+def truncate(response, offset):
+    """
+    Truncate a response to the question with TC set.
+    """
+    qid, flags = struct.unpack_from("!2H", response, 0)
+    return struct.pack("!6H", qid, flags | TC, 1, 0, 0, 0) + \
+        bytes(response[12:offset])
+
+
+class AnswerCache(object):
+    """
+    LRU cache of responses with TTL. Negative responses (NXDOMAIN and
+    NODATA) are cached by the SOA in authority section (RFC 2308).
+    """
+    def __init__(self, capacity=1024, max_ttl=86400, max_negative_ttl=900):
+        self.capacity = capacity
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0,
+                      "inserts": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        """
+        Get the cached response with TTLs decreased by its age.
+        """
+        now = time() if now is None else now
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.stats["misses"] += 1
+                return None
+            self._entries[key] = entry
+            expires, created, response, ttls, negative = entry
+            self.stats["hits"] += 1
+            if negative:
+                self.stats["negative_hits"] += 1
+
+        age = int(now - created)
+        response = bytearray(response)
+        for offset, ttl in ttls:
+            struct.pack_into("!I", response, offset, max(0, ttl - age))
+        return response
+
+    def put(self, key, response, offset, now=None):
+        """
+        Cache a response if it is cacheable.
+
+        Args:
+            key: (name, type, class) of the question.
+            response: the response message.
+            offset: offset after the question.
+
+        Returns:
+            True if cached.
+        """
+        flags, ancount = struct.unpack_from("!H2xH", response, 2)
+        rcode = flags & 0xF
+        if flags & TC or rcode not in [NOERROR, NXDOMAIN]:
+            return False
+
+        ttls, answer_ttl, negative_ttl = parse_records(response, offset)
+        negative = rcode == NXDOMAIN or ancount == 0
+        if negative:
+            ttl = None if negative_ttl is None \
+                else min(negative_ttl, self.max_negative_ttl)
+        else:
+            ttl = None if answer_ttl is None \
+                else min(answer_ttl, self.max_ttl)
+        if not ttl:
+            return False
+
+        now = time() if now is None else now
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = \
+                (now + ttl, now, bytes(response), ttls, negative)
+            self.stats["inserts"] += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DomainTrie(object):
+    """
+    Values by domain suffix in a trie of reversed labels, a name is matched
+    by its longest suffix in O(number of labels). The root domain "."
+    matches every name.
+    """
+    def __init__(self):
+        self._root = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def labels(name):
+        name = name.lower().rstrip(".")
+        return name.split(".") if name else []
+
+    def add(self, domain, value):
+        """
+        Set the value of the domain, the previous one is replaced.
+        """
+        node = self._root
+        for label in reversed(self.labels(domain)):
+            node = node.setdefault(label, {})
+        if None not in node:
+            self._size += 1
+        node[None] = value
+
+    def match(self, name):
+        """
+        Get (domain, value) of the longest domain suffix of the name, None
+        if no domain matches.
+        """
+        node = self._root
+        labels = self.labels(name)
+        found = (".", node[None]) if None in node else None
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if None in node:
+                found = (".".join(labels[-depth:]) + ".", node[None])
+        return found
+
+
+def parse_server(server, port=53):
+    """
+    Get (address, port) of a nameserver given as address or tuple.
+    """
+    if isinstance(server, tuple):
+        return server
+    return (server, port)
+
+
+class Forwarder(object):
+    """
+    Caching DNS forwarder listens UDP and TCP, queries are forwarded to
+    upstream nameservers in order until one of them responds.
+
+    Queries of a domain in the forwarding rules are forwarded to the
+    nameservers of the longest matching domain instead.
+
+    Args:
+        upstreams: a function returns the list of upstream nameservers.
+        rules: a function returns the list of forwarding rules, each of
+            them a dictionary with "domain" and its "servers". The rules
+            are indexed again only if another list is returned.
+    """
+    def __init__(self, upstreams, address="127.0.0.1", port=53,
+                 cache_size=1024, timeout=2, max_ttl=86400,
+                 max_negative_ttl=900, rules=None):
+        self.upstreams = upstreams
+        self.rules = rules
+        self.timeout = timeout
+        self.cache = AnswerCache(cache_size, max_ttl, max_negative_ttl)
+        self.stats = {"queries": 0, "forwarded": 0, "failures": 0,
+                      "routed": 0}
+        self._address = (address, port)
+        self._servers = []
+        self._routes = (None, DomainTrie())
+
+    @property
+    def address(self):
+        """
+        The address listened, the port is assigned if 0 is given.
+        """
+        if self._servers:
+            return self._servers[0].server_address
+        return self._address
+
+    def start(self):
+        forwarder = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                response = forwarder.resolve(data, udp=True)
+                if response is not None:
+                    sock.sendto(response, self.client_address)
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    query = _recv_tcp(self.request)
+                    if query is None:
+                        return
+                    response = forwarder.resolve(query)
+                    if response is None:
+                        return
+                    self.request.sendall(
+                        struct.pack("!H", len(response)) + bytes(response))
+
+        class UDPServer(socketserver.ThreadingUDPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        udp = UDPServer(self._address, UDPHandler)
+        try:
+            tcp = TCPServer(udp.server_address, TCPHandler)
+        except Exception:
+            udp.server_close()
+            raise
+        self._servers = [udp, tcp]
+        for server in self._servers:
+            thread = Thread(target=server.serve_forever,
+                            name="thread-dns-forwarder")
+            thread.daemon = True
+            thread.start()
+        _logger.info("DNS forwarder listens on %s:%s" % self.address)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def resolve(self, query, udp=False):
+        """
+        Resolve a query by cache or upstream nameservers.
+
+        Returns:
+            The response message, None if the query is malformed.
+        """
+        try:
+            qid, flags, key, offset = parse_question(query)
+        except (ValueError, struct.error):
+            return None
+        if flags & QR:
+            return None
+        self.stats["queries"] += 1
+
+        response = self.cache.get(key)
+        if response is None:
+            response = self._forward(query, key)
+            if response is None:
+                self.stats["failures"] += 1
+                return build_error(query, offset)
+            try:
+                self.cache.put(key, response, offset)
+            except (ValueError, struct.error):
+                _logger.debug("Cannot parse response of %s" % (key,))
+        response = bytearray(response)
+        response[0:2] = query[0:2]
+
+        if udp and len(response) > udp_payload_size(query, offset):
+            return truncate(response, offset)
+        return bytes(response)
+
+    def route(self, name):
+        """
+        Get the upstream nameservers of a name by forwarding rules.
+        """
+        if self.rules is not None:
+            rules = self.rules()
+            routes = self._routes
+            if routes[0] is not rules:
+                trie = DomainTrie()
+                for rule in rules:
+                    if rule["servers"]:
+                        trie.add(rule["domain"], rule["servers"])
+                routes = self._routes = (rules, trie)
+            found = routes[1].match(name)
+            if found is not None:
+                self.stats["routed"] += 1
+                return found[1]
+        return self.upstreams()
+
+    def _forward(self, query, key):
+        for server in self.route(key[0]):
+            server = parse_server(server)
+            try:
+                response = _query_udp(query, key, server, self.timeout)
+                if struct.unpack_from("!H", response, 2)[0] & TC:
+                    response = _query_tcp(query, server, self.timeout)
+            except (socket.error, ValueError, struct.error) as e:
+                _logger.debug("Upstream %s:%s failed: %s"
+                              % (server[0], server[1], e))
+                continue
+            self.stats["forwarded"] += 1
+            return response
+        return None
+
+
+def address_family(address):
+    return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+
+def _query_udp(query, key, server, timeout):
+    """
+    Send a query to the server by UDP, and wait for the response of it.
+    """
+    sock = socket.socket(address_family(server[0]), socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(server)
+        sock.send(query)
+        deadline = time() + timeout
+        while True:
+            sock.settimeout(max(0.001, deadline - time()))
+            response = sock.recv(65535)
+            if response[0:2] != bytes(query[0:2]):
+                continue
+            if parse_question(response)[2] == key:
+                return response
+    finally:
+        sock.close()
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_tcp(sock):
+    """
+    Receive a length prefixed message from TCP.
+    """
+    length = _recv_exactly(sock, 2)
+    if length is None:
+        return None
+    return _recv_exactly(sock, struct.unpack("!H", length)[0])
+
+
+def _query_tcp(query, server, timeout):
+    """
+    Send a query to the server by TCP, and wait for the response of it.
+    """
+    sock = socket.create_connection(server, timeout)
+    try:
+        sock.sendall(struct.pack("!H", len(query)) + bytes(query))
+        response = _recv_tcp(sock)
+        if response is None:
+            raise ValueError("Connection closed by %s:%s" % server)
+        return response
+    finally:
+        sock.close()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import inspect
+import logging
+from bisect import bisect_left
+from functools import wraps
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+
+_logger = logging.getLogger("sanji.dns.metrics")
+
+# upper bounds (in seconds) of latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    Count of observed values by bucket, with their sum and maximum.
+    """
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def buckets(self):
+        """
+        Get cumulative counts by upper bound, the last one is "+Inf".
+        """
+        result = []
+        total = 0
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            total += count
+            result.append([bound, total])
+        return result
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "buckets": self.buckets()}
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms by name, optionally by route.
+
+    Args:
+        prefix: prefix of metric names in Prometheus text format.
+    """
+    def __init__(self, prefix="dns"):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def inc(self, name, route=None, value=1):
+        """
+        Increase the counter by value.
+        """
+        key = (name, route)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, route=None):
+        """
+        Add a latency (in seconds) into the histogram.
+        """
+        key = (name, route)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        """
+        Get all metrics, metrics by route are given as a dictionary by
+        route, for example:
+            {
+              "counters": {
+                "config_writes": 2,
+                "validation_failures": {"put /network/dns": 1}
+              },
+              "histograms": {
+                "update_config": {"count": 2, "sum": 0.0004, ...},
+                "route": {"get /network/dns": {"count": 5, ...}}
+              }
+            }
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, histogram.to_dict())
+                          for key, histogram in self._histograms.items()]
+
+        def group(items):
+            result = {}
+            for (name, route), value in sorted(items):
+                if route is None:
+                    result[name] = value
+                else:
+                    result.setdefault(name, {})[route] = value
+            return result
+        return {"counters": group(counters),
+                "histograms": group(histograms)}
+
+    def prometheus(self):
+        """
+        Get all metrics in Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, histogram.to_dict())
+                for key, histogram in self._histograms.items())
+
+        def labels(route, **extra):
+            pairs = [] if route is None else [("route", route)]
+            pairs.extend(sorted(extra.items()))
+            if not pairs:
+                return ""
+            return "{%s}" % ",".join(
+                '%s="%s"' % (k, str(v).replace("\\", "\\\\")
+                             .replace('"', '\\"')) for k, v in pairs)
+
+        lines = []
+        typed = set()
+        for (name, route), value in counters:
+            metric = "%s_%s_total" % (self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE %s counter" % metric)
+            lines.append("%s%s %d" % (metric, labels(route), value))
+        for (name, route), histogram in histograms:
+            metric = "%s_%s_seconds" % (self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE %s histogram" % metric)
+            for bound, count in histogram["buckets"]:
+                lines.append("%s_bucket%s %d"
+                             % (metric, labels(route, le=bound), count))
+            lines.append("%s_sum%s %.6f"
+                         % (metric, labels(route), histogram["sum"]))
+            lines.append("%s_count%s %d"
+                         % (metric, labels(route), histogram["count"]))
+        return "".join(line + "\n" for line in lines)
+
+
+def timed(name):
+    """
+    Time calls of a method into the histogram of self.metrics by name,
+    failed calls are also counted as "<name>_errors".
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time()
+            try:
+                return func(self, *args, **kwargs)
+            except Exception:
+                self.metrics.inc("%s_errors" % name)
+                raise
+            finally:
+                self.metrics.observe(name, time() - start)
+        return wrapper
+    return decorator
+
+
+def metered_route(route):
+    """
+    Time calls of a route handler into the histogram "route" of
+    self.metrics by route, and count failures (responses with code 400 or
+    above, or exceptions) as "route_failures".
+
+    The handler arguments are kept, since Sanji dispatches requests and
+    events by the number of them.
+    """
+    def decorator(func):
+        def failed(metrics):
+            metrics.inc("route_failures", route)
+
+        if len(inspect.getargspec(func).args) < 3:
+            def wrapper(self, message):
+                start = time()
+                try:
+                    return func(self, message)
+                except Exception:
+                    failed(self.metrics)
+                    raise
+                finally:
+                    self.metrics.observe("route", time() - start, route)
+        else:
+            def wrapper(self, message, response):
+                metrics = self.metrics
+
+                def _response(code=200, data=None):
+                    if code >= 400:
+                        failed(metrics)
+                    return response(code=code, data=data)
+
+                start = time()
+                try:
+                    return func(self, message, _response)
+                except Exception:
+                    failed(metrics)
+                    raise
+                finally:
+                    metrics.observe("route", time() - start, route)
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+class PrometheusDumper(object):
+    """
+    Write metrics in Prometheus text format into a file periodically, and
+    once more when stopped.
+
+    Args:
+        write: a function writes the content into the path.
+    """
+    def __init__(self, metrics, path, write, interval=60):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.write = write
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="thread-dns-metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.dump()
+
+    def dump(self):
+        try:
+            self.write(self.path, self.metrics.prometheus())
+        except Exception as e:
+            _logger.warning("Failed to dump metrics into %s: %s"
+                            % (self.path, e))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
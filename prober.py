@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import socket
+import struct
+from multiprocessing.pool import ThreadPool
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+
+from forwarder import NOERROR
+from forwarder import NXDOMAIN
+from forwarder import TYPE_NS
+from forwarder import address_family
+from forwarder import build_query
+from forwarder import parse_server
+
+_logger = logging.getLogger("sanji.dns.prober")
+
+
+class HealthProber(object):
+    """
+    Probe nameservers concurrently in background, and keep EWMA latency
+    and failure statistics of each of them.
+
+    A nameserver is unhealthy after max_failures consecutive failures,
+    until it responds again.
+
+    Args:
+        servers: a function returns nameservers to be probed.
+        on_change: a function called if the order of nameservers by health
+            is changed after a round of probes.
+        reorder: order responsive nameservers by latency, otherwise the
+            order given is kept.
+        reorder_gap: a nameserver is moved ahead of another only if faster
+            by more than the gap (in milliseconds).
+    """
+    def __init__(self, servers, interval=30, timeout=1, name=".",
+                 alpha=0.3, max_failures=3, workers=8, on_change=None,
+                 reorder=False, reorder_gap=20):
+        self.servers = servers
+        self.interval = interval
+        self.timeout = timeout
+        self.name = name
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.workers = workers
+        self.on_change = on_change
+        self.reorder = reorder
+        self.reorder_gap = reorder_gap
+        self.stats = {}
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._pool = ThreadPool(self.workers)
+        self._thread = Thread(target=self._run, name="thread-dns-prober")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                _logger.warning("Failed to probe nameservers: %s" % e)
+            self._stop_event.wait(self.interval)
+
+    def probe(self, server):
+        """
+        Send a query to the nameserver.
+
+        Returns:
+            Round trip time in seconds, None if failed.
+        """
+        address = parse_server(server)
+        query = build_query(self.name, TYPE_NS)
+        sock = socket.socket(address_family(address[0]), socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            start = time()
+            sock.connect(address)
+            sock.send(query)
+            while True:
+                response = sock.recv(65535)
+                if response[0:2] == query[0:2]:
+                    break
+            rtt = time() - start
+            rcode = struct.unpack_from("!H", response, 2)[0] & 0xF
+        except (socket.error, struct.error, ValueError):
+            return None
+        finally:
+            sock.close()
+
+        return rtt if rcode in [NOERROR, NXDOMAIN] else None
+
+    def record(self, server, rtt):
+        """
+        Update statistics of the nameserver by a probe result.
+        """
+        with self._lock:
+            stat = self.stats.setdefault(server, {
+                "server": server, "latency": None, "probes": 0,
+                "failures": 0, "consecutiveFailures": 0, "lastProbe": None})
+            stat["probes"] += 1
+            stat["lastProbe"] = time()
+            if rtt is None:
+                stat["failures"] += 1
+                stat["consecutiveFailures"] += 1
+                return
+            rtt *= 1000
+            stat["consecutiveFailures"] = 0
+            stat["latency"] = rtt if stat["latency"] is None \
+                else self.alpha * rtt + (1 - self.alpha) * stat["latency"]
+
+    def probe_all(self):
+        """
+        Probe all nameservers concurrently, statistics of nameservers no
+        longer given are dropped.
+        """
+        servers = []
+        for server in self.servers():
+            if server not in servers:
+                servers.append(server)
+        before = self.order(servers)
+
+        if self._pool is not None:
+            rtts = self._pool.map(self.probe, servers)
+        else:
+            rtts = [self.probe(server) for server in servers]
+        for server, rtt in zip(servers, rtts):
+            self.record(server, rtt)
+        with self._lock:
+            for server in set(self.stats) - set(servers):
+                del self.stats[server]
+
+        if self.on_change is not None and self.order(servers) != before:
+            self.on_change()
+
+    def is_healthy(self, server):
+        with self._lock:
+            stat = self.stats.get(server)
+            return stat is None \
+                or stat["consecutiveFailures"] < self.max_failures
+
+    def order(self, servers):
+        """
+        Order nameservers by health: unhealthy ones are dropped, unless all
+        of them are unhealthy. If reorder is set, responsive ones come
+        first, then ones not probed yet; the fastest one comes next only if
+        faster than the next one in the order given by more than
+        reorder_gap, so ones of similar latency do not swap places by every
+        round of probes.
+        """
+        with self._lock:
+            known = []
+            unknown = []
+            for server in servers:
+                stat = self.stats.get(server)
+                if stat is not None and \
+                        stat["consecutiveFailures"] >= self.max_failures:
+                    continue
+                if not self.reorder or stat is None \
+                        or stat["latency"] is None:
+                    unknown.append(server)
+                    continue
+                known.append((stat["latency"], server))
+        ordered = []
+        while known:
+            fastest = min(known, key=lambda item: item[0])
+            if fastest[0] + self.reorder_gap >= known[0][0]:
+                fastest = known[0]
+            known.remove(fastest)
+            ordered.append(fastest[1])
+        ordered.extend(unknown)
+        return ordered if ordered else list(servers)
+
+    def get_stats(self):
+        """
+        Get statistics of all nameservers.
+        """
+        with self._lock:
+            stats = [dict(stat) for stat in self.stats.values()]
+        for stat in stats:
+            stat["healthy"] = \
+                stat["consecutiveFailures"] < self.max_failures
+            if isinstance(stat["server"], tuple):
+                stat["server"] = "%s:%s" % stat["server"]
+        return sorted(stats, key=lambda stat: stat["server"])
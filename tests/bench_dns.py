@@ -0,0 +1,905 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks for the DNS bundle.
+
+Usage:
+    python tests/bench_dns.py [--json FILE] [--baseline FILE]
+                              [--threshold RATIO] [benchmark ...]
+
+Run every benchmark if no name is given. Results are written into FILE as
+JSON by --json, and compared with the results of a previous run by
+--baseline; the exit status is 1 if any result is worse than the baseline
+by more than the threshold ratio (0.2 by default).
+
+DNS file is created under BENCH_TMPFS_DIR (/dev/shm by default) if it is a
+directory, so disk latency is not measured except by "write".
+"""
+
+import os
+import sys
+import argparse
+import copy
+import gc
+import json
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import timeit
+from collections import OrderedDict
+from threading import Condition
+from threading import Thread
+from time import sleep
+from time import time
+
+from sanji.connection.mockup import Mockup
+from voluptuous import All
+from voluptuous import Any
+from voluptuous import Length
+from voluptuous import Required
+from voluptuous import Schema
+from voluptuous import REMOVE_EXTRA
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import dns  # noqa
+from dns import Dns  # noqa
+from dns import DnsDatabase  # noqa
+from dns import DnsEntry  # noqa
+from dns import ExpiryScheduler  # noqa
+from forwarder import DomainTrie  # noqa
+from forwarder import Forwarder  # noqa
+from test_forwarder import StubUpstream  # noqa
+from test_forwarder import query_udp  # noqa
+
+dirpath = os.path.dirname(os.path.realpath(__file__))
+
+BENCHMARKS = OrderedDict()
+
+# results of benchmarks by name, a list of tables given to report()
+RESULTS = OrderedDict()
+_running = []
+
+
+def benchmark(name):
+    def _benchmark(func):
+        BENCHMARKS[name] = func
+        return func
+    return _benchmark
+
+
+class BundleFixture(object):
+    """
+    Create a bundle with a Mockup connection, and a temporary resolv.conf.
+    """
+    def __enter__(self):
+        tmpfs = os.getenv("BENCH_TMPFS_DIR", "/dev/shm")
+        self.tmpdir = tempfile.mkdtemp(
+            prefix="bench-dns-", dir=tmpfs if os.path.isdir(tmpfs) else None)
+        self.config_path = Dns.CONFIG_PATH
+        Dns.CONFIG_PATH = os.path.join(self.tmpdir, "resolv.conf")
+        self.bundle = Dns(connection=Mockup())
+        return self.bundle
+
+    def __exit__(self, *args):
+        self.bundle.stop()
+        Dns.CONFIG_PATH = self.config_path
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        for ext in ["json", "json.backup", "journal", "sources.json"]:
+            try:
+                os.remove("%s/data/dns.%s" % (dirpath, ext))
+            except OSError:
+                pass
+
+
+def per_op(func, number):
+    """
+    Return average seconds per call of func.
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def report(title, header, rows, higher=()):
+    """
+    Print a table of results and record it for the running benchmark.
+
+    Args:
+        title: title of the table.
+        header: names of columns, the first column names the rows.
+        rows: rows of results.
+        higher: names of columns which are better if higher, others are
+            better if lower.
+    """
+    RESULTS.setdefault(_running[-1] if _running else None, []).append(
+        {"title": title, "header": header, "rows": rows,
+         "higher": list(higher)})
+    print("\n%s" % title)
+    print("  ".join("%12s" % h for h in header))
+    for row in rows:
+        print("  ".join(
+            "%12s" % c if isinstance(c, (int, str)) else "%12.3f" % c
+            for c in row))
+
+
+class LegacyDnsList(object):
+    """
+    The list based DNS database, kept as the reference for the scaling curve.
+    """
+    def __init__(self):
+        self.dns_db = []
+
+    def get_dns_list(self, source):
+        for entry in self.dns_db:
+            if source == entry["source"]:
+                return entry
+        return None
+
+    def add_dns_list(self, obj):
+        entry = self.get_dns_list(obj["source"])
+        if entry:
+            entry["dns"] = obj["dns"]
+        else:
+            self.dns_db.append(obj)
+
+    def remove_dns_list(self, source):
+        self.dns_db[:] = \
+            [i for i in self.dns_db if i.get("source") != source]
+
+
+@benchmark("store")
+def bench_store():
+    """
+    get/add/remove cost (usec per op) by number of sources.
+    """
+    rows = []
+    with BundleFixture() as bundle:
+        for size in [10, 100, 1000, 10000]:
+            legacy = LegacyDnsList()
+            bundle.dns_db.clear()
+            for i in range(size):
+                obj = {"source": "vlan%d" % i, "dns": ["10.0.0.1"]}
+                legacy.add_dns_list(dict(obj))
+                bundle.add_dns_list(dict(obj), update=False)
+
+            last = "vlan%d" % (size - 1)
+            obj = {"source": last, "dns": ["10.0.0.2"]}
+            number = max(10, 100000 // size)
+
+            def remove_add(db):
+                def _remove_add():
+                    db.remove_dns_list(last)
+                    db.add_dns_list(dict(obj))
+                return _remove_add
+
+            rows.append([
+                size,
+                per_op(lambda: legacy.get_dns_list(last), number) * 1e6,
+                per_op(lambda: bundle.get_dns_list(last), number) * 1e6,
+                per_op(lambda: legacy.add_dns_list(obj), number) * 1e6,
+                per_op(lambda: bundle.add_dns_list(obj, False), number) * 1e6,
+                per_op(remove_add(legacy), number) * 1e6,
+                per_op(lambda: (bundle.remove_dns_list(last),
+                                bundle.add_dns_list(dict(obj), False)),
+                       number) * 1e6])
+    report("DNS database (usec/op)",
+           ["sources", "get(list)", "get", "add(list)", "add",
+            "del+add(list)", "del+add"], rows)
+
+
+@benchmark("write")
+def bench_write():
+    """
+    resolv.conf write latency (usec per write) by fsync policy, on tmpfs
+    and on disk. Set BENCH_TMPFS_DIR or BENCH_DISK_DIR to choose the
+    file systems.
+    """
+    targets = [
+        ("tmpfs", os.getenv("BENCH_TMPFS_DIR", "/dev/shm")),
+        ("disk", os.getenv("BENCH_DISK_DIR", "/var/tmp"))]
+    resolv = "nameserver 8.8.8.8\nnameserver 8.8.4.4\n"
+    rows = []
+    with BundleFixture() as bundle:
+        for name, basedir in targets:
+            if not os.path.isdir(basedir):
+                continue
+            tmpdir = tempfile.mkdtemp(prefix="bench-dns-", dir=basedir)
+            Dns.CONFIG_PATH = os.path.join(tmpdir, "resolv.conf")
+            row = [name]
+            for policy in Dns.FSYNC_POLICIES:
+                Dns.FSYNC_POLICY = policy
+                row.append(per_op(lambda: bundle._write_config(resolv),
+                                  50) * 1e6)
+            rows.append(row)
+            Dns.FSYNC_POLICY = "file"
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    report("resolv.conf write (usec/write)",
+           ["fs"] + list(Dns.FSYNC_POLICIES), rows)
+
+
+def legacy_get_current_dns(bundle):
+    """
+    get_current_dns() which deep copies the settings on every call.
+    """
+    data = copy.deepcopy(bundle.model.db)
+    if "enableFixed" not in data:
+        data["enableFixed"] = False
+
+    if data["enableFixed"] is True:
+        data["source"] = "fixed"
+    if "source" in data:
+        dns = bundle.get_dns_list(data["source"])
+        if dns and "dns" in dns:
+            data["dns"] = copy.copy(dns["dns"])
+        elif data["enableFixed"] is True:
+            data["dns"] = data["fixedDns"]
+    return data
+
+
+def allocations(func, number=1000):
+    """
+    Return number of objects tracked by gc allocated (and kept) per call.
+    """
+    results = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for _ in range(number):
+            results.append(func())
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    return max(0.0, float(after - before - 1) / number)
+
+
+def polling(func, clients, duration=1.0):
+    """
+    Return calls per second of func called by clients in threads.
+    """
+    counts = [0] * clients
+    deadline = time() + duration
+
+    def client(index):
+        while time() < deadline:
+            func()
+            counts[index] += 1
+
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / duration
+
+
+@benchmark("view")
+def bench_view():
+    """
+    GET /network/dns under polling clients, legacy deep copy versus
+    read-only view.
+    """
+    rows = []
+    with BundleFixture() as bundle:
+        bundle.model.db.update({"fixedDns": ["8.8.8.8", "8.8.4.4"]})
+        bundle.add_dns_list({"source": "eth0",
+                             "dns": ["192.168.50.33", "192.168.50.36"]})
+
+        def response(code=200, data=None):
+            return data
+
+        def legacy():
+            return response(data=legacy_get_current_dns(bundle))
+
+        def handler():
+            return response(data=bundle.get_current_dns())
+
+        for clients in [1, 8, 32]:
+            rows.append([clients, polling(legacy, clients),
+                         polling(handler, clients)])
+        alloc = [["alloc/call", allocations(legacy),
+                  allocations(bundle.get_current_dns)]]
+    report("GET /network/dns (calls/sec)",
+           ["clients", "deepcopy", "view"], rows,
+           higher=["deepcopy", "view"])
+    report("GET /network/dns (objects/call)",
+           ["", "deepcopy", "view"], alloc)
+
+
+@benchmark("restart")
+def bench_restart():
+    """
+    Bundle restart time (msec) with thousands of sources, replaying the
+    journal after a crash or loading the compacted snapshot, and the cost
+    (usec) of journaling a change.
+    """
+    rows = []
+    for size in [1000, 5000]:
+        fixture = BundleFixture()
+        with fixture as bundle:
+            bundle.journal.fsync = False
+            start = time()
+            for i in range(size):
+                bundle.add_dns_list(
+                    {"source": "vlan%d" % i, "dns": ["10.0.0.1"]}, False)
+            append = (time() - start) / size
+
+            # crash, then restart from the journal
+            bundle.journal.close()
+            bundle.journal = None
+            bundle.stop()
+            start = time()
+            bundle = fixture.bundle = Dns(connection=Mockup())
+            replay = time() - start
+            assert len(bundle.dns_db) == size + 1
+
+            # stop with compaction, then restart from the snapshot
+            bundle.stop()
+            start = time()
+            bundle = fixture.bundle = Dns(connection=Mockup())
+            snapshot = time() - start
+            assert len(bundle.dns_db) == size + 1
+        rows.append([size, append * 1e6, replay * 1e3, snapshot * 1e3])
+    report("Restart (journal append usec, restart msec)",
+           ["sources", "append", "journal", "snapshot"], rows)
+
+
+def import_time(statement, number=5):
+    """
+    Return the best seconds of statement in a fresh interpreter.
+    """
+    code = ("import sys; sys.path.insert(0, %r); from time import time; "
+            "start = time(); %s; print(time() - start)"
+            % (os.path.dirname(dirpath), statement))
+    return min(float(subprocess.check_output([sys.executable, "-c", code]))
+               for _ in range(number))
+
+
+@benchmark("startup")
+def bench_startup():
+    """
+    Startup time (msec): import of the bundle module, with its optional
+    modules imported eagerly as reference, and phases of startup from
+    init() to the end of run() on first boot and on restart.
+    """
+    rows = [["dns", import_time("import dns") * 1e3],
+            ["dns+eager", import_time(
+                "import dns, forwarder, prober, sanji.connection.mqtt; "
+                "dns.Dns.IFACE_SCHEMA, dns.Dns.PUT_DB_SCHEMA, "
+                "dns.Dns.PATCH_DB_SCHEMA, dns.Dns.PUT_DNS_SCHEMA") * 1e3]]
+    report("Import (msec)", ["module", "import"], rows)
+
+    phases = ["init", "model", "restore", "compact", "publish",
+              "forwarder", "config", "prober"]
+    probe_interval = Dns.PROBE_INTERVAL
+    Dns.PROBE_INTERVAL = 0
+    rows = []
+    try:
+        for size in [10, 1000]:
+            fixture = BundleFixture()
+            with fixture as bundle:
+                bundle.run()
+                bundle.add_dns_lists([{"source": "vlan%d" % i,
+                                       "dns": ["10.0.%d.1" % (i % 256)]}
+                                      for i in range(size)], False)
+                bundle.set_current_dns({"source": "vlan0"})
+                first = bundle
+                bundle.stop()
+                bundle = fixture.bundle = Dns(connection=Mockup())
+                bundle.run()
+                for name, startup in [("boot", first.startup),
+                                      ("restart", bundle.startup)]:
+                    row = ["%s/%d" % (name, size)]
+                    row.extend(startup.get(phase, 0.0) * 1e3
+                               for phase in phases)
+                    row.append(sum(startup.values()) * 1e3)
+                    rows.append(row)
+    finally:
+        Dns.PROBE_INTERVAL = probe_interval
+    report("Startup phases (msec)", ["case"] + phases + ["total"], rows)
+
+
+@benchmark("expiry")
+def bench_expiry():
+    """
+    Lease expiry (usec/source) by number of leased sources: renew a lease,
+    and expire a batch of leases from the heap.
+    """
+    rows = []
+    for size in [1000, 10000, 100000]:
+        scheduler = ExpiryScheduler(lambda keys: None)
+        now = time()
+        for i in range(size):
+            scheduler.schedule("vlan%d" % i, now + 3600 + i)
+        counter = [0]
+
+        def renew():
+            counter[0] += 1
+            scheduler.schedule("vlan%d" % (counter[0] % size),
+                               now + 7200 + counter[0])
+
+        number = 10000
+        renew_cost = per_op(renew, number)
+        start = time()
+        expired = scheduler._pop_expired(now + 3600 + size // 10)
+        expire_cost = (time() - start) / max(len(expired), 1)
+        scheduler.stop()
+        rows.append([size, renew_cost * 1e6, expire_cost * 1e6])
+    report("Lease expiry (usec/source)", ["sources", "renew", "expire"],
+           rows)
+
+
+@benchmark("rules")
+def bench_rules():
+    """
+    Forwarding rules lookup (usec/name) by number of rules: the suffix
+    trie against a scan for the longest matching suffix, and indexing the
+    rules into the trie (msec).
+    """
+    def scan(rules, name):
+        found = None
+        for domain, servers in rules:
+            if (name == domain or name.endswith("." + domain)) and \
+                    (found is None or len(domain) > len(found[0])):
+                found = (domain, servers)
+        return found
+
+    rows = []
+    for size in [10, 100, 1000]:
+        rules = [("site%d.corp.example." % i,
+                  ["10.%d.%d.1" % (i // 256, i % 256)])
+                 for i in range(size)]
+        names = ["www.site%d.corp.example." % (i * 7 % size)
+                 for i in range(100)] + ["www.example.%d." % i
+                                         for i in range(100)]
+        start = time()
+        trie = DomainTrie()
+        for domain, servers in rules:
+            trie.add(domain, servers)
+        index = time() - start
+
+        def lookup_trie():
+            for name in names:
+                trie.match(name)
+
+        def lookup_scan():
+            for name in names:
+                scan(rules, name)
+
+        number = 100
+        rows.append([size,
+                     per_op(lookup_trie, number) / len(names) * 1e6,
+                     per_op(lookup_scan, max(1, number // size * 10))
+                     / len(names) * 1e6,
+                     index * 1e3])
+    report("Forwarding rules (lookup usec/name, index msec)",
+           ["rules", "trie", "scan", "index"], rows)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+@benchmark("forwarder")
+def bench_forwarder():
+    """
+    Local caching forwarder against a stub upstream with 5 msec latency:
+    cache hit rate and query latency (msec) of a skewed workload.
+    """
+    upstream = StubUpstream(delay=0.005).start()
+    forwarder = Forwarder(lambda: [upstream.address], port=0)
+    forwarder.start()
+    names = ["host%d.example." % i for i in range(500)]
+    weights = [1.0 / (i + 1) for i in range(len(names))]
+    total = sum(weights)
+    rng = random.Random(0)
+
+    def pick():
+        value = rng.random() * total
+        for name, weight in zip(names, weights):
+            value -= weight
+            if value <= 0:
+                return name
+        return names[-1]
+
+    try:
+        rows = []
+        direct = []
+        for _ in range(100):
+            start = time()
+            query_udp(upstream.address, pick())
+            direct.append((time() - start) * 1e3)
+        rows.append(["direct", 0.0, percentile(direct, 50),
+                     percentile(direct, 99)])
+
+        latencies = []
+        for _ in range(3000):
+            start = time()
+            query_udp(forwarder.address, pick())
+            latencies.append((time() - start) * 1e3)
+        stats = forwarder.cache.stats
+        rows.append(["forwarder",
+                     100.0 * stats["hits"] / (stats["hits"] +
+                                              stats["misses"]),
+                     percentile(latencies, 50), percentile(latencies, 99)])
+    finally:
+        forwarder.stop()
+        upstream.stop()
+    report("DNS forwarder (hit rate %, latency msec)",
+           ["path", "hit rate", "p50", "p99"], rows, higher=["hit rate"])
+
+
+@benchmark("micro")
+def bench_micro():
+    """
+    Hot paths of the bundle (usec per call) by number of sources: update a
+    DNS list, get current DNS from the view and rebuild it, generate DNS
+    file, and set current DNS (journal and DNS file written). Updates are
+    run by the writer thread as handlers do.
+    """
+    rows = []
+    for size in [10, 100, 1000]:
+        with BundleFixture() as bundle:
+            bundle.journal.fsync = False
+            bundle.add_dns_lists([{"source": "vlan%d" % i,
+                                   "dns": ["10.0.%d.1" % (i % 256)]}
+                                  for i in range(size)], False)
+            bundle.set_current_dns({"source": "vlan0"})
+            counter = [0]
+
+            def add():
+                counter[0] += 1
+                bundle.writer.call(
+                    bundle.add_dns_list,
+                    {"source": "vlan0",
+                     "dns": ["10.1.%d.1" % (counter[0] % 256)]}, False)
+
+            def set_current():
+                counter[0] += 1
+                bundle.writer.call(
+                    bundle.set_current_dns,
+                    {"fixedDns": ["10.2.%d.1" % (counter[0] % 256)]})
+
+            number = 1000
+            rows.append([
+                size,
+                per_op(add, number) * 1e6,
+                per_op(bundle.get_current_dns, number) * 1e6,
+                per_op(bundle._build_current_dns, number) * 1e6,
+                per_op(bundle._generate_config, number) * 1e6,
+                per_op(set_current, number // 10) * 1e6])
+    report("Hot paths (usec/call)",
+           ["sources", "add", "get", "rebuild", "generate", "set"], rows)
+
+
+def deep_size(obj, seen):
+    """
+    Bytes of obj and objects it holds, objects in seen are not counted
+    again.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, DnsEntry):
+        size += sum(deep_size(getattr(obj, slot), seen)
+                    for slot in DnsEntry.__slots__ if hasattr(obj, slot))
+    return size
+
+
+@benchmark("memory")
+def bench_memory():
+    """
+    Memory of DNS lists (bytes/source) by number of sources, each with two
+    nameservers and a search domain as received in events: dictionaries
+    against entries in DNS database, and the cost of unpacking
+    nameservers (usec/access).
+    """
+    rows = []
+    for size in [100, 1000, 10000]:
+        messages = [json.dumps({
+            "source": "vlan%d" % i,
+            "dns": ["10.%d.%d.1" % (i % 64, i % 7), "2001:db8::%x" % (i % 5)],
+            "search": ["site%d.example" % (i % 3)]}) for i in range(size)]
+        legacy = [json.loads(message) for message in messages]
+        db = DnsDatabase()
+        for message in messages:
+            entry = json.loads(message)
+            db[entry["source"]] = entry
+        # keys of dictionaries are shared by all of them
+        keys = set(id(key) for entry in legacy for key in entry)
+        before = deep_size(legacy, set(keys)) - sys.getsizeof(legacy)
+        after = deep_size(list(db.values()), set(keys)) - \
+            sys.getsizeof(list(db.values()))
+        entry = db["vlan0"]
+        rows.append([size, float(before) / size, float(after) / size,
+                     per_op(lambda: entry["dns"], 10000) * 1e6])
+    report("Memory of DNS lists (bytes/source)",
+           ["sources", "dict", "entry", "unpack"], rows)
+
+
+@benchmark("validate")
+def bench_validate():
+    """
+    Validation of interface events (usec/message) by IFACE_SCHEMA, against
+    the length check of nameservers it replaces, with addresses cached
+    (the same servers every event) and not cached. The length check
+    rejects IPv6 addresses, so it is not measured for them.
+    """
+    legacy = dict(Dns.IFACE_SCHEMA.schema)
+    legacy[Required("dns")] = [Any("", All(basestring, Length(0, 15)))]
+    legacy = Schema(legacy, extra=REMOVE_EXTRA)
+    messages = OrderedDict([
+        ("ipv4", {"name": "eth0", "dns": ["192.168.1.1", "8.8.8.8"]}),
+        ("ipv4+search", {"name": "eth0", "dns": ["192.168.1.1", "8.8.8.8"],
+                         "search": ["lan"], "options": {"timeout": 1}}),
+        ("ipv6", {"name": "eth0", "dns": ["2001:4860:4860::8888",
+                                          "fe80::1%eth0"]})])
+
+    def uncached(data):
+        dns._NAMESERVER_CACHE.clear()
+        Dns.IFACE_SCHEMA(data)
+
+    number = 10000
+    rows = []
+    for name, data in messages.items():
+        rows.append([
+            name,
+            per_op(lambda: legacy(data), number) * 1e6
+            if name != "ipv6" else "-",
+            per_op(lambda: Dns.IFACE_SCHEMA(data), number) * 1e6,
+            per_op(lambda: uncached(data), number) * 1e6])
+    report("Validate interface events (usec/message)",
+           ["message", "length", "cached", "uncached"], rows)
+
+
+class MessageDriver(object):
+    """
+    Feed messages into the bundle as the connection does, dispatched by
+    the bundle's own threads, and time the responses.
+    """
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.latencies = []
+        self._sent = {}
+        self._next_id = 0
+        self._cond = Condition()
+        bundle.publish.create_response = self._create_response
+        bundle._create_thread_pool()
+
+    def _create_response(self, message, sign):
+        def _response(code=200, data=None):
+            with self._cond:
+                sent, tag = self._sent.pop(message.id)
+                self.latencies.append((tag, time() - sent))
+                self._cond.notify_all()
+        return _response
+
+    def send(self, method, resource, data, tag=None):
+        payload = {"method": method, "resource": resource, "data": data}
+        with self._cond:
+            self._next_id += 1
+            payload["id"] = self._next_id
+            self._sent[payload["id"]] = (time(), tag)
+        self.bundle.on_sanji_message(
+            self.bundle._conn, None, MqttMessage(json.dumps(payload)))
+
+    def event(self, resource, data):
+        payload = {"code": 200, "method": "put", "resource": resource,
+                   "data": data}
+        self.bundle.on_sanji_message(
+            self.bundle._conn, None, MqttMessage(json.dumps(payload)))
+
+    def wait(self, tag=None):
+        """
+        Wait for responses of all requests sent, return their latencies,
+        only of requests sent with the tag if given.
+        """
+        with self._cond:
+            while self._sent:
+                self._cond.wait()
+            latencies, self.latencies = self.latencies, []
+        return [latency for sent_tag, latency in latencies
+                if tag is None or sent_tag == tag]
+
+
+class MqttMessage(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def workloads():
+    """
+    Request messages (method, resource, data) by workload, data is given
+    by the index of the message.
+    """
+    return OrderedDict([
+        ("get dns", ("get", "/network/dns", lambda i: {})),
+        ("put dns", ("put", "/network/dns",
+                     lambda i: {"enableFixed": i % 2 == 0,
+                                "fixedDns": ["10.2.%d.1" % (i % 256)]})),
+        ("get db", ("get", "/network/dns/db", lambda i: {})),
+        ("put db", ("put", "/network/dns/db",
+                    lambda i: [{"source": "vlan%d" % j,
+                                "dns": ["10.3.%d.1" % (i % 256)]}
+                               for j in range(10)])),
+        ("patch db", ("put", "/network/dns/db/eth0",
+                      lambda i: [{"op": "replace", "path": "/dns/0",
+                                  "value": "10.4.%d.1" % (i % 256)}]))])
+
+
+def burst(driver, method, resource, data, count):
+    """
+    Send count requests at once, return messages per second and latencies.
+    """
+    start = time()
+    for i in range(count):
+        driver.send(method, resource, data(i))
+    latencies = driver.wait()
+    return count / (time() - start), latencies
+
+
+@benchmark("messages")
+def bench_messages():
+    """
+    End-to-end message handling through the bundle's dispatch threads,
+    bursts of requests by route (messages/sec, latency msec) and events,
+    the same by number of sources, and GET /network/dns latency (msec) by
+    message rate with 10% PUT.
+    """
+    count = 2000
+    rows = []
+    with BundleFixture() as bundle:
+        bundle.journal.fsync = False
+        bundle.add_dns_list({"source": "eth0", "dns": ["10.0.0.1"]})
+        bundle.set_current_dns({"source": "eth0"})
+        driver = MessageDriver(bundle)
+
+        for name, (method, resource, data) in workloads().items():
+            rate, latencies = burst(driver, method, resource, data, count)
+            rows.append([name, rate, percentile(latencies, 50) * 1e3,
+                         percentile(latencies, 99) * 1e3])
+
+        last = ["10.5.%d.1" % ((count - 1) % 256)]
+        start = time()
+        for i in range(count):
+            driver.event("/network/interfaces/eth1",
+                         {"name": "eth1", "dns": ["10.5.%d.1" % (i % 256)]})
+        while (bundle.get_dns_list("eth1") or {}).get("dns") != last:
+            sleep(0.001)
+        rows.append(["event", count / (time() - start), "-", "-"])
+    report("Messages, bursts of %d (messages/sec, latency msec)" % count,
+           ["route", "rate", "p50", "p99"], rows, higher=["rate"])
+
+    count = 500
+    names = list(workloads())
+    rates = []
+    p99s = []
+    for size in [10, 100, 1000, 5000]:
+        with BundleFixture() as bundle:
+            bundle.journal.fsync = False
+            bundle.add_dns_lists([{"source": "eth0", "dns": ["10.0.0.1"]}] +
+                                 [{"source": "vlan%d" % i,
+                                   "dns": ["10.0.%d.1" % (i % 256)]}
+                                  for i in range(size - 1)], False)
+            bundle.set_current_dns({"source": "eth0"})
+            driver = MessageDriver(bundle)
+            rate_row = [size]
+            p99_row = [size]
+            for method, resource, data in workloads().values():
+                rate, latencies = burst(driver, method, resource, data,
+                                        count)
+                rate_row.append(rate)
+                p99_row.append(percentile(latencies, 99) * 1e3)
+            rates.append(rate_row)
+            p99s.append(p99_row)
+    report("Messages by sources, bursts of %d (messages/sec)" % count,
+           ["sources"] + names, rates, higher=names)
+    report("Messages by sources, bursts of %d (p99 latency msec)" % count,
+           ["sources"] + names, p99s)
+
+    rows = []
+    for rate in [100, 500, 2000]:
+        with BundleFixture() as bundle:
+            bundle.journal.fsync = False
+            driver = MessageDriver(bundle)
+            deadline = time()
+            for i in range(rate):
+                if i % 10 == 0:
+                    driver.send("put", "/network/dns",
+                                {"fixedDns": ["10.6.%d.1" % (i % 256)]})
+                else:
+                    driver.send("get", "/network/dns", {}, tag="get")
+                deadline += 1.0 / rate
+                sleep(max(0, deadline - time()))
+            gets = driver.wait(tag="get")
+        rows.append([rate, percentile(gets, 50) * 1e3,
+                     percentile(gets, 99) * 1e3])
+    report("GET /network/dns by message rate (latency msec)",
+           ["msgs/sec", "p50", "p99"], rows)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with the baseline table by table, cell by cell.
+
+    Returns:
+        A list of (benchmark, title, row, column, baseline, result) worse
+        than the baseline by more than the threshold ratio.
+    """
+    regressions = []
+    for name, tables in results.items():
+        base_tables = dict((table["title"], table)
+                           for table in baseline.get(name, []))
+        for table in tables:
+            base = base_tables.get(table["title"])
+            if base is None:
+                continue
+            base_rows = dict((str(row[0]), row) for row in base["rows"])
+            for row in table["rows"]:
+                base_row = base_rows.get(str(row[0]))
+                if base_row is None:
+                    continue
+                for column, value, base_value in zip(
+                        table["header"][1:], row[1:], base_row[1:]):
+                    if not isinstance(value, float) or \
+                            not isinstance(base_value, float) or \
+                            base_value == 0:
+                        continue
+                    change = (value - base_value) / base_value
+                    if column in table["higher"]:
+                        change = -change
+                    if change > threshold:
+                        regressions.append((name, table["title"], row[0],
+                                            column, base_value, value))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for the DNS "
+                                     "bundle.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="one of %s" % ", ".join(BENCHMARKS.keys()))
+    parser.add_argument("--json", help="write results into the file")
+    parser.add_argument("--baseline", help="compare with results in the "
+                        "file written by --json")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="ratio of change reported as a regression")
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks or BENCHMARKS.keys():
+        _running.append(name)
+        try:
+            BENCHMARKS[name]()
+        finally:
+            _running.pop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time(),
+                       "results": RESULTS}, f, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(RESULTS, baseline, args.threshold)
+    rows = [[name, title, str(row), column, base_value, value]
+            for name, title, row, column, base_value, value in regressions]
+    print("\n%d regression(s) over %d%% against %s"
+          % (len(rows), args.threshold * 100, args.baseline))
+    for row in rows:
+        print("  %s: %s [%s] %s: %.3f -> %.3f" % tuple(row))
+    return 1 if rows else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,41 @@
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 import logging
+import json
+import copy
+import subprocess
+from threading import Event
+from threading import Thread
+from threading import local
+from time import sleep
+from time import time
 
 from sanji.connection.mockup import Mockup
 from sanji.message import Message
 from mock import patch
-from mock import mock_open
 from mock import Mock
+from voluptuous import Invalid
 
 
 try:
     sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
     from dns import Dns
+    from dns import DnsContext
+    from dns import DnsDatabase
+    from dns import DnsEntry
+    from dns import PriorityIndex
+    from dns import IOExecutor
+    from dns import ChangePublisher
+    from dns import CommandQueue
+    from dns import ExpiryScheduler
+    from dns import Journal
+    from dns import apply_dns_patch
+    from dns import nameserver
+    from dns import share
+    from prober import HealthProber
 except ImportError as e:
     print os.path.dirname(os.path.realpath(__file__)) + '/../'
     print sys.path
@@ -23,6 +46,53 @@ except ImportError as e:
 
 dirpath = os.path.dirname(os.path.realpath(__file__))
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def serve_serially(bundle, requests, interval):
+    """
+    Dispatch GET/PUT /network/dns requests one by one like the message
+    loop of the bundle, while a request arrives every interval seconds.
+
+    Returns:
+        Latencies (seconds) of GET requests, from arrival to response.
+    """
+    arrivals = queue.Queue()
+    latencies = []
+
+    def response(code=200, data=None):
+        return data
+
+    def dispatcher():
+        while True:
+            request = arrivals.get()
+            if request is None:
+                return
+            arrived, method, data = request
+            message = Message({"data": data})
+            if method == "get":
+                bundle._get_current_dns(message, response, test=True)
+                latencies.append(time() - arrived)
+            else:
+                bundle._put_current_dns(message, response, test=True)
+
+    thread = Thread(target=dispatcher)
+    thread.start()
+    for method, data in requests:
+        arrivals.put((time(), method, data))
+        sleep(interval)
+    arrivals.put(None)
+    thread.join()
+    return latencies
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
 
 class MockLoggingHandler(logging.Handler):
     """Mock logging handler to check for expected logs.
@@ -75,32 +145,46 @@ class TestDnsClass(unittest.TestCase):
         self._dns_log_handler.reset()  # So each test is independent
 
         self.name = "dns"
+
+        # never touch the system DNS file
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = patch.object(Dns, "CONFIG_PATH",
+                               self.tmpdir + "/resolv.conf")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(Dns, "NETNS_CONFIG_PATH",
+                               self.tmpdir + "/netns/%s/resolv.conf")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         self.bundle = Dns(connection=Mockup())
 
     def tearDown(self):
-        self.bundle.dns_db[:] = []
+        self.bundle.dns_db.clear()
         self.bundle.stop()
         self.bundle = None
-        try:
-            os.remove("%s/data/%s.json" % (dirpath, self.name))
-        except OSError:
-            pass
-
-        try:
-            os.remove("%s/data/%s.json.backup" % (dirpath, self.name))
-        except OSError:
-            pass
-
+        for ext in ["json", "json.backup", "journal", "sources.json",
+                    "netns.json"]:
+            try:
+                os.remove("%s/data/%s.%s" % (dirpath, self.name, ext))
+            except OSError:
+                pass
+
+    @patch("prober.HealthProber")
     @patch.object(Dns, "update_config")
-    def test__run(self, mock_update_config):
+    def test__run(self, mock_update_config, mock_prober):
         """
         run
         """
         self.bundle.run()
         mock_update_config.assert_called_once_with()
+        mock_prober.return_value.start.assert_called_once_with()
 
+    @patch("prober.HealthProber")
     @patch.object(Dns, "update_config")
-    def test__run__update_resolv_conf_failed(self, mock_update_config):
+    def test__run__update_resolv_conf_failed(self, mock_update_config,
+                                             mock_prober):
         """
         run: failed to update resolv.conf
         """
@@ -109,6 +193,608 @@ class TestDnsClass(unittest.TestCase):
         self.assertEqual(len(self.dns_log_messages["warning"]), 1)
         self.assertIn("Failed to update", self.dns_log_messages["warning"][0])
 
+    def test__journal__replay(self):
+        """
+        Journal: replay records until a broken one
+        """
+        # arrange
+        journal = Journal(self.tmpdir + "/dns.journal")
+        journal.append({"op": "remove", "source": "eth0"})
+        journal.append({"op": "remove", "source": "eth1"})
+        journal.close()
+        with open(journal.path, "a") as f:
+            f.write('{"op": "remove", "sou')
+
+        # act
+        records = journal.replay()
+
+        # assert
+        self.assertEqual(records, [{"op": "remove", "source": "eth0"},
+                                   {"op": "remove", "source": "eth1"}])
+        self.assertEqual(journal.records, 2)
+        self.assertEqual(len(self.dns_log_messages["warning"]), 1)
+
+        journal.truncate()
+        self.assertEqual(journal.replay(), [])
+        journal.close()
+
+    @patch.object(Dns, "update_config")
+    def test__load__warm_restart(self, mock_update_config):
+        """
+        load: restore DNS database and settings from the journal
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth1", "dns": ["1.1.1.1"]})
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["8.8.8.8"]})
+        self.bundle.remove_dns_list("eth1")
+        self.bundle.set_current_dns({"fixedDns": ["9.9.9.9"]})
+        self.bundle.add_dns_list({"source": "wwan0", "dns": ["2.2.2.2"]})
+
+        # act: restart without compaction
+        self.bundle.journal.close()
+        self.bundle.journal = None
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+
+        # assert
+        self.assertEqual(
+            self.bundle.get_dns_database(),
+            [{"source": "fixed", "dns": ["9.9.9.9"]},
+             {"source": "eth0", "dns": ["8.8.8.8"]},
+             {"source": "wwan0", "dns": ["2.2.2.2"]}])
+        self.assertEqual(self.bundle.model.db["fixedDns"], ["9.9.9.9"])
+        self.assertEqual(self.bundle.journal.records, 0)
+
+    def test__load__fast_start(self):
+        """
+        load: nothing is written on restart if the journal is empty and
+        snapshots are intact, startup phases are timed
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["8.8.8.8"]})
+        self.bundle.set_current_dns({"fixedDns": ["9.9.9.9"]})
+        self.bundle.stop()
+
+        # act
+        with patch("dns.write_file") as mock_write_file, \
+                patch.object(Journal, "_truncate") as mock_truncate, \
+                patch("sanji.model_initiator.ModelInitiator.backup_db") \
+                as mock_backup_db:
+            self.bundle = Dns(connection=Mockup())
+
+        # assert
+        self.assertEqual(mock_write_file.call_count, 0)
+        self.assertEqual(mock_truncate.call_count, 0)
+        self.assertEqual(mock_backup_db.call_count, 0)
+        self.assertEqual(self.bundle.get_dns_list("eth0")["dns"], ["8.8.8.8"])
+        self.assertEqual(list(self.bundle.startup.keys()),
+                         ["init", "model", "restore", "publish"])
+
+        # broken snapshot is written again
+        with open(self.bundle.snapshot_path, "w") as f:
+            f.write("[{")
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+        with open(self.bundle.snapshot_path) as f:
+            self.assertEqual(json.load(f), self.bundle.get_dns_database())
+        self.assertIn("compact", self.bundle.startup)
+
+    def test__lazy_import(self):
+        """
+        import: MQTT connection, forwarder, prober and schemas are loaded
+        on first use
+        """
+        # arrange
+        code = ("import sys; sys.path.insert(0, %r); import dns; "
+                "print([m in sys.modules for m in ['sanji.connection.mqtt', "
+                "'paho', 'forwarder', 'prober']]); "
+                "print(type(dns.Dns.__dict__['IFACE_SCHEMA']).__name__); "
+                "dns.Dns.IFACE_SCHEMA; "
+                "print(type(dns.Dns.__dict__['IFACE_SCHEMA']).__name__)"
+                % os.path.dirname(dirpath))
+
+        # act
+        output = subprocess.check_output([sys.executable, "-c", code])
+
+        # assert
+        self.assertEqual(output.splitlines(),
+                         ["[False, False, False, False]", "lazy_schema",
+                          "Schema"])
+
+    def test__compact(self):
+        """
+        compact: compact the journal into snapshots if it is too long
+        """
+        # arrange
+        with patch.object(Dns, "JOURNAL_MAX_RECORDS", 5):
+            # act
+            for i in range(6):
+                self.bundle.add_dns_list(
+                    {"source": "vlan%d" % i, "dns": ["1.1.1.1"]})
+
+            # assert
+            self.assertEqual(self.bundle.journal.records, 1)
+            with open(self.bundle.snapshot_path) as f:
+                self.assertEqual(len(json.load(f)), 1 + 5)
+
+    def test__save(self):
+        """
+        save: append the settings into the journal
+        """
+        # arrange
+        records = self.bundle.journal.records
+        self.bundle.model.db["enableFixed"] = True
+
+        with patch.object(self.bundle.model, "save_db") as mock_save_db:
+            # act
+            self.assertTrue(self.bundle.save())
+
+            # assert
+            self.assertEqual(mock_save_db.call_count, 0)
+            self.assertEqual(self.bundle.journal.records, records + 1)
+
+    def count_disk_writes(self):
+        """
+        Count writes of files by name: DNS file, journal, snapshots and the
+        settings backup.
+        """
+        writes = {}
+        write_file = sys.modules["dns"].write_file
+        journal_write = Journal._write
+        backup_db = self.bundle.model.backup_db
+
+        def count(path):
+            name = os.path.basename(path)
+            writes[name] = writes.get(name, 0) + 1
+
+        def counted_write_file(path, *args, **kwargs):
+            count(path)
+            return write_file(path, *args, **kwargs)
+
+        def counted_journal_write(journal, line):
+            count(journal.path)
+            return journal_write(journal, line)
+
+        def counted_backup_db():
+            count(self.bundle.model.backup_json_db_path)
+            return backup_db()
+
+        for patcher in [
+                patch("dns.write_file", side_effect=counted_write_file),
+                patch.object(Journal, "_write", counted_journal_write),
+                patch.object(self.bundle.model, "backup_db",
+                             side_effect=counted_backup_db)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return writes
+
+    def test__put_current_dns__disk_writes(self):
+        """
+        _put_current_dns: write nothing if settings are not changed, and
+        only the journal and DNS file if changed
+        """
+        # arrange
+        self.bundle.set_current_dns({"fixedDns": ["1.1.1.1"]})
+        writes = self.count_disk_writes()
+        mock_func = Mock(code=200, data=None)
+
+        def put(data):
+            writes.clear()
+            self.bundle._put_current_dns(Message({"data": data}), mock_func,
+                                         test=True)
+            return dict(writes)
+
+        # act & assert
+        self.assertEqual(put({"fixedDns": ["1.1.1.1"]}), {})
+        self.assertEqual(put({"enableFixed": True}),
+                         {"dns.journal": 1, "resolv.conf": 1})
+        self.assertEqual(put({"enableFixed": True}), {})
+        self.assertEqual(put({"enableFixed": False}),
+                         {"dns.journal": 1, "resolv.conf": 1})
+
+    def test__compact__disk_writes(self):
+        """
+        compact: write modified snapshots only, and back up settings at
+        most once per interval and on stop
+        """
+        # arrange
+        writes = self.count_disk_writes()
+
+        def compact():
+            writes.clear()
+            self.bundle.compact()
+            return dict(writes)
+
+        # act & assert
+        # the first backup is left from startup to the first compaction
+        self.assertEqual(compact(), {"dns.json.backup": 1})
+        self.assertEqual(compact(), {})
+
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]})
+        self.assertEqual(compact(), {"dns.sources.json": 1})
+
+        self.bundle.set_current_dns({"fixedDns": ["1.1.1.1"]}, False)
+        self.assertEqual(compact(), {"dns.json": 1, "dns.sources.json": 1})
+
+        self.bundle.model.db["enableFixed"] = True
+        self.assertEqual(compact(), {"dns.json": 1})
+
+        with patch.object(Dns, "BACKUP_INTERVAL", 0):
+            self.bundle.model.db["enableFixed"] = False
+            self.assertEqual(compact(), {"dns.json": 1,
+                                         "dns.json.backup": 1})
+            self.assertEqual(compact(), {})
+
+        self.bundle.model.db["enableFixed"] = True
+        self.assertEqual(compact(), {"dns.json": 1})
+        writes.clear()
+        self.bundle.stop()
+        self.assertEqual(writes, {"dns.json.backup": 1})
+
+    def test__io_executor(self):
+        """
+        IOExecutor: run tasks in order, failures are logged
+        """
+        # arrange
+        executor = IOExecutor()
+        done = []
+
+        def fail():
+            raise IOError("No space left on device")
+
+        # act
+        for i in range(50):
+            executor.submit(done.append, i)
+        executor.submit(fail)
+        executor.submit(done.append, 50)
+        executor.join()
+        executor.stop()
+
+        # assert
+        self.assertEqual(done, list(range(51)))
+        self.assertEqual(executor.pending(), 0)
+        self.assertEqual(executor.stats,
+                         {"submitted": 52, "completed": 51, "failed": 1})
+        self.assertEqual(len(self.dns_log_messages["warning"]), 1)
+
+    def test__journal__executor(self):
+        """
+        Journal: records are counted now and written by the executor
+        """
+        # arrange
+        executor = IOExecutor()
+        journal = Journal(self.tmpdir + "/dns.journal", executor=executor)
+
+        # act
+        journal.append({"op": "remove", "source": "eth0"})
+        journal.truncate()
+        journal.append({"op": "remove", "source": "eth1"})
+        records = journal.records
+        executor.stop()
+        journal.close()
+
+        # assert
+        self.assertEqual(records, 1)
+        self.assertEqual(journal.replay(),
+                         [{"op": "remove", "source": "eth1"}])
+
+    def test__command_queue(self):
+        """
+        CommandQueue: run commands by the writer thread in order, errors
+        are raised to callers
+        """
+        # arrange
+        writer = CommandQueue()
+        done = []
+
+        def command(i):
+            self.assertTrue(writer.in_writer())
+            self.assertEqual(writer.sequence % 2, 1)
+            done.append(i)
+            return i
+
+        def fail():
+            raise ValueError("Invalid command.")
+
+        # act
+        results = [writer.call(command, i) for i in range(10)]
+        nested = writer.call(writer.call, command, 10)
+        with self.assertRaises(ValueError):
+            writer.call(fail)
+        writer.stop()
+
+        # assert
+        self.assertEqual(results, list(range(10)))
+        self.assertEqual(nested, 10)
+        self.assertEqual(done, list(range(11)))
+        self.assertFalse(writer.in_writer())
+        self.assertEqual(writer.sequence, 24)
+
+    def test__before_stop__compact(self):
+        """
+        before_stop: the journal is compacted by the writer thread, not
+        concurrently with commands
+        """
+        # arrange
+        in_writer = []
+        compact = self.bundle.compact
+
+        def record_compact(*args, **kwargs):
+            in_writer.append(self.bundle.writer.in_writer())
+            return compact(*args, **kwargs)
+
+        # act
+        with patch.object(self.bundle, "compact",
+                          side_effect=record_compact) as mock_compact:
+            self.bundle.stop()
+
+        # assert
+        mock_compact.assert_called_once_with(backup=True)
+        self.assertEqual(in_writer, [True])
+
+    @patch("forwarder.Forwarder")
+    def test__before_stop__forwarder(self, mock_forwarder):
+        """
+        before_stop: DNS file is pointed back to upstream servers before
+        the forwarder is stopped
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.model.db["enableForwarder"] = True
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        self.bundle.update_forwarder()
+        self.bundle.update_config()
+        contents = []
+
+        def record_stop():
+            with open(Dns.CONFIG_PATH) as f:
+                contents.append(f.read())
+
+        mock_forwarder.return_value.stop.side_effect = record_stop
+
+        # act
+        self.bundle.stop()
+
+        # assert
+        self.assertIsNone(self.bundle.forwarder)
+        self.assertEqual(contents, ["nameserver 1.1.1.1\n"])
+
+    @patch.object(Dns, "FSYNC_POLICY", "none")
+    def test__concurrent_handlers__stress(self):
+        """
+        Concurrent handlers: readers always see consistent state while
+        many threads modify it
+        """
+        # arrange
+        self.bundle.update_scheduler.quiet_window = 0.01
+        self.bundle.writer.call(self.bundle.add_dns_lists, [
+            {"source": "eth0", "dns": ["10.0.0.1", "10.0.0.2"]},
+            {"source": "eth1", "dns": ["10.0.0.3"]}])
+        self.bundle.writer.call(self.bundle.set_current_dns,
+                                {"source": "eth0"})
+        errors = []
+        writing = []
+        responses = local()
+
+        def response(code=200, data=None):
+            if code != 200:
+                raise AssertionError("%d: %s" % (code, data))
+            responses.data = data
+
+        def prefix(address):
+            return address.rsplit(".", 1)[0]
+
+        def worker(func):
+            def run(*args):
+                try:
+                    func(*args)
+                except Exception as e:
+                    errors.append(e)
+            return run
+
+        @worker
+        def put_database(n):
+            for i in range(50):
+                network = "10.%d.%d" % (n, i)
+                message = Message({"data": [
+                    {"source": "eth0", "dns": [network + ".1",
+                                               network + ".2"]},
+                    {"source": "eth1", "dns": [network + ".3"]}]})
+                self.bundle._put_dns_database(message, response, test=True)
+
+        @worker
+        def put_settings(n):
+            for i in range(50):
+                network = "9.%d.%d" % (n, i)
+                message = Message({"data": {
+                    "enableFixed": i % 2 == 0,
+                    "fixedDns": [network + ".1", network + ".2"]}})
+                self.bundle._put_current_dns(message, response, test=True)
+
+        @worker
+        def put_interface(n):
+            for i in range(50):
+                message = Message({"data": {"name": "eth2",
+                                            "dns": ["10.99.%d.1" % i]}})
+                message.param = {"name": "eth2"}
+                self.bundle._event_network_interface(message, test=True)
+
+        @worker
+        def get(n):
+            while writing:
+                self.bundle._get_current_dns(
+                    Message({"data": None}), response, test=True)
+                data = responses.data
+                if data["enableFixed"]:
+                    self.assertEqual(data["source"], "fixed")
+                    self.assertEqual(data["dns"], data["fixedDns"])
+                else:
+                    self.assertEqual(data["source"], "eth0")
+                self.assertEqual(len(data["dns"]), 2)
+                self.assertEqual(prefix(data["dns"][0]),
+                                 prefix(data["dns"][1]))
+
+                self.bundle._get_dns_database(
+                    Message({"data": None}), response, test=True)
+                entries = dict((entry["source"], entry)
+                               for entry in responses.data)
+                self.assertEqual(prefix(entries["eth0"]["dns"][0]),
+                                 prefix(entries["eth1"]["dns"][0]))
+
+        writers = [Thread(target=put_database, args=(n,)) for n in range(4)]
+        writers += [Thread(target=put_settings, args=(n,)) for n in range(2)]
+        writers.append(Thread(target=put_interface, args=(0,)))
+        readers = [Thread(target=get, args=(n,)) for n in range(4)]
+
+        # act
+        writing.append(True)
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        writing.pop()
+        for thread in readers:
+            thread.join()
+        self.bundle.update_scheduler.flush()
+
+        # assert
+        self.assertEqual(errors, [])
+        self.assertEqual(self.bundle.get_dns_list("eth2")["dns"],
+                         ["10.99.49.1"])
+        self.assertEqual(self.bundle.writer.sequence % 2, 0)
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(f.read(), self.bundle._generate_config())
+
+    def restart_async(self):
+        self.bundle.stop()
+        patcher = patch.object(Dns, "IO_MODE", "async")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bundle = Dns(connection=Mockup())
+        self.bundle.io.join()
+
+    def test__io_mode__async(self):
+        """
+        IO_MODE: handlers leave writes to the I/O thread in "async" mode
+        """
+        # arrange
+        self.restart_async()
+        message = Message({"data": {"enableFixed": True,
+                                    "fixedDns": ["3.3.3.3"]}})
+        mock_func = Mock(code=200, data=None)
+
+        busy = Event()
+        self.addCleanup(busy.set)
+        self.bundle.io.submit(busy.wait)
+
+        with patch("dns.write_file") as mock_write_file:
+            # act
+            self.bundle._put_current_dns(message, mock_func, test=True)
+
+            # assert
+            self.assertEqual(mock_func.call_args[1]["data"]["fixedDns"],
+                             ["3.3.3.3"])
+            self.assertEqual(mock_write_file.call_count, 0)
+            self.assertGreater(self.bundle.io.pending(), 1)
+            busy.set()
+            self.bundle.io.join()
+            mock_write_file.assert_called_once_with(
+                Dns.CONFIG_PATH, "nameserver 3.3.3.3\n", Dns.FSYNC_POLICY)
+
+        # restart from the journal written by the I/O thread
+        self.bundle.journal.close()
+        self.bundle.journal = None
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+        self.assertEqual(self.bundle.model.db["fixedDns"], ["3.3.3.3"])
+        self.assertEqual(self.bundle.get_dns_list("fixed")["dns"],
+                         ["3.3.3.3"])
+
+    def test__io_mode__async_compact_failure(self):
+        """
+        IO_MODE: the journal is kept if snapshots fail to be written by the
+        I/O thread in "async" mode, and compacted again later
+        """
+        # arrange
+        self.restart_async()
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]})
+        self.bundle.io.join()
+        write_file = sys.modules["dns"].write_file
+
+        def failing_write_file(path, *args, **kwargs):
+            if path == self.bundle.snapshot_path:
+                raise IOError(28, "No space left on device")
+            return write_file(path, *args, **kwargs)
+
+        # act
+        with patch("dns.write_file", side_effect=failing_write_file):
+            self.bundle.compact()
+            self.bundle.io.join()
+
+        # assert
+        self.assertGreater(os.path.getsize(self.bundle.journal.path), 0)
+        self.assertGreater(self.bundle.journal.records, 0)
+        self.assertFalse(self.bundle._compacting)
+
+        # restart from the journal kept
+        self.bundle.journal.close()
+        self.bundle.journal = None
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+        self.bundle.io.join()
+        self.assertEqual(self.bundle.get_dns_list("eth0")["dns"],
+                         ["1.1.1.1"])
+
+        # compacted again once snapshots are written
+        self.bundle.compact()
+        self.bundle.io.join()
+        self.assertEqual(os.path.getsize(self.bundle.journal.path), 0)
+        self.assertEqual(self.bundle.journal.records, 0)
+        with open(self.bundle.snapshot_path) as f:
+            self.assertIn("eth0", [entry["source"]
+                                   for entry in json.load(f)])
+
+    def test__io_mode__get_latency_under_slow_writes(self):
+        """
+        IO_MODE: GET /network/dns is not stalled by slow writes in "async"
+        mode
+        """
+        # arrange
+        delay = 0.03
+        write_file = sys.modules["dns"].write_file
+        journal_write = Journal._write
+
+        def slow_write_file(*args, **kwargs):
+            sleep(delay)
+            return write_file(*args, **kwargs)
+
+        def slow_journal_write(journal, line):
+            sleep(delay)
+            return journal_write(journal, line)
+
+        requests = []
+        for i in range(100):
+            if i % 10 == 0:
+                requests.append(("put", {"enableFixed": True,
+                                         "fixedDns": ["10.0.0.%d" % i]}))
+            else:
+                requests.append(("get", {}))
+
+        # act
+        with patch("dns.write_file", side_effect=slow_write_file), \
+                patch.object(Journal, "_write", slow_journal_write):
+            blocking = serve_serially(self.bundle, requests, 0.002)
+            self.restart_async()
+            latencies = serve_serially(self.bundle, requests, 0.002)
+            self.bundle.io.join()
+
+        # assert
+        self.assertGreater(percentile(blocking, 99), delay)
+        self.assertLess(percentile(latencies, 99), delay)
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(f.read(), "nameserver 10.0.0.90\n")
+
     def test__get_dns_list(self):
         """
         get_dns_list
@@ -116,17 +802,17 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         dns = {"source": "eth1",
                "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         dns = self.bundle.get_dns_list("eth0")
 
         # assert
-        self.assertEqual(self.bundle.dns_db[1], dns)
+        self.assertEqual(self.bundle.get_dns_database()[1], dns)
 
     def test__get_dns_list__cannot_find_source(self):
         """
@@ -135,7 +821,7 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         dns = self.bundle.get_dns_list("eth1")
@@ -150,7 +836,7 @@ class TestDnsClass(unittest.TestCase):
         dns = {"source": "eth1",
                "dns": ["8.8.8.8", "8.8.4.4"]}
         self.bundle.add_dns_list(dns)
-        self.assertEqual(self.bundle.dns_db[1], dns)
+        self.assertEqual(self.bundle.get_dns_database()[1], dns)
 
     @patch.object(Dns, "update_config")
     def test__add_dns_list__update(self, mock_update_config):
@@ -160,7 +846,7 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         dns = {"source": "eth0",
                "dns": ["1.1.1.1", "2.2.2.2"]}
@@ -170,7 +856,24 @@ class TestDnsClass(unittest.TestCase):
 
         # assert
         self.assertEqual(len(self.bundle.dns_db), 2)
-        self.assertEqual(self.bundle.dns_db[1], dns)
+        self.assertEqual(self.bundle.get_dns_database()[1], dns)
+
+    def test__add_dns_list__keep_order(self):
+        """
+        add_dns_list: updating an existing source keeps its position
+        """
+        # arrange
+        for source in ["eth0", "eth1", "eth2"]:
+            self.bundle.add_dns_list({"source": source, "dns": ["1.1.1.1"]})
+
+        # act
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["2.2.2.2"]})
+
+        # assert
+        self.assertEqual(
+            [i["source"] for i in self.bundle.get_dns_database()],
+            ["fixed", "eth0", "eth1", "eth2"])
+        self.assertEqual(self.bundle.get_dns_list("eth0")["dns"], ["2.2.2.2"])
 
     def test__remove_dns_list(self):
         """
@@ -179,18 +882,18 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         dns = {"source": "eth1",
                "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         self.bundle.remove_dns_list("eth0")
 
         # assert
         self.assertEqual(len(self.bundle.dns_db), 2)
-        self.assertEqual(self.bundle.dns_db[1], dns)
+        self.assertEqual(self.bundle.get_dns_database()[1], dns)
 
     def test__remove_dns_list__empty_db(self):
         """
@@ -209,11 +912,11 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         dns = {"source": "eth1",
                "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         self.bundle.remove_dns_list("eth2")
@@ -221,6 +924,23 @@ class TestDnsClass(unittest.TestCase):
         # assert
         self.assertEqual(len(self.bundle.dns_db), 3)
 
+    def test__remove_dns_list__readd(self):
+        """
+        remove_dns_list: a removed source is appended when added again
+        """
+        # arrange
+        for source in ["eth0", "eth1"]:
+            self.bundle.add_dns_list({"source": source, "dns": ["1.1.1.1"]})
+
+        # act
+        self.bundle.remove_dns_list("eth0")
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]})
+
+        # assert
+        self.assertEqual(
+            [i["source"] for i in self.bundle.get_dns_database()],
+            ["fixed", "eth1", "eth0"])
+
     def test__generate_config__by_source(self):
         """
         _generate_config: generate resolv.conf content by source
@@ -230,11 +950,11 @@ class TestDnsClass(unittest.TestCase):
 
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         dns = {"source": "eth1",
                "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         rc = self.bundle._generate_config()
@@ -252,7 +972,7 @@ class TestDnsClass(unittest.TestCase):
 
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         rc = self.bundle._generate_config()
@@ -268,13 +988,13 @@ class TestDnsClass(unittest.TestCase):
         self.bundle.model.db["enableFixed"] = True
         self.bundle.model.db["fixedDns"] = ["8.8.8.8", "3.3.3.3"]
 
-        self.bundle.dns_db = []
+        self.bundle.dns_db.clear()
         dns = {"source": "eth0",
                "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
         dns = {"source": "fixed",
                "dns": ["8.8.8.8", "3.3.3.3"]}
-        self.bundle.dns_db.append(dns)
+        self.bundle.dns_db[dns["source"]] = dns
 
         # act
         rc = self.bundle._generate_config()
@@ -295,96 +1015,790 @@ class TestDnsClass(unittest.TestCase):
         # assert
         self.assertEqual(rc, "")
 
-    def test__write_config(self):
+    def test__generate_config__search_and_options(self):
         """
-        _write_config
+        _generate_config: render search domains and options of the source
         """
         # arrange
-        resolv = "nameserver 1.1.1.1\n" + "nameserver 2.2.2.2\n"
-
-        # patch open
-        m = mock_open()
-        with patch("dns.open", m, create=True) as f:
-            # act
-            self.bundle._write_config(resolv)
-
-            # assert
-            f.return_value.write.assert_called_once_with(resolv)
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({
+            "source": "eth0", "dns": ["1.1.1.1"],
+            "search": ["example.com", "lan"],
+            "options": {"rotate": True, "timeout": 2, "attempts": 3,
+                        "ndots": 0}}, False)
 
-    @patch.object(Dns, "_write_config")
-    @patch.object(Dns, "_generate_config")
-    def test__update_config(self, mock_generate_config, mock_write_config):
-        """
-        update_config: it should_be_called_once
-        """
-
-        # arrange
-        mock_generate_config.return_value = \
-            "nameserver 1.1.1.1\nnameserver 2.2.2.2\n"
         # act
-        self.bundle.update_config()
+        rc = self.bundle._generate_config()
 
         # assert
-        mock_write_config.assert_called_once_with(
-            "nameserver 1.1.1.1\nnameserver 2.2.2.2\n")
+        self.assertEqual(rc, "search example.com lan\n" +
+                         "nameserver 1.1.1.1\n" +
+                         "options ndots:0 timeout:2 attempts:3 rotate\n")
 
-    def test__get_current_dns(self):
+    def test__generate_config__too_many_nameservers(self):
         """
-        get_current_dns
+        _generate_config: warn about nameservers beyond the resolver limit
         """
         # arrange
-        self.bundle.model.db = {
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({
             "source": "eth0",
-            "dns": ["1.1.1.1", "2.2.2.2"]
-        }
+            "dns": ["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4"],
+            "options": {"rotate": False}}, False)
 
         # act
-        data = self.bundle.get_current_dns()
+        rc = self.bundle._generate_config()
 
         # assert
-        self.assertEqual(
-            data,
-            {"enableFixed": False,
-             "source": "eth0",
-             "dns": ["1.1.1.1", "2.2.2.2"]})
+        self.assertEqual(rc.count("nameserver"), 4)
+        self.assertNotIn("options", rc)
+        self.assertEqual(len(self.dns_log_messages["warning"]), 1)
+        self.assertIn("first 3 nameservers",
+                      self.dns_log_messages["warning"][0])
 
     @patch.object(Dns, "update_config")
-    def test__set_current_dns__by_fixed(self, mock_update_config):
+    def test__set_current_dns__fixed_search_and_options(self,
+                                                        mock_update_config):
         """
-        set_current_dns: set by fixed
+        set_current_dns: fixed DNS with search domains and options
         """
         # arrange
-        dns = {"source": "eth0",
-               "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
-
-        dns = {"source": "eth1",
-               "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
-
-        data = {"enableFixed": True, "fixedDns": ["3.3.3.3", "4.4.4.4"]}
+        data = self.bundle.PUT_DNS_SCHEMA({
+            "enableFixed": True, "fixedDns": ["3.3.3.3"],
+            "fixedSearch": ["corp.example"],
+            "fixedOptions": {"timeout": 1}})
 
         # act
         self.bundle.set_current_dns(data)
 
         # assert
-        mock_update_config.assert_called_once_with()
+        self.assertEqual(self.bundle.get_dns_list("fixed")["search"],
+                         ["corp.example"])
+        self.assertEqual(self.bundle._generate_config(),
+                         "search corp.example\nnameserver 3.3.3.3\n" +
+                         "options timeout:1\n")
 
-    @patch.object(Dns, "update_config")
-    def test__set_current_dns__by_source(self, mock_update_config):
+        self.bundle.model.db.pop("fixedSearch")
+        self.bundle.set_current_dns({})
+        self.assertNotIn("search", self.bundle.get_dns_list("fixed"))
+
+    def test__schema__search_and_options(self):
         """
-        set_current_dns: set by source
+        IFACE_SCHEMA: validate search domains and options
         """
         # arrange
-        dns = {"source": "eth0",
-               "dns": ["8.8.8.8", "8.8.4.4"]}
-        self.bundle.dns_db.append(dns)
-
-        dns = {"source": "eth1",
-               "dns": ["1.1.1.1", "2.2.2.2"]}
-        self.bundle.dns_db.append(dns)
-
-        data = {"source": "eth0"}
+        valid = {"name": "eth0", "dns": [], "search": ["a.example."],
+                 "options": {"ndots": 2}}
+
+        # act & assert
+        self.assertEqual(self.bundle.IFACE_SCHEMA(valid), valid)
+        for invalid in [{"search": ["bad domain"]},
+                        {"options": {"timeout": 0}},
+                        {"options": {"attempts": 6}},
+                        {"options": {"rotate": "yes"}}]:
+            data = dict(valid)
+            data.update(invalid)
+            with self.assertRaises(Exception):
+                self.bundle.IFACE_SCHEMA(data)
+
+    @patch.dict("dns._NAMESERVER_CACHE", clear=True)
+    def test__nameserver(self):
+        """
+        nameserver: accept IPv4 and IPv6 addresses, normalize IPv6 ones and
+        remember the results
+        """
+        # arrange
+        valid = {"": "",
+                 "8.8.8.8": "8.8.8.8",
+                 "2001:4860:4860::8888": "2001:4860:4860::8888",
+                 "2001:DB8:0:0::0:1": "2001:db8::1",
+                 "::ffff:192.168.0.1": "::ffff:192.168.0.1",
+                 "FE80::1%eth0": "fe80::1%eth0"}
+        invalid = ["garbage", "1.2.3", "1.2.3.256", "010.0.0.1",
+                   "8.8.8.8\n", " 8.8.8.8", "2001:db8::1::1", "fe80::1%",
+                   "2001:db8::1%eth0", "fe80::1%bad scope", None, 8]
+
+        # act & assert
+        for value, expected in valid.items():
+            self.assertEqual(nameserver(value), expected)
+        for value in invalid:
+            with self.assertRaises(Invalid):
+                nameserver(value)
+
+        with patch("dns.socket.inet_pton") as mock_inet_pton:
+            self.assertEqual(nameserver("2001:DB8:0:0::0:1"), "2001:db8::1")
+            with self.assertRaises(Invalid):
+                nameserver("2001:db8::1::1")
+            self.assertEqual(mock_inet_pton.call_count, 0)
+
+    def test__schema__nameservers(self):
+        """
+        IFACE_SCHEMA, PUT_DNS_SCHEMA, PATCH_DB_SCHEMA: validate and
+        normalize nameserver addresses
+        """
+        # arrange
+        iface = {"name": "eth0", "dns": ["192.168.1.1", "FE80::1%eth0", ""]}
+        settings = {"fixedDns": ["2001:4860:4860:0:0:0:0:8888"]}
+        patch_ops = [{"op": "add", "path": "/dns/-", "value": "::1"}]
+
+        # act & assert
+        self.assertEqual(self.bundle.IFACE_SCHEMA(iface)["dns"],
+                         ["192.168.1.1", "fe80::1%eth0", ""])
+        self.assertEqual(self.bundle.PUT_DNS_SCHEMA(settings)["fixedDns"],
+                         ["2001:4860:4860::8888"])
+        self.assertEqual(self.bundle.PATCH_DB_SCHEMA(patch_ops), patch_ops)
+        for dns in [["not-an-ip"], ["8.8.8.8; rm -rf /"], ["1.1.1.1.1"]]:
+            with self.assertRaises(Exception):
+                self.bundle.IFACE_SCHEMA({"name": "eth0", "dns": dns})
+            with self.assertRaises(Exception):
+                self.bundle.PUT_DNS_SCHEMA({"fixedDns": dns})
+
+    def test__write_config(self):
+        """
+        _write_config
+        """
+        # arrange
+        resolv = "nameserver 1.1.1.1\n" + "nameserver 2.2.2.2\n"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with patch.object(Dns, "CONFIG_PATH", tmpdir + "/resolv.conf"):
+            # act
+            self.bundle._write_config(resolv)
+
+            # assert
+            with open(Dns.CONFIG_PATH) as f:
+                self.assertEqual(f.read(), resolv)
+            self.assertEqual(os.stat(Dns.CONFIG_PATH).st_mode & 0o777, 0o644)
+            self.assertEqual(os.listdir(tmpdir), ["resolv.conf"])
+
+    def test__write_config__replace(self):
+        """
+        _write_config: replace the file and keep its permission
+        """
+        # arrange
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = tmpdir + "/resolv.conf"
+        with open(path, "w") as f:
+            f.write("nameserver 9.9.9.9\n")
+        os.chmod(path, 0o664)
+        inode = os.stat(path).st_ino
+
+        with patch.object(Dns, "CONFIG_PATH", path):
+            # act
+            self.bundle._write_config("nameserver 1.1.1.1\n")
+
+            # assert
+            with open(path) as f:
+                self.assertEqual(f.read(), "nameserver 1.1.1.1\n")
+            self.assertNotEqual(os.stat(path).st_ino, inode)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o664)
+
+    def test__write_config__failed(self):
+        """
+        _write_config: keep the original file if failed to replace it
+        """
+        # arrange
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = tmpdir + "/resolv.conf"
+        with open(path, "w") as f:
+            f.write("nameserver 9.9.9.9\n")
+
+        with patch.object(Dns, "CONFIG_PATH", path), \
+                patch("dns.os.rename", side_effect=OSError):
+            # act & assert
+            with self.assertRaises(OSError):
+                self.bundle._write_config("nameserver 1.1.1.1\n")
+            with open(path) as f:
+                self.assertEqual(f.read(), "nameserver 9.9.9.9\n")
+            self.assertEqual(os.listdir(tmpdir), ["resolv.conf"])
+
+    def test__write_config__fsync_policy(self):
+        """
+        _write_config: fsync file and directory by policy
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        for policy, count in [("none", 0), ("file", 1), ("dir", 2)]:
+            with patch.object(Dns, "CONFIG_PATH", tmpdir + "/resolv.conf"), \
+                    patch.object(Dns, "FSYNC_POLICY", policy), \
+                    patch("dns.os.fsync") as mock_fsync:
+                self.bundle._write_config("nameserver 1.1.1.1\n")
+                self.assertEqual(mock_fsync.call_count, count)
+
+        with patch.object(Dns, "FSYNC_POLICY", "always"):
+            with self.assertRaises(ValueError):
+                self.bundle._write_config("nameserver 1.1.1.1\n")
+
+    @patch.object(Dns, "_write_config")
+    @patch.object(Dns, "_generate_config")
+    def test__update_config(self, mock_generate_config, mock_write_config):
+        """
+        update_config: it should_be_called_once
+        """
+
+        # arrange
+        mock_generate_config.return_value = \
+            "nameserver 1.1.1.1\nnameserver 2.2.2.2\n"
+        # act
+        self.bundle.update_config()
+
+        # assert
+        mock_write_config.assert_called_once_with(
+            "nameserver 1.1.1.1\nnameserver 2.2.2.2\n")
+
+    def test__update_config__skip_unchanged(self):
+        """
+        update_config: skip writing if the content is not changed
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with patch.object(Dns, "CONFIG_PATH", tmpdir + "/resolv.conf"):
+            # act
+            written = self.bundle.update_config()
+            skipped = self.bundle.update_config()
+
+            # assert
+            self.assertTrue(written)
+            self.assertFalse(skipped)
+            self.assertEqual(self.bundle.config_stats,
+                             {"written": 1, "skipped": 1})
+
+            # content changed
+            self.bundle.add_dns_list({"source": "eth0", "dns": ["2.2.2.2"]},
+                                     False)
+            self.assertTrue(self.bundle.update_config())
+            with open(Dns.CONFIG_PATH) as f:
+                self.assertEqual(f.read(), "nameserver 2.2.2.2\n")
+
+    def test__update_config__written_before_restart(self):
+        """
+        update_config: keep the DNS file written before restart if the
+        content is the same
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        with open(Dns.CONFIG_PATH, "w") as f:
+            f.write("nameserver 1.1.1.1\n")
+        inode = os.stat(Dns.CONFIG_PATH).st_ino
+
+        # act
+        skipped = self.bundle.update_config()
+
+        # assert
+        self.assertFalse(skipped)
+        self.assertEqual(os.stat(Dns.CONFIG_PATH).st_ino, inode)
+        self.assertEqual(self.bundle.config_stats,
+                         {"written": 0, "skipped": 1})
+
+    def test__update_config__modified_externally(self):
+        """
+        update_config: rewrite if the file is modified or removed by others
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with patch.object(Dns, "CONFIG_PATH", tmpdir + "/resolv.conf"):
+            self.bundle.update_config()
+
+            # act & assert
+            with open(Dns.CONFIG_PATH, "w") as f:
+                f.write("nameserver 9.9.9.9\nnameserver 8.8.8.8\n")
+            self.assertTrue(self.bundle.update_config())
+            with open(Dns.CONFIG_PATH) as f:
+                self.assertEqual(f.read(), "nameserver 1.1.1.1\n")
+
+            os.remove(Dns.CONFIG_PATH)
+            self.assertTrue(self.bundle.update_config())
+            self.assertTrue(os.path.exists(Dns.CONFIG_PATH))
+            self.assertEqual(self.bundle.config_stats,
+                             {"written": 3, "skipped": 0})
+
+    @patch("forwarder.Forwarder")
+    def test__update_forwarder(self, mock_forwarder):
+        """
+        update_forwarder: start and stop the forwarder by settings
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0",
+                                  "dns": ["1.1.1.1", "", "2.2.2.2"]}, False)
+
+        # act & assert
+        self.bundle.model.db["enableForwarder"] = True
+        self.bundle.update_forwarder()
+        mock_forwarder.return_value.start.assert_called_once_with()
+        self.assertEqual(self.bundle.get_upstream_dns(),
+                         ["1.1.1.1", "2.2.2.2"])
+        self.assertEqual(self.bundle._generate_config(),
+                         "nameserver 127.0.0.1\n")
+
+        self.bundle.model.db["enableForwarder"] = False
+        self.bundle.update_forwarder()
+        mock_forwarder.return_value.stop.assert_called_once_with()
+        self.assertIsNone(self.bundle.forwarder)
+        self.assertEqual(self.bundle._generate_config(),
+                         "nameserver 1.1.1.1\nnameserver 2.2.2.2\n")
+
+    @patch("forwarder.Forwarder")
+    def test__update_forwarder__failed(self, mock_forwarder):
+        """
+        update_forwarder: DNS file is not changed if failed to start
+        """
+        # arrange
+        mock_forwarder.return_value.start.side_effect = IOError("In use")
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+
+        # act
+        self.bundle.model.db["enableForwarder"] = True
+        self.bundle.update_forwarder()
+
+        # assert
+        self.assertIsNone(self.bundle.forwarder)
+        self.assertEqual(len(self.dns_log_messages["warning"]), 1)
+        self.assertEqual(self.bundle._generate_config(),
+                         "nameserver 1.1.1.1\n")
+
+    def test__put_dns_rules(self):
+        """
+        _put_dns_rules: replace forwarding rules, servers of a source are
+        taken from DNS database
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "tun0",
+                                  "dns": ["10.8.0.1", ""]}, False)
+        rules = [{"domain": "corp.example", "source": "tun0"},
+                 {"domain": "lan.", "dns": ["192.168.1.1"]},
+                 {"domain": "vpn.example", "source": "tun1"}]
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._put_dns_rules(Message({"data": rules}), mock_func,
+                                   test=True)
+        self.bundle._get_dns_rules(Message({"data": {}}), mock_func,
+                                   test=True)
+
+        # assert
+        expected = [{"domain": "corp.example", "source": "tun0",
+                     "servers": ["10.8.0.1"]},
+                    {"domain": "lan.", "dns": ["192.168.1.1"],
+                     "servers": ["192.168.1.1"]},
+                    {"domain": "vpn.example", "source": "tun1",
+                     "servers": []}]
+        self.assertEqual(mock_func.call_args_list[0][1]["data"], expected)
+        self.assertEqual(mock_func.call_args_list[1][1]["data"], expected)
+        self.assertEqual(self.bundle.model.db["rules"], rules)
+        self.assertNotIn("rules", self.bundle.get_current_dns())
+
+        self.bundle.add_dns_list({"source": "tun1", "dns": ["10.9.0.1"]},
+                                 False)
+        self.assertEqual(self.bundle.get_dns_rules()[2]["servers"],
+                         ["10.9.0.1"])
+
+    def test__put_dns_rules__invalid(self):
+        """
+        _put_dns_rules: reject invalid rules
+        """
+        # arrange
+        mock_func = Mock(code=200, data=None)
+
+        # act & assert
+        for rules in [{"domain": "lan", "source": "eth0"},
+                      [{"domain": "lan"}],
+                      [{"domain": "lan", "source": "eth0",
+                        "dns": ["1.1.1.1"]}],
+                      [{"domain": "bad domain", "source": "eth0"}],
+                      [{"domain": "lan", "dns": []}],
+                      [{"domain": "lan", "dns": ["not-an-ip"]}],
+                      [{"domain": "lan", "source": "eth0"},
+                       {"domain": "LAN.", "source": "eth1"}]]:
+            self.bundle._put_dns_rules(Message({"data": rules}), mock_func,
+                                       test=True)
+            self.assertEqual(mock_func.call_args[1]["code"], 400)
+        self.assertNotIn("rules", self.bundle.model.db)
+
+    def test__update_config__rules(self):
+        """
+        RULES_CONFIG_PATH: write forwarding rules as per-domain servers,
+        updated once servers of a source in rules are changed
+        """
+        # arrange
+        path = self.tmpdir + "/rules.conf"
+        self.bundle.set_current_dns({"source": "eth0"})
+        self.bundle.add_dns_list({"source": "tun0", "dns": ["10.8.0.1"]},
+                                 False)
+
+        with patch.object(Dns, "RULES_CONFIG_PATH", path):
+            # act
+            self.bundle.set_dns_rules(
+                [{"domain": "corp.example", "source": "tun0"},
+                 {"domain": "lan", "dns": ["192.168.1.1", "fe80::1%br0"]}])
+            with open(path) as f:
+                content = f.read()
+            self.bundle.add_dns_list(
+                {"source": "tun0", "dns": ["10.8.0.2"]})
+
+            # assert
+            self.assertEqual(content,
+                             "server=/corp.example/10.8.0.1\n"
+                             "server=/lan/192.168.1.1\n"
+                             "server=/lan/fe80::1%br0\n")
+            with open(path) as f:
+                self.assertIn("server=/corp.example/10.8.0.2\n", f.read())
+            self.assertFalse(self.bundle._apply_rules_config(
+                self.bundle._generate_rules_config()))
+
+    @patch("forwarder.Forwarder")
+    def test__update_forwarder__rules(self, mock_forwarder):
+        """
+        update_forwarder: the forwarder is given forwarding rules, and its
+        cache is cleared once rules are replaced
+        """
+        # arrange
+        self.bundle.model.db["enableForwarder"] = True
+        self.bundle.update_forwarder()
+
+        # act
+        self.bundle.set_dns_rules([{"domain": "lan", "dns": ["10.0.0.1"]}],
+                                  False)
+
+        # assert
+        rules = mock_forwarder.call_args[1]["rules"]
+        self.assertEqual(rules(), [{"domain": "lan", "dns": ["10.0.0.1"],
+                                    "servers": ["10.0.0.1"]}])
+        mock_forwarder.return_value.cache.clear.assert_called_once_with()
+
+    def test__get_probe_servers(self):
+        """
+        get_probe_servers: all nameservers in database without duplicates
+        """
+        # arrange
+        self.bundle.add_dns_lists([
+            {"source": "eth0", "dns": ["1.1.1.1", "", "8.8.8.8"]},
+            {"source": "wwan0", "dns": ["2.2.2.2", "1.1.1.1"]}], False)
+
+        # act & assert
+        self.assertEqual(self.bundle.get_probe_servers(),
+                         ["1.1.1.1", "8.8.8.8", "2.2.2.2"])
+
+    def test__get_upstream_dns__ordered_by_health(self):
+        """
+        get_upstream_dns: nameservers are ordered by the prober
+        """
+        # arrange
+        self.bundle.model.db["source"] = "eth0"
+        self.bundle.add_dns_list({"source": "eth0",
+                                  "dns": ["1.1.1.1", "2.2.2.2"]}, False)
+        self.bundle.prober = HealthProber(self.bundle.get_probe_servers,
+                                          max_failures=1)
+        self.bundle.prober.record("1.1.1.1", None)
+        self.bundle.prober.record("2.2.2.2", 0.01)
+
+        # act & assert
+        self.assertEqual(self.bundle.get_upstream_dns(), ["2.2.2.2"])
+        self.assertEqual(self.bundle._generate_config(),
+                         "nameserver 2.2.2.2\n")
+
+    def test__get_upstream_dns__fixed(self):
+        """
+        get_upstream_dns: fixed DNS is never dropped by the prober
+        """
+        # arrange
+        self.bundle.set_current_dns({"enableFixed": True,
+                                     "fixedDns": ["1.1.1.1", "2.2.2.2"]})
+        self.bundle.prober = HealthProber(self.bundle.get_probe_servers,
+                                          max_failures=1)
+        self.bundle.prober.record("1.1.1.1", None)
+        self.bundle.prober.record("2.2.2.2", 0.01)
+
+        # act & assert
+        self.assertEqual(self.bundle.get_upstream_dns(),
+                         ["1.1.1.1", "2.2.2.2"])
+
+    def test__get_dns_health(self):
+        """
+        get_dns_health: statistics of nameservers
+        """
+        # arrange
+        message = Message({"data": {}})
+        mock_func = Mock(code=200, data=None)
+
+        # act & assert
+        self.bundle._get_dns_health(message=message, response=mock_func,
+                                    test=True)
+        self.assertEqual(mock_func.call_args[1]["data"],
+                         {"enable": False, "servers": []})
+
+        self.bundle.prober = HealthProber(self.bundle.get_probe_servers)
+        self.bundle.prober.record("1.1.1.1", 0.02)
+        self.bundle._get_dns_health(message=message, response=mock_func,
+                                    test=True)
+        data = mock_func.call_args[1]["data"]
+        self.assertTrue(data["enable"])
+        self.assertEqual(data["servers"][0]["server"], "1.1.1.1")
+        self.assertEqual(data["servers"][0]["latency"], 20.0)
+        self.assertTrue(data["servers"][0]["healthy"])
+
+    def test__get_metrics(self):
+        """
+        _get_metrics: count requests, validation failures and DNS file
+        writes
+        """
+        # arrange
+        mock_func = Mock(code=200, data=None)
+        self.bundle._put_current_dns(
+            Message({"data": {"fixedDns": ["1.1.1.1"], "enableFixed": 1}}),
+            mock_func, test=True)
+        self.bundle._put_current_dns(
+            Message({"data": {"enableFixed": True, "fixedDns": ["1.1.1.1"]}}),
+            mock_func, test=True)
+        self.bundle._get_current_dns(Message({"data": {}}), mock_func,
+                                     test=True)
+
+        # act
+        self.bundle._get_metrics(Message({"data": {}}), mock_func,
+                                 test=True)
+
+        # assert
+        data = mock_func.call_args[1]["data"]
+        self.assertEqual(data["counters"]["validation_failures"],
+                         {"put /network/dns": 1})
+        self.assertEqual(data["counters"]["route_failures"],
+                         {"put /network/dns": 1})
+        self.assertEqual(data["counters"]["config_writes"], 1)
+        self.assertEqual(data["histograms"]["update_config"]["count"], 1)
+        routes = data["histograms"]["route"]
+        self.assertEqual(routes["put /network/dns"]["count"], 2)
+        self.assertEqual(routes["get /network/dns"]["count"], 1)
+        self.assertEqual(sorted(data["startup"].keys()),
+                         ["init", "model", "publish", "restore"])
+
+    @patch("prober.HealthProber")
+    def test__metrics__prometheus_dump(self, mock_prober):
+        """
+        METRICS_PATH: dump metrics in Prometheus text format
+        """
+        # arrange
+        path = self.tmpdir + "/dns.prom"
+        with patch.object(Dns, "METRICS_PATH", path):
+            # act
+            self.bundle.run()
+            self.bundle.stop()
+
+        # assert
+        with open(path) as f:
+            content = f.read()
+        self.assertIn("dns_config_writes_total 1\n", content)
+        self.assertIn("# TYPE dns_update_config_seconds histogram", content)
+
+    @patch.object(Dns, "WATCH_MIN_BACKOFF", 0.1)
+    def test__start_watcher(self):
+        """
+        start_watcher: restore DNS file replaced by others with a single
+        write
+        """
+        # arrange
+        self.bundle.set_current_dns({"enableFixed": True,
+                                     "fixedDns": ["1.1.1.1"]})
+        with open(Dns.CONFIG_PATH) as f:
+            content = f.read()
+        self.bundle.start_watcher()
+        writes = self.bundle.config_stats["written"]
+
+        # act
+        with open(self.tmpdir + "/resolv.conf.dhclient", "w") as f:
+            f.write("nameserver 10.0.0.1\n")
+        os.rename(self.tmpdir + "/resolv.conf.dhclient", Dns.CONFIG_PATH)
+        deadline = time() + 3
+        while self.bundle.watcher.stats["restores"] == 0 \
+                and time() < deadline:
+            sleep(0.02)
+
+        # assert
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.bundle.config_stats["written"], writes + 1)
+        self.assertEqual(
+            self.bundle.metrics.snapshot()["counters"]["config_restores"], 1)
+
+    def test__start_watcher__disabled(self):
+        """
+        WATCH_INTERVAL: DNS file is not watched if the interval is 0
+        """
+        # act
+        with patch.object(Dns, "WATCH_INTERVAL", 0):
+            self.bundle.start_watcher()
+
+        # assert
+        self.assertIsNone(self.bundle.watcher)
+
+    def test__get_current_dns(self):
+        """
+        get_current_dns
+        """
+        # arrange
+        self.bundle.model.db = {
+            "source": "eth0",
+            "dns": ["1.1.1.1", "2.2.2.2"]
+        }
+
+        # act
+        data = self.bundle.get_current_dns()
+
+        # assert
+        self.assertEqual(
+            data,
+            {"enableFixed": False,
+             "source": "eth0",
+             "dns": ["1.1.1.1", "2.2.2.2"]})
+
+    def test__get_current_dns__snapshot(self):
+        """
+        get_current_dns: share a read-only view until data modified
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+
+        # act
+        data = self.bundle.get_current_dns()
+        revision = self.bundle.view_revision
+
+        # assert
+        self.assertIs(self.bundle.get_current_dns(), data)
+        self.assertEqual(self.bundle.view_revision, revision)
+        with self.assertRaises(TypeError):
+            data["source"] = "eth1"
+        with self.assertRaises(TypeError):
+            data["dns"].append("2.2.2.2")
+
+        mutable = copy.deepcopy(data)
+        mutable["dns"].append("2.2.2.2")
+        self.assertEqual(data["dns"], ["1.1.1.1"])
+
+    @patch.object(Dns, "update_config")
+    def test__get_current_dns__rebuild(self, mock_update_config):
+        """
+        get_current_dns: rebuild the view if settings or database modified
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        data = self.bundle.get_current_dns()
+
+        # act & assert
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["2.2.2.2"]},
+                                 False)
+        self.assertEqual(self.bundle.get_current_dns()["dns"], ["2.2.2.2"])
+        self.assertEqual(data["dns"], ["1.1.1.1"])
+
+        self.bundle.set_current_dns({"enableFixed": True,
+                                     "fixedDns": ["8.8.8.8"]})
+        data = self.bundle.get_current_dns()
+        self.assertEqual(data["source"], "fixed")
+        self.assertEqual(data["dns"], ["8.8.8.8"])
+
+    def test__publish__lazy_views(self):
+        """
+        _publish: commands build only current DNS, the database view is
+        built once read, by the writer thread if a command is running
+        """
+        # arrange
+        self.bundle.add_dns_lists([{"source": "eth%d" % i,
+                                    "dns": ["10.0.%d.1" % (i % 256)]}
+                                   for i in range(1000)], False)
+        self.bundle.get_dns_database_view()
+        revision = self.bundle.view_revision
+
+        # act
+        for i in range(100):
+            self.bundle.writer.call(self.bundle.add_dns_list,
+                                    {"source": "eth0",
+                                     "dns": ["10.1.0.%d" % i]}, False)
+
+        # assert
+        self.assertEqual(self.bundle.view_revision - revision, 100)
+        self.assertNotIn("database", self.bundle._published)
+
+        started = Event()
+        release = Event()
+        self.addCleanup(release.set)
+
+        def blocked():
+            started.set()
+            release.wait()
+            self.bundle.add_dns_list({"source": "eth1", "dns": ["9.9.9.9"]},
+                                     False)
+
+        writer = Thread(target=self.bundle.writer.call, args=(blocked,))
+        writer.start()
+        started.wait()
+        views = []
+        reader = Thread(target=lambda: views.append(
+            self.bundle.get_dns_database_view()))
+        reader.start()
+        reader.join(0.1)
+        self.assertEqual(views, [])
+        release.set()
+        writer.join()
+        reader.join()
+        self.assertEqual(views[0][1], {"source": "eth0", "dns": ["10.1.0.99"]})
+        self.assertEqual(views[0][2], {"source": "eth1", "dns": ["9.9.9.9"]})
+        self.assertIs(self.bundle._published["database"], views[0])
+
+    @patch.object(Dns, "update_config")
+    def test__set_current_dns__by_fixed(self, mock_update_config):
+        """
+        set_current_dns: set by fixed
+        """
+        # arrange
+        dns = {"source": "eth0",
+               "dns": ["8.8.8.8", "8.8.4.4"]}
+        self.bundle.dns_db[dns["source"]] = dns
+
+        dns = {"source": "eth1",
+               "dns": ["1.1.1.1", "2.2.2.2"]}
+        self.bundle.dns_db[dns["source"]] = dns
+
+        data = {"enableFixed": True, "fixedDns": ["3.3.3.3", "4.4.4.4"]}
+
+        # act
+        self.bundle.set_current_dns(data)
+
+        # assert
+        mock_update_config.assert_called_once_with()
+
+    @patch.object(Dns, "update_config")
+    def test__set_current_dns__by_source(self, mock_update_config):
+        """
+        set_current_dns: set by source
+        """
+        # arrange
+        dns = {"source": "eth0",
+               "dns": ["8.8.8.8", "8.8.4.4"]}
+        self.bundle.dns_db[dns["source"]] = dns
+
+        dns = {"source": "eth1",
+               "dns": ["1.1.1.1", "2.2.2.2"]}
+        self.bundle.dns_db[dns["source"]] = dns
+
+        data = {"source": "eth0"}
 
         # act
         self.bundle.set_current_dns(data)
@@ -443,11 +1857,11 @@ class TestDnsClass(unittest.TestCase):
         # arrange
         dns1 = {"source": "eth0", "dns": ["1.1.1.1", "2.2.2.2", "3.3.3.3"]}
         dns2 = {"source": "eth1", "dns": ["2.2.2.2", "3.3.3.3"]}
-        self.bundle.dns_db.append(dns1)
-        self.bundle.dns_db.append(dns2)
+        self.bundle.dns_db[dns1["source"]] = dns1
+        self.bundle.dns_db[dns2["source"]] = dns2
 
         dns = [
-            self.bundle.dns_db[0],
+            self.bundle.get_dns_database()[0],
             {"source": "eth0", "dns": ["8.8.8.8", "8.8.4.4"]},
             {"source": "eth1", "dns": ["1.1.1.1", "2.2.2.2"]}
         ]
@@ -461,6 +1875,1115 @@ class TestDnsClass(unittest.TestCase):
         self.assertEqual(len(mock_func.call_args_list[0][1]["data"]), 3)
         self.assertEqual(mock_func.call_args_list[0][1]["data"], dns)
 
+    @patch.object(Dns, "update_config")
+    def test__set_dns_database__batch_update_once(self, mock_update_config):
+        """
+        set_dns_database: update DNS file once for a batch
+        """
+        # arrange
+        dns = [{"source": "eth0", "dns": ["8.8.8.8"]},
+               {"source": "eth1", "dns": ["1.1.1.1"]},
+               {"source": "eth0", "dns": ["8.8.4.4"]}]
+        message = Message({"data": dns})
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle.set_dns_database(message=message, response=mock_func)
+
+        # assert
+        mock_update_config.assert_called_once_with()
+        self.assertEqual(self.bundle.get_dns_list("eth0")["dns"],
+                         ["8.8.4.4"])
+
+    @patch.object(Dns, "update_config")
+    def test__set_dns_database__invalid(self, mock_update_config):
+        """
+        set_dns_database: reject the whole batch if any entry is invalid
+        """
+        # arrange
+        dns = [{"source": "eth0", "dns": ["8.8.8.8"]},
+               {"source": "eth1", "dns": "1.1.1.1"}]
+        message = Message({"data": dns})
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle.set_dns_database(message=message, response=mock_func)
+
+        # assert
+        self.assertEqual(mock_func.call_args_list[0][1]["code"], 400)
+        self.assertEqual(len(self.bundle.dns_db), 1)
+        self.assertEqual(mock_update_config.call_count, 0)
+
+    def test__set_dns_database__wrong_type(self):
+        """
+        set_dns_database: neither a list nor a dictionary
+        """
+        # arrange
+        message = Message({"data": "eth0"})
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle.set_dns_database(message=message, response=mock_func)
+
+        # assert
+        self.assertEqual(mock_func.call_args_list[0][1]["code"], 400)
+
+    @patch.object(Dns, "update_config")
+    def test__set_dns_database__rollback(self, mock_update_config):
+        """
+        set_dns_database: restore the database if failed to update
+        """
+        # arrange
+        mock_update_config.side_effect = IOError("Write error!")
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]},
+                                 False)
+        dns = [{"source": "eth1", "dns": ["2.2.2.2"]},
+               {"source": "eth0", "dns": ["8.8.8.8"]},
+               {"source": "eth0", "dns": ["8.8.4.4"]}]
+        message = Message({"data": dns})
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle.set_dns_database(message=message, response=mock_func)
+
+        # assert
+        self.assertEqual(mock_func.call_args_list[0][1]["code"], 400)
+        self.assertEqual(
+            self.bundle.get_dns_database(),
+            [{"source": "fixed", "dns": []},
+             {"source": "eth0", "dns": ["1.1.1.1"]}])
+
+    @patch.object(Dns, "_write_config")
+    def test__set_dns_database__throughput(self, mock_write_config):
+        """
+        set_dns_database: throughput of a large batch
+        """
+        # arrange
+        count = 2000
+        dns = [{"source": "vlan%d" % i,
+                "dns": ["10.%d.%d.1" % (i // 256, i % 256)]}
+               for i in range(count)]
+        dns.append({"source": "eth0", "dns": ["8.8.8.8"]})
+        message = Message({"data": dns})
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        start = time()
+        self.bundle.set_dns_database(message=message, response=mock_func)
+        elapsed = time() - start
+
+        # assert
+        rate = len(dns) / elapsed
+        self.assertEqual(len(self.bundle.dns_db), count + 2)
+        self.assertEqual(mock_write_config.call_count, 1)
+        self.assertGreater(rate, 1000,
+                           "%d entries/sec for a batch of %d"
+                           % (rate, len(dns)))
+
+    def test__get_dns_database__since(self):
+        """
+        _get_dns_database: get changes since a revision
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["1.1.1.1"]})
+        self.bundle.add_dns_list({"source": "eth1", "dns": ["2.2.2.2"]})
+        self.bundle.add_dns_list({"source": "eth2", "dns": ["3.3.3.3"]})
+        revision = self.bundle.dns_db.revision
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["8.8.8.8"]})
+        self.bundle.remove_dns_list("eth1")
+
+        message = Message({"data": None})
+        message.query = {"since": str(revision),
+                         "epoch": self.bundle.dns_db.epoch}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._get_dns_database(message, mock_func, test=True)
+
+        # assert
+        self.assertEqual(
+            mock_func.call_args_list[0][1]["data"],
+            {"epoch": self.bundle.dns_db.epoch,
+             "revision": revision + 2, "reset": False,
+             "dns": [{"source": "eth0", "dns": ["8.8.8.8"]}],
+             "removed": ["eth1"]})
+
+    def test__get_dns_database__since_unknown(self):
+        """
+        _get_dns_database: get all if changes since a revision are unknown
+        """
+        # arrange
+        message = Message({"data": None})
+        message.query = {"since": str(self.bundle.dns_db.revision + 10),
+                         "epoch": self.bundle.dns_db.epoch}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._get_dns_database(message, mock_func, test=True)
+
+        # assert
+        data = mock_func.call_args_list[0][1]["data"]
+        self.assertTrue(data["reset"])
+        self.assertEqual(data["dns"], self.bundle.get_dns_database())
+
+        message.query = {"since": "abc"}
+        self.bundle._get_dns_database(message, mock_func, test=True)
+        self.assertEqual(mock_func.call_args_list[1][1]["code"], 400)
+
+    def test__get_dns_database__since_restart(self):
+        """
+        _get_dns_database: get all if the bundle was restarted, even if the
+        revision is reached again
+        """
+        # arrange
+        for i in range(4):
+            self.bundle.add_dns_list({"source": "eth%d" % i,
+                                      "dns": ["10.0.0.%d" % i]})
+        synced = self.bundle.get_dns_database_changes(0)
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+        self.bundle.remove_dns_list("eth3")
+        for i in range(synced["revision"]):
+            self.bundle.add_dns_list({"source": "eth0",
+                                      "dns": ["10.1.0.%d" % i]})
+        self.assertGreater(self.bundle.dns_db.revision, synced["revision"])
+
+        # act
+        changes = self.bundle.get_dns_database_changes(synced["revision"],
+                                                       synced["epoch"])
+        without_epoch = self.bundle.get_dns_database_changes(
+            synced["revision"])
+
+        # assert
+        self.assertTrue(changes["reset"])
+        self.assertNotEqual(changes["epoch"], synced["epoch"])
+        self.assertEqual(changes["dns"], self.bundle.get_dns_database())
+        self.assertNotIn("eth3", [entry["source"]
+                                  for entry in changes["dns"]])
+        self.assertTrue(without_epoch["reset"])
+
+    def test__dns_database__changes_horizon(self):
+        """
+        DnsDatabase: changes are unknown before forgotten removals
+        """
+        # arrange
+        db = DnsDatabase(max_removed=2)
+        for source in ["eth0", "eth1", "eth2", "eth3"]:
+            db[source] = {"source": source, "dns": []}
+
+        # act
+        for source in ["eth0", "eth1", "eth2"]:
+            del db[source]
+
+        # assert
+        self.assertIsNone(db.changes(0, db.epoch))
+        self.assertEqual(db.changes(db.horizon, db.epoch),
+                         ([], ["eth1", "eth2"]))
+        self.assertEqual(db.changes(db.revision, db.epoch), ([], []))
+        self.assertIsNone(db.changes(db.revision, DnsDatabase().epoch))
+
+    def test__priority_index(self):
+        """
+        PriorityIndex: order by priority then by the order added
+        """
+        # arrange
+        index = PriorityIndex(default=100)
+
+        # act
+        index.update("eth0", {})
+        index.update("wwan0", {"priority": 200})
+        index.update("eth1", {"priority": 10})
+        index.update("eth2", {})
+        index.update("eth0", {"priority": 300})
+        index.remove("eth2")
+        index.remove("unknown")
+
+        # assert
+        self.assertEqual(list(index), ["eth1", "wwan0", "eth0"])
+        self.assertEqual(len(index), 3)
+
+    def test__dns_database__index(self):
+        """
+        DnsDatabase: the priority index follows modifications
+        """
+        # arrange
+        db = DnsDatabase()
+        db["eth0"] = {"source": "eth0", "dns": []}
+        db["eth1"] = {"source": "eth1", "dns": []}
+
+        # act
+        db["eth1"]["priority"] = 1
+        db.touch("eth1")
+        db.pop("eth0")
+
+        # assert
+        self.assertEqual(list(db.index), ["eth1"])
+        db.clear()
+        self.assertEqual(list(db.index), [])
+
+    def test__merge_dns_lists(self):
+        """
+        merge_dns_lists: deduplicated union by priority with caps
+        """
+        # arrange
+        self.bundle.model.db.update({"enableMerge": True,
+                                     "mergeMaxDns": 4})
+        self.bundle.add_dns_lists([
+            {"source": "wwan0", "dns": ["8.8.8.8", "9.9.9.9"],
+             "priority": 200, "options": {"timeout": 5}},
+            {"source": "eth0", "dns": ["1.1.1.1", "", "8.8.8.8", "2.2.2.2",
+                                       "3.3.3.3"],
+             "priority": 10, "search": ["lan"]},
+            {"source": "eth1", "dns": ["4.4.4.4"], "priority": 300}], False)
+
+        # act
+        merged = self.bundle.merge_dns_lists()
+
+        # assert
+        self.assertEqual(merged, {
+            "dns": ["1.1.1.1", "8.8.8.8", "9.9.9.9", "4.4.4.4"],
+            "sources": ["eth0", "wwan0", "eth1"],
+            "search": ["lan"],
+            "options": {"timeout": 5}})
+
+        self.bundle.model.db["mergeMaxPerSource"] = 1
+        self.assertEqual(self.bundle.merge_dns_lists()["dns"],
+                         ["1.1.1.1", "8.8.8.8", "4.4.4.4"])
+
+    def test__merge_dns_lists__scale(self):
+        """
+        merge_dns_lists: sources after the list is full are not walked, so
+        the cost does not grow with the number of sources
+        """
+        # arrange
+        self.bundle.model.db.update({"enableMerge": True,
+                                     "mergeMaxDns": 3})
+
+        def elapsed(size):
+            self.bundle.dns_db.clear()
+            self.bundle.add_dns_lists([{"source": "eth%d" % i,
+                                        "dns": ["10.0.%d.1" % (i % 256)]}
+                                       for i in range(size)], False)
+            results = []
+            for _ in range(3):
+                start = time()
+                for _ in range(100):
+                    self.bundle.merge_dns_lists()
+                results.append(time() - start)
+            return min(results)
+
+        # act
+        small = elapsed(10)
+        large = elapsed(20000)
+
+        # assert
+        self.assertLess(large, small * 5, "%.1f us with 10 sources, %.1f us "
+                        "with 20000 sources" % (small * 1e4, large * 1e4))
+
+    def test__merge_dns_lists__failover(self):
+        """
+        merge_dns_lists: fall over to the next source once a source has
+        no nameservers, without a WAN event
+        """
+        # arrange
+        self.bundle.model.db.update({"enableMerge": True,
+                                     "source": "eth0"})
+        self.bundle.add_dns_lists([
+            {"source": "eth0", "dns": ["1.1.1.1"], "priority": 1},
+            {"source": "wwan0", "dns": ["8.8.8.8"], "priority": 2}], False)
+        self.assertTrue(self.bundle.is_current_source("wwan0"))
+        self.assertEqual(self.bundle.get_current_dns()["dns"],
+                         ["1.1.1.1", "8.8.8.8"])
+
+        # act
+        self.bundle.add_dns_list({"source": "eth0", "dns": []}, False)
+
+        # assert
+        data = self.bundle.get_current_dns()
+        self.assertEqual(data["dns"], ["8.8.8.8"])
+        self.assertEqual(data["sources"], ["wwan0"])
+        self.assertNotIn("source", data)
+        self.assertEqual(self.bundle._generate_config(),
+                         "nameserver 8.8.8.8\n")
+
+        self.bundle.model.db["enableFixed"] = True
+        self.assertFalse(self.bundle.is_merged())
+        self.assertFalse(self.bundle.is_current_source("wwan0"))
+
+    def test__apply_dns_patch(self):
+        """
+        apply_dns_patch
+        """
+        dns = ["8.8.8.8", "8.8.4.4"]
+        self.assertEqual(
+            apply_dns_patch(dns, [
+                {"op": "test", "path": "/dns/0", "value": "8.8.8.8"},
+                {"op": "remove", "path": "/dns/0"},
+                {"op": "add", "path": "/dns/-", "value": "1.1.1.1"},
+                {"op": "add", "path": "/dns/0", "value": "2.2.2.2"},
+                {"op": "replace", "path": "/dns/1", "value": "3.3.3.3"}]),
+            ["2.2.2.2", "3.3.3.3", "1.1.1.1"])
+        self.assertEqual(dns, ["8.8.8.8", "8.8.4.4"])
+
+        for operations in [
+                [{"op": "remove", "path": "/dns/2"}],
+                [{"op": "add", "path": "/dns/3", "value": "1.1.1.1"}],
+                [{"op": "add", "path": "/dns/-"}],
+                [{"op": "test", "path": "/dns/1", "value": "8.8.8.8"}]]:
+            with self.assertRaises(ValueError):
+                apply_dns_patch(dns, operations)
+
+    @patch.object(Dns, "update_config")
+    def test__patch_dns_list(self, mock_update_config):
+        """
+        _patch_dns_list: patch DNS list of a source
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0",
+                                  "dns": ["8.8.8.8", "8.8.4.4"]}, False)
+        message = Message({"data": [
+            {"op": "remove", "path": "/dns/1"},
+            {"op": "add", "path": "/dns/0", "value": "1.1.1.1"}]})
+        message.param = {"source": "eth0"}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._patch_dns_list(message, mock_func, test=True)
+
+        # assert
+        self.assertEqual(mock_func.call_args_list[0][1]["data"],
+                         {"source": "eth0", "dns": ["1.1.1.1", "8.8.8.8"]})
+        mock_update_config.assert_called_once_with()
+
+    def test__patch_dns_list__failed(self):
+        """
+        _patch_dns_list: nothing changed if any operation failed
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth1", "dns": ["8.8.8.8"]})
+        message = Message({"data": [
+            {"op": "add", "path": "/dns/-", "value": "1.1.1.1"},
+            {"op": "remove", "path": "/dns/5"}]})
+        message.param = {"source": "eth1"}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._patch_dns_list(message, mock_func, test=True)
+
+        # assert
+        self.assertEqual(mock_func.call_args_list[0][1]["code"], 400)
+        self.assertEqual(self.bundle.get_dns_list("eth1")["dns"],
+                         ["8.8.8.8"])
+
+    def replay(self, storm):
+        """
+        Replay recorded events with their delays (ms).
+
+        Returns:
+            (timestamps of DNS file writes, number of saves, time of the
+            last event)
+        """
+        writes = []
+        write_config = self.bundle._write_config
+
+        def _write_config(resolv):
+            write_config(resolv)
+            writes.append(time())
+
+        self.bundle._write_config = _write_config
+        with patch.object(self.bundle, "save", wraps=self.bundle.save) \
+                as mock_save:
+            for event in storm:
+                sleep(event["delay"] / 1000.0)
+                message = Message({"resource": event["resource"],
+                                   "method": "put", "data": event["data"]})
+                if event["resource"] == "/network/wan":
+                    self.bundle._event_network_wan(message, test=True)
+                else:
+                    message.param = {"name": event["data"]["name"]}
+                    self.bundle._event_network_interface(message, test=True)
+            last_event = time()
+            deadline = last_event + 5
+            while self.bundle.update_scheduler.pending() \
+                    and time() < deadline:
+                sleep(0.01)
+            sleep(0.05)
+        return writes, mock_save.call_count, last_event
+
+    def test__event_storm__coalesced(self):
+        """
+        events: a storm of interface events results in a single write
+        """
+        # arrange
+        with open("%s/data/event_storm.json" % dirpath) as f:
+            storm = json.load(f)
+        self.bundle.update_scheduler.quiet_window = 0.1
+        self.bundle.update_scheduler.max_delay = 5
+
+        # act
+        writes, saves, last_event = self.replay(storm)
+
+        # assert
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(saves, 1)
+        self.assertLess(writes[0] - last_event, 0.1 + 0.5)
+        self.assertEqual(self.bundle.model.db["source"], "eth0")
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(
+                f.read(), "nameserver 192.168.31.1\nnameserver 8.8.8.8\n")
+
+    def test__event_storm__max_delay(self):
+        """
+        events: a continuous storm is flushed at least every max delay
+        """
+        # arrange
+        storm = [{"delay": 10, "resource": "/network/interfaces/eth0",
+                  "data": {"name": "eth0", "dns": ["10.0.0.%d" % i]}}
+                 for i in range(60)]
+        self.bundle.update_scheduler.quiet_window = 0.1
+        self.bundle.update_scheduler.max_delay = 0.2
+
+        # act
+        writes, saves, last_event = self.replay(storm)
+
+        # assert
+        self.assertGreater(len(writes), 1)
+        self.assertLess(len(writes), len(storm))
+        self.assertEqual(saves, 0)
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(f.read(), "nameserver 10.0.0.59\n")
+
+    def test__event_network_wan__scheduled(self):
+        """
+        _event_network_wan: settings are saved and applied later
+        """
+        # arrange
+        self.bundle.update_scheduler.quiet_window = 10
+        self.bundle.add_dns_list({"source": "eth1", "dns": ["1.1.1.1"]})
+        message = Message({"data": {"interface": "eth1"}})
+
+        with patch.object(Dns, "save") as mock_save, \
+                patch.object(Dns, "update_config") as mock_update_config:
+            # act
+            self.bundle._event_network_wan(message, test=True)
+
+            # assert
+            self.assertEqual(self.bundle.model.db["source"], "eth1")
+            self.assertEqual(mock_update_config.call_count, 0)
+            self.assertTrue(self.bundle.update_scheduler.pending())
+
+            self.bundle.update_scheduler.stop()
+            mock_save.assert_called_once_with()
+            mock_update_config.assert_called_once_with()
+
+    def test__event_network_interface__search_and_options(self):
+        """
+        _event_network_interface: keep search domains and options, and
+        drop them once not given
+        """
+        # arrange
+        message = Message({"data": {"name": "eth0", "dns": ["1.1.1.1"],
+                                    "search": ["lan"],
+                                    "options": {"timeout": 1}}})
+        message.param = {"name": "eth0"}
+
+        # act
+        self.bundle._event_network_interface(message, test=True)
+        entry = dict(self.bundle.get_dns_list("eth0"))
+        message.data = {"name": "eth0", "dns": ["1.1.1.1"]}
+        self.bundle._event_network_interface(message, test=True)
+
+        # assert
+        self.assertEqual(entry["search"], ["lan"])
+        self.assertEqual(entry["options"], {"timeout": 1})
+        self.assertEqual(self.bundle.get_dns_list("eth0"),
+                         {"source": "eth0", "dns": ["1.1.1.1"]})
+
+    def test__expiry_scheduler(self):
+        """
+        ExpiryScheduler: expire keys at their latest deadlines
+        """
+        # arrange
+        expired = []
+        done = Event()
+
+        def callback(keys):
+            expired.append(sorted(keys))
+            if len(expired) == 2:
+                done.set()
+
+        scheduler = ExpiryScheduler(callback)
+        self.addCleanup(scheduler.stop)
+        now = time()
+
+        # act
+        scheduler.schedule("eth0", now + 0.05)
+        scheduler.schedule("eth1", now + 0.05)
+        scheduler.schedule("eth2", now + 0.05)
+        scheduler.schedule("eth1", now + 0.2)
+        scheduler.cancel("eth2")
+        for i in range(100):
+            scheduler.schedule("wwan0", now + 60 + i)
+
+        # assert
+        self.assertEqual(scheduler.deadline("eth1"), now + 0.2)
+        self.assertEqual(len(scheduler), 3)
+        self.assertLessEqual(len(scheduler._heap), 2 * 3 + 16 + 1)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(expired, [["eth0"], ["eth1"]])
+        self.assertEqual(scheduler.deadline("wwan0"), now + 159)
+
+    @patch.object(Dns, "schedule_update")
+    def test__expire_dns_lists(self, mock_schedule_update):
+        """
+        _expire_dns_lists: remove DNS lists not renewed within the lease,
+        and update DNS file once
+        """
+        # arrange
+        self.bundle.set_current_dns({"enableMerge": True}, False)
+        mock_schedule_update.reset_mock()
+        with patch("dns.time", return_value=1000.0):
+            self.bundle.add_dns_list(
+                {"source": "eth0", "dns": ["1.1.1.1"], "lease": 60}, False)
+            self.bundle.add_dns_list(
+                {"source": "eth1", "dns": ["2.2.2.2"], "lease": 60}, False)
+            self.bundle.add_dns_list(
+                {"source": "eth2", "dns": ["3.3.3.3"]}, False)
+        with patch("dns.time", return_value=1030.0):
+            self.bundle.add_dns_list(
+                {"source": "eth1", "dns": ["2.2.2.2"], "lease": 60}, False)
+
+        # act
+        with patch("dns.time", return_value=1060.0):
+            self.bundle.writer.call(self.bundle._expire_dns_lists,
+                                    ["eth0", "eth1", "eth2"])
+
+        # assert
+        self.assertIsNone(self.bundle.get_dns_list("eth0"))
+        self.assertEqual(self.bundle.get_dns_list("eth1"),
+                         {"source": "eth1", "dns": ["2.2.2.2"],
+                          "lease": 60, "lastSeen": 1030.0})
+        self.assertIsNotNone(self.bundle.get_dns_list("eth2"))
+        self.assertEqual(self.bundle.expiry.deadline("eth1"), 1090.0)
+        self.assertIsNone(self.bundle.expiry.deadline("eth2"))
+        mock_schedule_update.assert_called_once_with()
+        self.assertEqual(self.bundle.metrics.snapshot()["counters"]
+                         ["expired"], 1)
+
+    def test__event_network_interface__lease(self):
+        """
+        _event_network_interface: DNS list is removed once the lease is
+        expired, and DNS file is updated
+        """
+        # arrange
+        self.bundle.set_current_dns({"source": "eth0"})
+        message = Message({"data": {"name": "eth0", "dns": ["1.1.1.1"],
+                                    "lease": 1}})
+        message.param = {"name": "eth0"}
+
+        # act
+        with patch.object(Dns, "INTERFACE_LEASE", 3600):
+            self.bundle._event_network_interface(message, test=True)
+        deadline = time() + 3
+        while self.bundle.get_dns_list("eth0") is not None \
+                and time() < deadline:
+            sleep(0.05)
+        self.bundle.update_scheduler.flush()
+
+        # assert
+        self.assertIsNone(self.bundle.get_dns_list("eth0"))
+        self.assertNotIn("dns", self.bundle.get_current_dns())
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertNotIn("1.1.1.1", f.read())
+
+    def test__event_network_interface__default_lease(self):
+        """
+        INTERFACE_LEASE: lease of DNS lists by interface events without one
+        """
+        # arrange
+        message = Message({"data": {"name": "eth0", "dns": ["1.1.1.1"]}})
+        message.param = {"name": "eth0"}
+
+        # act
+        with patch.object(Dns, "INTERFACE_LEASE", 3600):
+            self.bundle._event_network_interface(message, test=True)
+
+        # assert
+        entry = self.bundle.get_dns_list("eth0")
+        self.assertEqual(entry["lease"], 3600)
+        self.assertEqual(self.bundle.expiry.deadline("eth0"),
+                         entry["lastSeen"] + 3600)
+
+    def test__load__lease_expired(self):
+        """
+        load: remove DNS lists whose lease expired while stopped
+        """
+        # arrange
+        with patch("dns.time", return_value=time() - 120):
+            self.bundle.add_dns_list(
+                {"source": "eth0", "dns": ["1.1.1.1"], "lease": 60})
+        self.bundle.add_dns_list(
+            {"source": "eth1", "dns": ["2.2.2.2"], "lease": 60})
+        self.bundle.stop()
+
+        # act
+        self.bundle = Dns(connection=Mockup())
+
+        # assert
+        self.assertIsNone(self.bundle.get_dns_list("eth0"))
+        self.assertIsNotNone(self.bundle.expiry.deadline("eth1"))
+        self.assertEqual(self.bundle.journal.records, 1)
+
+    def test__event_network_interface__ipv6(self):
+        """
+        _event_network_interface: keep normalized IPv6 nameservers
+        """
+        # arrange
+        message = Message({"data": {"name": "eth0",
+                                    "dns": ["2001:DB8::0:53", "1.1.1.1"]}})
+        message.param = {"name": "eth0"}
+
+        # act
+        self.bundle._event_network_interface(message, test=True)
+
+        # assert
+        self.assertEqual(self.bundle.get_dns_list("eth0")["dns"],
+                         ["2001:db8::53", "1.1.1.1"])
+
+    def test__change_publisher(self):
+        """
+        ChangePublisher: publish the latest changed state at most once per
+        interval, with increasing revisions
+        """
+        # arrange
+        published = []
+        publisher = ChangePublisher(
+            lambda state, revision: published.append((revision, state)),
+            interval=0.1)
+        self.addCleanup(publisher.stop)
+
+        # act
+        publisher.notify({"dns": []})
+        publisher.start()
+        start = time()
+        for i in range(1000):
+            publisher.notify({"dns": ["10.0.0.%d" % (i % 10)]})
+            publisher.notify({"dns": ["10.0.0.%d" % (i % 10)]})
+        publisher.notify({"dns": ["1.1.1.1"]})
+        duration = time() - start
+        deadline = time() + 2
+        while (not published or published[-1][1] != {"dns": ["1.1.1.1"]}) \
+                and time() < deadline:
+            sleep(0.01)
+        publisher.notify({"dns": ["1.1.1.1"]})
+        sleep(0.2)
+
+        # assert
+        self.assertEqual(published[-1], (1002, {"dns": ["1.1.1.1"]}))
+        self.assertLessEqual(len(published), duration / 0.1 + 2)
+        revisions = [revision for revision, _ in published]
+        self.assertEqual(revisions, sorted(set(revisions)))
+        self.assertEqual(publisher.stats["duplicates"], 1001)
+        self.assertEqual(publisher.stats["published"], len(published))
+        self.assertNotEqual(publisher.epoch,
+                            ChangePublisher(published.append).epoch)
+
+    def test__publish_event__storm(self):
+        """
+        EVENT_INTERVAL: changes of current DNS are coalesced into events of
+        /network/dns, and unchanged settings publish nothing
+        """
+        # arrange
+        conn = self.bundle._conn
+        conn.set_on_connect(lambda client, userdata, flags, rc: 0)
+        conn.connect()
+        self.bundle.set_current_dns({"enableMerge": True})
+        self.bundle.events.interval = 0.1
+        self.bundle.events.start()
+
+        def events():
+            return [call[1]["payload"]
+                    for call in mock_publish.call_args_list
+                    if call[1]["payload"]["resource"] == "/network/dns"]
+
+        def wait_for(dns):
+            deadline = time() + 3
+            while time() < deadline:
+                if events() and events()[-1]["data"].get("dns") == dns:
+                    return
+                sleep(0.01)
+
+        # act
+        with patch.object(conn, "publish", wraps=conn.publish) \
+                as mock_publish:
+            start = time()
+            for i in range(200):
+                message = Message({"data": {
+                    "name": "eth0", "dns": ["10.0.0.%d" % (i % 20)]}})
+                message.param = {"name": "eth0"}
+                self.bundle._event_network_interface(message, test=True)
+            message = Message({"data": {"name": "eth0",
+                                        "dns": ["1.1.1.1"]}})
+            message.param = {"name": "eth0"}
+            self.bundle._event_network_interface(message, test=True)
+            duration = time() - start
+            wait_for(["1.1.1.1"])
+            count = len(events())
+            self.bundle._event_network_interface(message, test=True)
+            self.bundle.set_current_dns({"enableMerge": True})
+            sleep(0.3)
+
+        # assert
+        payloads = events()
+        self.assertEqual(len(payloads), count)
+        self.assertLessEqual(count, duration / 0.1 + 2)
+        self.assertEqual(payloads[-1]["method"], "put")
+        self.assertEqual(payloads[-1]["data"]["dns"], ["1.1.1.1"])
+        data = dict(payloads[-1]["data"])
+        self.assertEqual(data.pop("revision"), self.bundle.events.revision)
+        self.assertEqual(data.pop("epoch"), self.bundle.events.epoch)
+        self.assertEqual(data, self.bundle.get_current_dns())
+        revisions = [payload["data"]["revision"] for payload in payloads]
+        self.assertEqual(revisions, sorted(set(revisions)))
+        self.assertEqual(
+            self.bundle.metrics.snapshot()["counters"]["events_published"],
+            self.bundle.events.stats["published"])
+
+    @patch("dns._SHARED_SIZE", 8)
+    def test__share(self):
+        """
+        share: equal values are stored once, and values no longer used are
+        not kept forever
+        """
+        # act
+        first = share(u"".join([u"eth", u"0"]))
+        for i in range(100):
+            nameserver(u"10.0.0.%d" % i)
+
+        # assert
+        self.assertIs(share(u"".join([u"eth", u"0"])),
+                      share(u"".join([u"eth", u"0"])))
+        self.assertEqual(share(u"eth0"), first)
+        self.assertIs(share("".join(["eth", "0"])), share("eth0"))
+        self.assertLessEqual(len(sys.modules["dns"]._SHARED), 8)
+
+    def test__dns_context(self):
+        """
+        DnsContext: current DNS and DNS file by its own settings and DNS
+        lists, addresses are shared among contexts
+        """
+        # arrange
+        path = self.tmpdir + "/netns/blue/resolv.conf"
+        context = DnsContext("blue", path)
+        other = DnsContext("red", self.tmpdir + "/netns/red/resolv.conf")
+
+        # act
+        context.add_dns_list({"source": "eth0", "dns": [u"10.0.0.1"],
+                              "search": ["blue.example"], "lease": 60})
+        other.add_dns_list({"source": "eth0", "dns": [u"10.0.0.1"]})
+        written = context.update_config()
+        skipped = context.update_config()
+        context.set_current_dns({"source": "eth0", "enableMerge": False})
+
+        # assert
+        self.assertTrue(written)
+        self.assertFalse(skipped)
+        with open(path) as f:
+            self.assertEqual(f.read(), "search blue.example\n"
+                                       "nameserver 10.0.0.1\n")
+        self.assertNotIn("lease", context.get_dns_list("eth0"))
+        self.assertIs(context.get_dns_list("eth0")["dns"][0],
+                      other.get_dns_list("eth0")["dns"][0])
+        self.assertEqual(context.get_current_dns()["source"], "eth0")
+        self.assertTrue(context.is_current_source("eth0"))
+        self.assertFalse(context.add_dns_list(
+            {"source": "eth0", "dns": ["10.0.0.1"],
+             "search": ["blue.example"]}))
+
+    def test__dns_context__modified_externally(self):
+        """
+        DnsContext: DNS file is rewritten if modified or removed by others
+        """
+        # arrange
+        path = self.tmpdir + "/netns/blue/resolv.conf"
+        context = DnsContext("blue", path)
+        context.add_dns_list({"source": "eth0", "dns": ["10.0.0.1"]})
+        context.update_config()
+
+        # act & assert
+        with open(path, "w") as f:
+            f.write("nameserver 9.9.9.9\nnameserver 8.8.8.8\n")
+        self.assertTrue(context.update_config())
+        with open(path) as f:
+            self.assertEqual(f.read(), "nameserver 10.0.0.1\n")
+        self.assertFalse(context.update_config())
+
+        os.remove(path)
+        self.assertTrue(context.update_config())
+        self.assertTrue(os.path.exists(path))
+
+    def test__is_current_source__fixed(self):
+        """
+        is_current_source: only fixed DNS is current once enabled, for the
+        bundle and DNS contexts alike
+        """
+        # arrange
+        settings = {"source": "eth0", "enableFixed": True,
+                    "fixedDns": ["9.9.9.9"]}
+        context = DnsContext("blue", self.tmpdir + "/netns/blue/resolv.conf",
+                             dict(settings, enableMerge=False))
+        self.bundle.set_current_dns(settings)
+
+        # act & assert
+        for bundle in [self.bundle, context]:
+            self.assertTrue(bundle.is_current_source("fixed"))
+            self.assertFalse(bundle.is_current_source("eth0"))
+
+        self.bundle.set_current_dns({"enableFixed": False})
+        context.set_current_dns({"enableFixed": False})
+        for bundle in [self.bundle, context]:
+            self.assertFalse(bundle.is_current_source("fixed"))
+            self.assertTrue(bundle.is_current_source("eth0"))
+
+    def test__put_context_dns(self):
+        """
+        _put_context_dns: DNS file of the namespace by its own settings,
+        DNS file of the bundle is untouched
+        """
+        # arrange
+        self.bundle.set_current_dns({"enableFixed": True,
+                                     "fixedDns": ["1.1.1.1"]})
+        message = Message({"data": {"enableFixed": True,
+                                    "fixedDns": ["9.9.9.9"]}})
+        message.param = {"name": "blue"}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._put_context_dns(message, mock_func, test=True)
+
+        # assert
+        self.assertEqual(mock_func.call_args[1]["code"], 200)
+        data = mock_func.call_args[1]["data"]
+        self.assertEqual(data["dns"], ["9.9.9.9"])
+        self.assertEqual(data["path"], self.tmpdir + "/netns/blue/resolv.conf")
+        with open(self.tmpdir + "/netns/blue/resolv.conf") as f:
+            self.assertEqual(f.read(), "nameserver 9.9.9.9\n")
+        with open(Dns.CONFIG_PATH) as f:
+            self.assertEqual(f.read(), "nameserver 1.1.1.1\n")
+        self.assertNotIn("namespaces", self.bundle.get_current_dns())
+        self.bundle._get_contexts(Message({"data": {}}), mock_func,
+                                  test=True)
+        self.assertEqual([context["name"] for context
+                          in mock_func.call_args[1]["data"]], ["blue"])
+
+    def test__put_context_dns__invalid(self):
+        """
+        _put_context_dns: invalid namespace names are rejected
+        """
+        # arrange
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        for name in ["..", "../etc", "a/b", ""]:
+            message = Message({"data": {"enableMerge": True}})
+            message.param = {"name": name}
+            self.bundle._put_context_dns(message, mock_func, test=True)
+
+            # assert
+            self.assertEqual(mock_func.call_args[1]["code"], 400)
+        self.assertEqual(self.bundle.contexts, {})
+
+    def test__put_context_dns_lists(self):
+        """
+        _put_context_dns_lists: DNS lists of a namespace are merged by
+        default
+        """
+        # arrange
+        message = Message({"data": [{"source": "eth0", "dns": ["10.0.0.1"]},
+                                    {"source": "eth1", "dns": ["10.0.1.1"]}]})
+        message.param = {"name": "blue"}
+        mock_func = Mock(code=200, data=None)
+
+        # act
+        self.bundle._put_context_dns_lists(message, mock_func, test=True)
+
+        # assert
+        data = mock_func.call_args[1]["data"]
+        self.assertEqual(data["dns"], ["10.0.0.1", "10.0.1.1"])
+        self.assertEqual([entry["source"] for entry in data["db"]],
+                         ["eth0", "eth1"])
+        self.assertIsNone(self.bundle.get_dns_list("eth0"))
+        with open(self.tmpdir + "/netns/blue/resolv.conf") as f:
+            self.assertEqual(f.read(), "nameserver 10.0.0.1\n"
+                                       "nameserver 10.0.1.1\n")
+
+    def test__delete_context(self):
+        """
+        _delete_context: remove the namespace, unknown ones are not found
+        """
+        # arrange
+        self.bundle.set_context_dns("blue", {})
+        mock_func = Mock(code=200, data=None)
+        message = Message({})
+        message.param = {"name": "blue"}
+
+        # act
+        self.bundle._delete_context(message, mock_func, test=True)
+        code = mock_func.call_args[1].get("code", 200)
+        self.bundle._delete_context(message, mock_func, test=True)
+
+        # assert
+        self.assertEqual(code, 200)
+        self.assertEqual(mock_func.call_args[1]["code"], 404)
+        self.assertNotIn("blue", self.bundle.model.db.get("namespaces", {}))
+        self.bundle._get_context_dns(message, mock_func, test=True)
+        self.assertEqual(mock_func.call_args[1]["code"], 404)
+
+    def test__event_network_interface__netns(self):
+        """
+        _event_network_interface: DNS list of an interface in a namespace
+        is added into its DNS context only
+        """
+        # arrange
+        message = Message({"data": {"name": "veth0", "dns": ["10.0.0.1"],
+                                    "netns": "blue"}})
+        message.param = {"name": "veth0"}
+
+        # act
+        self.bundle._event_network_interface(message, test=True)
+        self.bundle.update_scheduler.flush()
+
+        # assert
+        self.assertIsNone(self.bundle.get_dns_list("veth0"))
+        self.assertEqual(
+            self.bundle.contexts["blue"].get_dns_list("veth0")["dns"],
+            ["10.0.0.1"])
+        with open(self.tmpdir + "/netns/blue/resolv.conf") as f:
+            self.assertEqual(f.read(), "nameserver 10.0.0.1\n")
+
+    def test__load__contexts(self):
+        """
+        load: DNS contexts are restored with their DNS lists, from the
+        journal and from snapshots
+        """
+        # arrange
+        self.bundle.set_context_dns("blue", {"fixedDns": ["9.9.9.9"]})
+        self.bundle.add_context_dns_lists(
+            "red", [{"source": "eth0", "dns": ["10.0.0.1"]}])
+        self.bundle.writer.stop()
+        journal = Dns(connection=Mockup())
+        self.addCleanup(journal.stop)
+
+        # act
+        self.bundle.stop()
+        self.bundle = Dns(connection=Mockup())
+
+        # assert
+        for bundle in [journal, self.bundle]:
+            self.assertEqual(sorted(bundle.contexts.keys()), ["blue", "red"])
+            self.assertEqual(
+                bundle.contexts["red"].get_current_dns()["dns"],
+                ["10.0.0.1"])
+            self.assertEqual(
+                bundle.contexts["blue"].get_dns_list("fixed")["dns"],
+                ["9.9.9.9"])
+        with open(self.bundle.netns_snapshot_path) as f:
+            self.assertEqual(sorted(json.load(f).keys()), ["blue", "red"])
+
+    def test__contexts__scale(self):
+        """
+        contexts: hundreds of namespaces are updated together by a
+        scheduled update, and share their addresses
+        """
+        # arrange
+        count = 300
+        servers = ["10.0.%d.1" % i for i in range(8)]
+
+        # act
+        start = time()
+        for i in range(count):
+            self.bundle.writer.call(
+                self.bundle.add_context_dns_lists, "ns%d" % i,
+                [{"source": "eth0", "dns": [servers[i % 8]]},
+                 {"source": "eth1", "dns": [servers[(i + 1) % 8]]}],
+                False)
+        self.bundle.update_scheduler.flush()
+        elapsed = time() - start
+
+        # assert
+        self.assertEqual(len(self.bundle.contexts), count)
+        self.assertEqual(len(os.listdir(self.tmpdir + "/netns")), count)
+        with open(self.tmpdir + "/netns/ns9/resolv.conf") as f:
+            self.assertEqual(f.read(), "nameserver 10.0.1.1\n"
+                                       "nameserver 10.0.2.1\n")
+        addresses = set()
+        for context in self.bundle.contexts.values():
+            for entry in context.dns_db.values():
+                addresses.update(id(server) for server in entry["dns"])
+                addresses.add(id(entry["source"]))
+        self.assertEqual(len(addresses), 8 + 2)
+        self.assertLess(elapsed, 10, "%d contexts updated in %.1f ms"
+                        % (count, elapsed * 1e3))
+
+    def test__dns_entry(self):
+        """
+        DnsEntry: fields like a dictionary, nameservers packed into binary
+        addresses
+        """
+        # arrange
+        fields = {"source": u"eth0",
+                  "dns": [u"8.8.8.8", "2001:db8::53", "fe80::1%eth0", "",
+                          "010.1.1.1"],
+                  "search": ["example.com"], "lease": 60, "lastSeen": 1.5,
+                  "enableFixed": False}
+
+        # act
+        entry = DnsEntry(fields)
+
+        # assert
+        self.assertEqual(entry, fields)
+        self.assertEqual(fields, entry)
+        self.assertEqual(entry.to_dict(), fields)
+        self.assertEqual(len(entry._dns), 5 + 17 + 15 + 3 + 12)
+        self.assertIs(entry["dns"][0], DnsEntry(fields)["dns"][0])
+        self.assertEqual(json.loads(json.dumps(entry.to_dict())), fields)
+        self.assertFalse(hasattr(entry, "__dict__"))
+
+        # update in place
+        entry["priority"] = 1
+        self.assertEqual(entry.pop("lease"), 60)
+        self.assertIsNone(entry.pop("lease", None))
+        del entry["enableFixed"]
+        self.assertNotIn("lease", entry)
+        self.assertFalse(hasattr(entry, "_extra"))
+        self.assertEqual(sorted(entry.keys()),
+                         ["dns", "lastSeen", "priority", "search", "source"])
+        self.assertEqual(entry.get("options", {}), {})
+        with self.assertRaises(KeyError):
+            entry["options"]
+        self.assertNotEqual(entry, fields)
+
+    def test__dns_database__entries(self):
+        """
+        DnsDatabase: DNS lists are stored as entries and given as
+        dictionaries by the API
+        """
+        # arrange
+        self.bundle.add_dns_list({"source": "eth0", "dns": ["8.8.8.8"]})
+
+        # act
+        entry = self.bundle.dns_db["eth0"]
+        database = self.bundle.get_dns_database()
+        changes = self.bundle.get_dns_database_changes(0)
+
+        # assert
+        self.assertIsInstance(entry, DnsEntry)
+        self.assertEqual(entry, {"source": "eth0", "dns": ["8.8.8.8"]})
+        self.assertEqual(database[-1], {"source": "eth0", "dns": ["8.8.8.8"]})
+        self.assertIs(type(database[-1]), dict)
+        self.assertIs(type(changes["dns"][0]), dict)
+        self.assertEqual(self.bundle.get_dns_database_view(), database)
+
 
 if __name__ == "__main__":
     FORMAT = '%(asctime)s - %(levelname)s - %(lineno)s - %(message)s'
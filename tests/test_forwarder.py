@@ -0,0 +1,395 @@
+import os
+import sys
+import socket
+import struct
+import unittest
+import logging
+from threading import Thread
+from time import sleep
+
+
+try:
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+    import forwarder
+    from forwarder import AnswerCache
+    from forwarder import DomainTrie
+    from forwarder import Forwarder
+    from forwarder import build_query
+    from forwarder import parse_question
+    from forwarder import write_name
+except ImportError as e:
+    print os.path.dirname(os.path.realpath(__file__)) + '/../'
+    print sys.path
+    print e
+    print "Please check the python PATH for import test module. (%s)" \
+        % __file__
+    exit(1)
+
+
+class StubUpstream(object):
+    """
+    A stub nameserver for testing, listens on UDP and TCP of localhost.
+
+    Questions are answered by name:
+        missing.*: NXDOMAIN with SOA (TTL 120, minimum 60).
+        drop.*: no response.
+        big.*: 40 A records.
+        tc.*: truncated on UDP, 1 A record on TCP.
+        others: 1 A record 192.0.2.1.
+    """
+    def __init__(self, ttl=300, delay=0):
+        self.ttl = ttl
+        self.delay = delay
+        self.queries = []
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.udp.getsockname())
+        self.tcp.listen(5)
+        self.address = self.udp.getsockname()
+        self._stopped = False
+
+    def start(self):
+        for target in [self._serve_udp, self._serve_tcp]:
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self.udp.close()
+        self.tcp.close()
+
+    def respond(self, query, udp=True):
+        qid, flags, (name, qtype, qclass), offset = parse_question(query)
+        self.queries.append(name)
+        if self.delay:
+            sleep(self.delay)
+        question = query[12:offset]
+        answers = []
+        authority = []
+        rcode = 0
+        tc = 0
+        if name.startswith("drop."):
+            return None
+        elif name.startswith("missing."):
+            rcode = 3
+            rdata = write_name("ns.example.") + \
+                write_name("hostmaster.example.") + \
+                struct.pack("!5I", 1, 3600, 600, 86400, 60)
+            authority.append(b"\xc0\x0c" + struct.pack(
+                "!HHIH", 6, 1, 120, len(rdata)) + rdata)
+        elif name.startswith("tc.") and udp:
+            tc = 0x0200
+        else:
+            count = 40 if name.startswith("big.") else 1
+            for i in range(count):
+                answers.append(b"\xc0\x0c" + struct.pack(
+                    "!HHIH", 1, 1, self.ttl, 4) +
+                    socket.inet_aton("192.0.2.%d" % (i + 1)))
+        header = struct.pack("!6H", qid, 0x8000 | 0x0080 | tc | rcode |
+                             (flags & 0x0100), 1, len(answers),
+                             len(authority), 0)
+        return header + question + b"".join(answers + authority)
+
+    def _serve_udp(self):
+        while not self._stopped:
+            try:
+                query, address = self.udp.recvfrom(65535)
+            except socket.error:
+                return
+            response = self.respond(query)
+            if response is not None:
+                self.udp.sendto(response, address)
+
+    def _serve_tcp(self):
+        while not self._stopped:
+            try:
+                conn, address = self.tcp.accept()
+            except socket.error:
+                return
+            length = struct.unpack("!H", conn.recv(2))[0]
+            response = self.respond(conn.recv(length), udp=False)
+            conn.sendall(struct.pack("!H", len(response)) + response)
+            conn.close()
+
+
+def query_udp(address, name, qtype=1, timeout=2):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    query = build_query(name, qtype)
+    sock.sendto(query, address)
+    response = sock.recv(65535)
+    sock.close()
+    return query, response
+
+
+def query_tcp(address, name, qtype=1, timeout=2):
+    sock = socket.create_connection(address, timeout)
+    query = build_query(name, qtype)
+    sock.sendall(struct.pack("!H", len(query)) + query)
+    length = struct.unpack("!H", sock.recv(2))[0]
+    response = b""
+    while len(response) < length:
+        response += sock.recv(length - len(response))
+    sock.close()
+    return query, response
+
+
+def rcode(response):
+    return struct.unpack_from("!H", response, 2)[0] & 0xF
+
+
+def ancount(response):
+    return struct.unpack_from("!H", response, 6)[0]
+
+
+class TestAnswerCacheClass(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = StubUpstream(ttl=300)
+
+    def tearDown(self):
+        self.upstream.stop()
+
+    def response(self, name):
+        query = build_query(name)
+        offset = parse_question(query)[3]
+        return self.upstream.respond(query), offset
+
+    def test__get__ttl_decreased(self):
+        """
+        get: TTLs are decreased by the age
+        """
+        # arrange
+        cache = AnswerCache()
+        response, offset = self.response("www.example.")
+        cache.put(("www.example.", 1, 1), response, offset, now=1000)
+
+        # act
+        cached = cache.get(("www.example.", 1, 1), now=1100)
+
+        # assert
+        self.assertEqual(struct.unpack_from("!I", cached, offset + 6)[0],
+                         200)
+        self.assertIsNone(cache.get(("www.example.", 1, 1), now=1300))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test__put__negative(self):
+        """
+        put: NXDOMAIN is cached by SOA minimum
+        """
+        # arrange
+        cache = AnswerCache()
+        response, offset = self.response("missing.example.")
+
+        # act
+        cached = cache.put(("missing.example.", 1, 1), response, offset,
+                           now=1000)
+
+        # assert
+        self.assertTrue(cached)
+        self.assertIsNotNone(cache.get(("missing.example.", 1, 1),
+                                       now=1059))
+        self.assertIsNone(cache.get(("missing.example.", 1, 1), now=1060))
+        self.assertEqual(cache.stats["negative_hits"], 1)
+
+    def test__put__not_cacheable(self):
+        """
+        put: truncated and zero TTL responses are not cached
+        """
+        # arrange
+        cache = AnswerCache()
+        response, offset = self.response("tc.example.")
+        self.upstream.ttl = 0
+        zero, zero_offset = self.response("www.example.")
+
+        # act & assert
+        self.assertFalse(cache.put(("tc.example.", 1, 1), response, offset))
+        self.assertFalse(cache.put(("www.example.", 1, 1), zero,
+                                   zero_offset))
+        self.assertEqual(len(cache), 0)
+
+    def test__put__lru(self):
+        """
+        put: evict the least recently used
+        """
+        # arrange
+        cache = AnswerCache(capacity=2)
+        for name in ["a.example.", "b.example."]:
+            response, offset = self.response(name)
+            cache.put((name, 1, 1), response, offset)
+
+        # act
+        cache.get(("a.example.", 1, 1))
+        response, offset = self.response("c.example.")
+        cache.put(("c.example.", 1, 1), response, offset)
+
+        # assert
+        self.assertIsNotNone(cache.get(("a.example.", 1, 1)))
+        self.assertIsNone(cache.get(("b.example.", 1, 1)))
+        self.assertEqual(cache.stats["evictions"], 1)
+
+
+class TestForwarderClass(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = StubUpstream().start()
+        self.upstreams = [self.upstream.address]
+        self.forwarder = Forwarder(lambda: self.upstreams, port=0,
+                                   timeout=0.5)
+        self.forwarder.start()
+
+    def tearDown(self):
+        self.forwarder.stop()
+        self.upstream.stop()
+
+    def test__resolve__cached(self):
+        """
+        resolve: the second query is answered by cache
+        """
+        # act
+        query1, response1 = query_udp(self.forwarder.address, "www.example.")
+        query2, response2 = query_udp(self.forwarder.address, "www.example.")
+
+        # assert
+        self.assertEqual(response1[0:2], query1[0:2])
+        self.assertEqual(response2[0:2], query2[0:2])
+        self.assertEqual(ancount(response2), 1)
+        self.assertEqual(self.upstream.queries, ["www.example."])
+        self.assertEqual(self.forwarder.cache.stats["hits"], 1)
+
+    def test__resolve__negative_cached(self):
+        """
+        resolve: NXDOMAIN is cached
+        """
+        # act
+        query_udp(self.forwarder.address, "missing.example.")
+        query, response = query_udp(self.forwarder.address,
+                                    "missing.example.")
+
+        # assert
+        self.assertEqual(rcode(response), 3)
+        self.assertEqual(self.upstream.queries, ["missing.example."])
+
+    def test__resolve__failover(self):
+        """
+        resolve: try the next upstream if one does not respond
+        """
+        # arrange
+        dead = StubUpstream()
+        dead.stop()
+        self.upstreams = [dead.address, ("127.0.0.1", 9),
+                          self.upstream.address]
+
+        # act
+        query, response = query_udp(self.forwarder.address, "www.example.")
+
+        # assert
+        self.assertEqual(rcode(response), 0)
+        self.assertEqual(ancount(response), 1)
+
+    def test__resolve__servfail(self):
+        """
+        resolve: SERVFAIL if no upstream responds
+        """
+        # act
+        query, response = query_udp(self.forwarder.address, "drop.example.")
+        self.upstreams = []
+        query, response2 = query_udp(self.forwarder.address, "www.example.")
+
+        # assert
+        self.assertEqual(rcode(response), 2)
+        self.assertEqual(rcode(response2), 2)
+        self.assertEqual(self.forwarder.stats["failures"], 2)
+        self.assertEqual(len(self.forwarder.cache), 0)
+
+    def test__resolve__truncated(self):
+        """
+        resolve: retry by TCP if truncated, truncate for small UDP clients
+        """
+        # act
+        query, response = query_udp(self.forwarder.address, "tc.example.")
+        query, big = query_udp(self.forwarder.address, "big.example.")
+        query, big_tcp = query_tcp(self.forwarder.address, "big.example.")
+
+        # assert
+        self.assertEqual(ancount(response), 1)
+        self.assertTrue(struct.unpack_from("!H", big, 2)[0] & 0x0200)
+        self.assertEqual(ancount(big), 0)
+        self.assertEqual(ancount(big_tcp), 40)
+
+    def test__resolve__malformed(self):
+        """
+        resolve: ignore malformed queries and responses
+        """
+        self.assertIsNone(self.forwarder.resolve(b"\x00\x01"))
+        self.assertIsNone(self.forwarder.resolve(
+            self.upstream.respond(build_query("www.example."))))
+        self.assertEqual(forwarder.udp_payload_size(b"\x00" * 12, 12), 512)
+
+    def test__resolve__rules(self):
+        """
+        resolve: forward queries by the longest matching rule, others to
+        upstream nameservers
+        """
+        # arrange
+        corp = StubUpstream().start()
+        self.addCleanup(corp.stop)
+        rules = [{"domain": "corp.example", "servers": [corp.address]},
+                 {"domain": "lan", "servers": []}]
+        self.forwarder.rules = lambda: rules
+
+        # act
+        query_udp(self.forwarder.address, "www.corp.example.")
+        query_udp(self.forwarder.address, "www.example.")
+        query_udp(self.forwarder.address, "nas.lan.")
+        rules = [{"domain": "www.corp.example", "servers": []}]
+        query_udp(self.forwarder.address, "ftp.corp.example.")
+
+        # assert
+        self.assertEqual(corp.queries, ["www.corp.example."])
+        self.assertEqual(self.upstream.queries,
+                         ["www.example.", "nas.lan.", "ftp.corp.example."])
+        self.assertEqual(self.forwarder.stats["routed"], 1)
+
+
+class TestDomainTrieClass(unittest.TestCase):
+
+    def test__match(self):
+        """
+        match: the longest domain suffix by labels
+        """
+        # arrange
+        trie = DomainTrie()
+        trie.add("corp.example", "corp")
+        trie.add("a.corp.example.", "a")
+        trie.add("LAN", "lan")
+
+        # act & assert
+        self.assertEqual(trie.match("www.corp.example."),
+                         ("corp.example.", "corp"))
+        self.assertEqual(trie.match("x.A.corp.example"),
+                         ("a.corp.example.", "a"))
+        self.assertEqual(trie.match("corp.example."),
+                         ("corp.example.", "corp"))
+        self.assertEqual(trie.match("nas.lan."), ("lan.", "lan"))
+        self.assertIsNone(trie.match("example."))
+        self.assertIsNone(trie.match("notcorp.example."))
+        self.assertEqual(len(trie), 3)
+
+        trie.add(".", "default")
+        trie.add("lan", "LAN")
+        self.assertEqual(trie.match("example."), (".", "default"))
+        self.assertEqual(trie.match("nas.lan."), ("lan.", "LAN"))
+        self.assertEqual(len(trie), 4)
+
+
+if __name__ == "__main__":
+    FORMAT = '%(asctime)s - %(levelname)s - %(lineno)s - %(message)s'
+    logging.basicConfig(level=20, format=FORMAT)
+    logger = logging.getLogger('DNS Forwarder Test')
+    unittest.main()
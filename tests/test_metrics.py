@@ -0,0 +1,237 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import logging
+import inspect
+from time import time
+
+
+try:
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+    from metrics import Histogram
+    from metrics import Metrics
+    from metrics import PrometheusDumper
+    from metrics import metered_route
+    from metrics import timed
+except ImportError as e:
+    print os.path.dirname(os.path.realpath(__file__)) + '/../'
+    print sys.path
+    print e
+    print "Please check the python PATH for import test module. (%s)" \
+        % __file__
+    exit(1)
+
+
+class Handlers(object):
+    """
+    Route handlers and a method instrumented by metrics.
+    """
+    def __init__(self):
+        self.metrics = Metrics()
+
+    def get(self, message, response):
+        return response(data=message)
+
+    @metered_route("get /test")
+    def metered_get(self, message, response):
+        return response(data=message)
+
+    @metered_route("put /test")
+    def metered_put(self, message, response):
+        return response(code=400, data={"message": "Invalid data."})
+
+    @metered_route("put /event")
+    def metered_event(self, message):
+        raise ValueError("Invalid event.")
+
+    @timed("work")
+    def work(self, fail=False):
+        if fail:
+            raise IOError("No space left on device")
+        return True
+
+
+class TestMetricsClass(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = Handlers()
+        self.metrics = self.handlers.metrics
+
+    def test__histogram(self):
+        """
+        Histogram: cumulative counts by bucket
+        """
+        # arrange
+        histogram = Histogram(bounds=(0.001, 0.01))
+
+        # act
+        for value in [0.0005, 0.001, 0.005, 0.5]:
+            histogram.observe(value)
+
+        # assert
+        self.assertEqual(histogram.buckets(),
+                         [[0.001, 2], [0.01, 3], ["+Inf", 4]])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 0.5065)
+        self.assertEqual(histogram.max, 0.5)
+
+    def test__snapshot(self):
+        """
+        snapshot: metrics by route are grouped by name
+        """
+        # arrange
+        self.metrics.inc("config_writes")
+        self.metrics.inc("config_writes")
+        self.metrics.inc("validation_failures", "put /network/dns")
+        self.metrics.observe("save", 0.002)
+        self.metrics.observe("route", 0.0002, "get /network/dns")
+
+        # act
+        data = self.metrics.snapshot()
+
+        # assert
+        self.assertEqual(data["counters"],
+                         {"config_writes": 2,
+                          "validation_failures": {"put /network/dns": 1}})
+        self.assertEqual(data["histograms"]["save"]["count"], 1)
+        self.assertEqual(
+            data["histograms"]["route"]["get /network/dns"]["count"], 1)
+
+    def test__prometheus(self):
+        """
+        prometheus: text exposition format
+        """
+        # arrange
+        self.metrics.inc("config_writes", value=3)
+        self.metrics.inc("route_failures", 'put "/x"')
+        self.metrics.observe("save", 0.002)
+
+        # act
+        lines = self.metrics.prometheus().splitlines()
+
+        # assert
+        self.assertIn("# TYPE dns_config_writes_total counter", lines)
+        self.assertIn("dns_config_writes_total 3", lines)
+        self.assertIn('dns_route_failures_total{route="put \\"/x\\""} 1',
+                      lines)
+        self.assertIn("# TYPE dns_save_seconds histogram", lines)
+        self.assertIn('dns_save_seconds_bucket{le="0.001"} 0', lines)
+        self.assertIn('dns_save_seconds_bucket{le="0.0025"} 1', lines)
+        self.assertIn('dns_save_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn("dns_save_seconds_sum 0.002000", lines)
+        self.assertIn("dns_save_seconds_count 1", lines)
+
+    def test__timed(self):
+        """
+        timed: time calls and count errors
+        """
+        # act
+        self.assertTrue(self.handlers.work())
+        with self.assertRaises(IOError):
+            self.handlers.work(fail=True)
+
+        # assert
+        data = self.metrics.snapshot()
+        self.assertEqual(data["histograms"]["work"]["count"], 2)
+        self.assertEqual(data["counters"], {"work_errors": 1})
+        self.assertEqual(Handlers.work.__name__, "work")
+
+    def test__metered_route(self):
+        """
+        metered_route: keep handler arguments, count failed responses and
+        exceptions
+        """
+        # arrange
+        responses = []
+
+        def response(code=200, data=None):
+            responses.append((code, data))
+
+        # act
+        self.handlers.metered_get("a", response)
+        self.handlers.metered_put("b", response)
+        with self.assertRaises(ValueError):
+            self.handlers.metered_event("c")
+
+        # assert
+        self.assertEqual(len(inspect.getargspec(
+            Handlers.metered_get.__func__).args), 3)
+        self.assertEqual(len(inspect.getargspec(
+            Handlers.metered_event.__func__).args), 2)
+        self.assertEqual(responses,
+                         [(200, "a"), (400, {"message": "Invalid data."})])
+        data = self.metrics.snapshot()
+        self.assertEqual(data["counters"]["route_failures"],
+                         {"put /test": 1, "put /event": 1})
+        self.assertEqual(sorted(data["histograms"]["route"].keys()),
+                         ["get /test", "put /event", "put /test"])
+
+    def test__prometheus_dumper(self):
+        """
+        PrometheusDumper: dump periodically and when stopped
+        """
+        # arrange
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "dns.prom")
+
+        def write(path, content):
+            with open(path, "w") as f:
+                f.write(content)
+
+        dumper = PrometheusDumper(self.metrics, path, write, interval=0.05)
+        self.metrics.inc("config_writes")
+
+        # act
+        dumper.start()
+        deadline = time() + 2
+        while not os.path.exists(path) and time() < deadline:
+            dumper._stop_event.wait(0.01)
+        self.metrics.inc("config_writes")
+        dumper.stop()
+
+        # assert
+        with open(path) as f:
+            self.assertIn("dns_config_writes_total 2\n", f.read())
+
+    def test__overhead(self):
+        """
+        metered_route: overhead per call of a route handler
+        """
+        # arrange
+        number = 20000
+
+        def response(code=200, data=None):
+            return data
+
+        def per_call(func):
+            best = None
+            for _ in range(3):
+                start = time()
+                for _ in range(number):
+                    func(None, response)
+                elapsed = (time() - start) / number
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        # act
+        plain = per_call(self.handlers.get)
+        metered = per_call(self.handlers.metered_get)
+
+        # assert
+        overhead = metered - plain
+        self.assertEqual(self.metrics.snapshot()["histograms"]["route"]
+                         ["get /test"]["count"], number * 3)
+        self.assertLess(overhead, 20e-6,
+                        "route metrics overhead: %.2f usec/call "
+                        "(%.2f -> %.2f)" % (overhead * 1e6, plain * 1e6,
+                                            metered * 1e6))
+
+
+if __name__ == "__main__":
+    FORMAT = '%(asctime)s - %(levelname)s - %(lineno)s - %(message)s'
+    logging.basicConfig(level=20, format=FORMAT)
+    logger = logging.getLogger('DNS Metrics Test')
+    unittest.main()
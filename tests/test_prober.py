@@ -0,0 +1,197 @@
+import os
+import sys
+import unittest
+import logging
+from mock import Mock
+
+
+try:
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+    from prober import HealthProber
+    from test_forwarder import StubUpstream
+except ImportError as e:
+    print os.path.dirname(os.path.realpath(__file__)) + '/../'
+    print sys.path
+    print e
+    print "Please check the python PATH for import test module. (%s)" \
+        % __file__
+    exit(1)
+
+
+class TestHealthProberClass(unittest.TestCase):
+
+    def setUp(self):
+        self.fast = StubUpstream().start()
+        self.slow = StubUpstream(delay=0.05).start()
+        self.dead = StubUpstream()
+        self.dead.stop()
+        self.servers = [self.slow.address, self.fast.address]
+        self.prober = HealthProber(lambda: self.servers, timeout=0.3,
+                                   max_failures=2, reorder=True)
+
+    def tearDown(self):
+        self.prober.stop()
+        self.fast.stop()
+        self.slow.stop()
+
+    def test__probe(self):
+        """
+        probe: round trip time of responsive nameservers, None of others
+        """
+        # act & assert
+        self.assertIsNotNone(self.prober.probe(self.fast.address))
+        self.assertGreaterEqual(self.prober.probe(self.slow.address), 0.05)
+        self.assertIsNone(self.prober.probe(self.dead.address))
+
+    def test__probe__short_response(self):
+        """
+        probe: a response too short to carry a header is a failure, not
+        aborting the round of probes
+        """
+        # arrange
+        self.fast.respond = lambda query, udp=True: query[0:2]
+
+        # act
+        self.prober.probe_all()
+
+        # assert
+        self.assertIsNone(self.prober.probe(self.fast.address))
+        self.assertEqual(self.prober.stats[self.fast.address]["failures"], 1)
+        self.assertEqual(self.prober.stats[self.slow.address]["failures"], 0)
+
+    def test__probe_all__order_by_latency(self):
+        """
+        probe_all: order nameservers by latency
+        """
+        # act
+        self.prober.probe_all()
+
+        # assert
+        self.assertEqual(self.prober.order(self.servers),
+                         [self.fast.address, self.slow.address])
+        stats = self.prober.get_stats()
+        self.assertEqual(len(stats), 2)
+        self.assertTrue(all(stat["healthy"] for stat in stats))
+        latency = dict((stat["server"], stat["latency"]) for stat in stats)
+        self.assertLess(latency["%s:%s" % self.fast.address],
+                        latency["%s:%s" % self.slow.address])
+
+    def test__order__keep_order(self):
+        """
+        order: keep the order given unless reorder is set, only unhealthy
+        nameservers are dropped
+        """
+        # arrange
+        self.prober.reorder = False
+        self.prober.record("1.1.1.1", 0.2)
+        self.prober.record("2.2.2.2", 0.01)
+        for _ in range(2):
+            self.prober.record("3.3.3.3", None)
+
+        # act & assert
+        self.assertEqual(
+            self.prober.order(["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4"]),
+            ["1.1.1.1", "2.2.2.2", "4.4.4.4"])
+
+    def test__order__reorder_gap(self):
+        """
+        order: nameservers are moved ahead only if faster by more than the
+        gap, so ones of similar latency do not swap places
+        """
+        # arrange
+        servers = ["1.1.1.1", "2.2.2.2", "3.3.3.3"]
+        self.prober.record("1.1.1.1", 0.030)
+        self.prober.record("2.2.2.2", 0.025)
+        self.prober.record("3.3.3.3", 0.005)
+        on_change = Mock()
+        self.prober.on_change = on_change
+
+        # act & assert
+        self.assertEqual(self.prober.order(servers),
+                         ["3.3.3.3", "1.1.1.1", "2.2.2.2"])
+        self.prober.record("2.2.2.2", 0.015)
+        self.assertEqual(self.prober.order(servers),
+                         ["3.3.3.3", "1.1.1.1", "2.2.2.2"])
+        self.prober.reorder_gap = 0
+        self.assertEqual(self.prober.order(servers),
+                         ["3.3.3.3", "2.2.2.2", "1.1.1.1"])
+
+    def test__probe_all__drop_unhealthy(self):
+        """
+        probe_all: drop nameservers after consecutive failures
+        """
+        # arrange
+        self.servers = [self.dead.address, self.fast.address]
+
+        # act
+        self.prober.probe_all()
+        first = self.prober.order(self.servers)
+        self.prober.probe_all()
+
+        # assert
+        self.assertEqual(first, [self.fast.address, self.dead.address])
+        self.assertEqual(self.prober.order(self.servers),
+                         [self.fast.address])
+        self.assertFalse(self.prober.is_healthy(self.dead.address))
+        self.assertEqual(
+            self.prober.order([self.dead.address]), [self.dead.address])
+
+    def test__probe_all__recovered(self):
+        """
+        probe_all: nameservers are healthy again once they respond
+        """
+        # arrange
+        self.prober.max_failures = 1
+        self.prober.record(self.fast.address, None)
+        self.assertFalse(self.prober.is_healthy(self.fast.address))
+
+        # act
+        self.prober.probe_all()
+
+        # assert
+        self.assertTrue(self.prober.is_healthy(self.fast.address))
+
+    def test__probe_all__on_change(self):
+        """
+        probe_all: notify only if the order is changed, and forget
+        nameservers removed
+        """
+        # arrange
+        self.prober.on_change = Mock()
+
+        # act
+        self.prober.probe_all()
+        self.prober.probe_all()
+        self.servers = [self.fast.address]
+        self.prober.probe_all()
+
+        # assert
+        self.assertEqual(self.prober.on_change.call_count, 1)
+        self.assertEqual([stat["server"] for stat in self.prober.get_stats()],
+                         ["%s:%s" % self.fast.address])
+
+    def test__start(self):
+        """
+        start: probe in background until stopped
+        """
+        # arrange
+        self.prober.interval = 60
+
+        # act
+        self.prober.start()
+        for _ in range(100):
+            if len(self.prober.get_stats()) == 2:
+                break
+            self.prober._stop_event.wait(0.01)
+        self.prober.stop()
+
+        # assert
+        self.assertEqual(len(self.prober.get_stats()), 2)
+        self.assertIsNone(self.prober._thread)
+
+
+if __name__ == "__main__":
+    FORMAT = '%(asctime)s - %(levelname)s - %(lineno)s - %(message)s'
+    logging.basicConfig(level=20, format=FORMAT)
+    logger = logging.getLogger('DNS Prober Test')
+    unittest.main()
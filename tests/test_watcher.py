@@ -0,0 +1,209 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import logging
+from threading import Event
+from time import sleep
+from time import time
+from mock import patch
+
+
+try:
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+    from watcher import ConfigWatcher
+except ImportError as e:
+    print os.path.dirname(os.path.realpath(__file__)) + '/../'
+    print sys.path
+    print e
+    print "Please check the python PATH for import test module. (%s)" \
+        % __file__
+    exit(1)
+
+
+CONTENT = "nameserver 1.1.1.1\n"
+
+
+class TestConfigWatcherClass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "resolv.conf")
+        self.write(CONTENT)
+        self.restored = Event()
+        self.watcher = ConfigWatcher(
+            self.path, lambda: hashlib.sha1(CONTENT).hexdigest(),
+            self.restore, interval=60, settle=0.01, min_backoff=0.2,
+            max_backoff=0.8)
+        self.addCleanup(self.watcher.stop)
+
+    def write(self, content, replace=False):
+        path = self.path + ".tmp" if replace else self.path
+        with open(path, "w") as f:
+            f.write(content)
+        if replace:
+            os.rename(path, self.path)
+
+    def restore(self):
+        self.write(CONTENT, replace=True)
+        self.restored.set()
+
+    def wait_restored(self, timeout=2):
+        result = self.restored.wait(timeout)
+        self.restored.clear()
+        return result
+
+    def test__drifted(self):
+        """
+        drifted: compare the file with the expected digest, hashed only if
+        the file is changed
+        """
+        # act and assert
+        self.assertFalse(self.watcher.drifted())
+        self.assertFalse(self.watcher.drifted())
+        self.assertEqual(self.watcher.stats["checks"], 1)
+        self.write("nameserver 8.8.8.8\n")
+        self.assertTrue(self.watcher.drifted())
+        os.remove(self.path)
+        self.assertTrue(self.watcher.drifted())
+
+    def test__drifted__unknown(self):
+        """
+        drifted: nothing is expected before the file is written
+        """
+        # arrange
+        self.watcher.expected = lambda: None
+        self.write("nameserver 8.8.8.8\n")
+
+        # act and assert
+        self.assertFalse(self.watcher.drifted())
+
+    def test__start__modified(self):
+        """
+        start: restore the file modified in place
+        """
+        # arrange
+        self.watcher.start()
+
+        # act
+        self.write("nameserver 8.8.8.8\n")
+
+        # assert
+        self.assertTrue(self.wait_restored())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(self.watcher.stats["restores"], 1)
+
+    def test__start__replaced(self):
+        """
+        start: restore the file replaced by rename, and leave it alone if
+        rewritten with the expected content
+        """
+        # arrange
+        self.watcher.start()
+
+        # act
+        self.write("nameserver 8.8.8.8\n", replace=True)
+        self.assertTrue(self.wait_restored())
+        self.write(CONTENT, replace=True)
+
+        # assert
+        self.assertFalse(self.wait_restored(0.3))
+        self.assertEqual(self.watcher.stats["restores"], 1)
+
+    def test__start__symlink(self):
+        """
+        start: restore the file if its target or the link itself is
+        replaced by others
+        """
+        # arrange
+        target = os.path.join(self.tmpdir, "run", "resolv.conf")
+        os.mkdir(os.path.dirname(target))
+        os.rename(self.path, target)
+
+        def link():
+            with open(target, "w") as f:
+                f.write(CONTENT)
+            path = self.path + ".link"
+            os.symlink(target, path)
+            os.rename(path, self.path)
+
+        link()
+        self.watcher.start()
+
+        # act & assert
+        with open(target, "w") as f:
+            f.write("nameserver 8.8.8.8\n")
+        self.assertTrue(self.wait_restored())
+
+        link()
+        self.assertFalse(self.wait_restored(0.3))
+        self.write("nameserver 8.8.8.8\n", replace=True)
+        self.assertTrue(self.wait_restored())
+
+        # polling also sees the link replaced
+        self.watcher.stop()
+        self.watcher.interval = 0.05
+        link()
+        with patch("watcher.Inotify", side_effect=OSError(38, "ENOSYS")):
+            self.watcher.start()
+        self.write("nameserver 8.8.8.8\n", replace=True)
+        self.assertTrue(self.wait_restored())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test__start__polling(self):
+        """
+        start: check the file every interval if inotify is not available
+        """
+        # arrange
+        self.watcher.interval = 0.05
+        with patch("watcher.Inotify", side_effect=OSError(38, "ENOSYS")):
+            self.watcher.start()
+
+        # act
+        self.write("nameserver 8.8.8.8\n")
+
+        # assert
+        self.assertTrue(self.wait_restored())
+        self.assertEqual(self.watcher.stats["events"], 0)
+
+    def test__start__backoff(self):
+        """
+        start: restores are delayed by doubled backoff while the file is
+        rewritten by others
+        """
+        # arrange
+        self.watcher.start()
+
+        # act
+        start = time()
+        while time() - start < 1.5:
+            self.write("nameserver 8.8.8.8\n")
+            sleep(0.02)
+        duration = time() - start
+
+        deadline = time() + 3
+        while time() < deadline:
+            with open(self.path) as f:
+                if f.read() == CONTENT:
+                    break
+            sleep(0.05)
+
+        # assert
+        self.assertGreater(self.watcher.stats["drifts"], 1)
+        self.assertLessEqual(self.watcher.stats["restores"], 5)
+        self.assertLess(self.watcher.stats["restores"], duration / 0.02 / 10)
+        self.assertEqual(self.watcher.backoff, 0.8)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), CONTENT)
+
+
+if __name__ == "__main__":
+    FORMAT = '%(asctime)s - %(levelname)s - %(lineno)s - %(message)s'
+    logging.basicConfig(level=20, format=FORMAT)
+    logger = logging.getLogger('DNS Watcher Test')
+    unittest.main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import logging
+import os
+import select
+import struct
+from threading import Event
+from threading import Thread
+from time import time
+
+_logger = logging.getLogger("sanji.dns.watcher")
+
+# inotify(7) events of entries in the watched directory
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """
+    Minimal inotify(7) binding by ctypes, watching directories for events
+    of their entries by name.
+
+    Raises:
+        OSError: inotify is not available, e.g. not on Linux.
+    """
+    def __init__(self, paths, mask=WATCH_MASK):
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self.paths = []
+        self.mask = mask
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.wds = {}
+        try:
+            self.watch(paths)
+        except OSError:
+            if not self.wds:
+                os.close(self.fd)
+                raise
+
+    def watch(self, paths):
+        """
+        Watch the directories, and stop watching others.
+
+        Raises:
+            OSError: failed to watch some of them, e.g. not existing;
+                they are retried by the next call.
+        """
+        self.paths = list(paths)
+        for wd, path in list(self.wds.items()):
+            if path not in self.paths:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.wds[wd]
+        error = None
+        for path in self.paths:
+            if path in self.wds.values():
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, path, self.mask)
+            if wd < 0:
+                error = OSError(ctypes.get_errno(), "inotify_add_watch",
+                                path)
+                continue
+            self.wds[wd] = path
+        if error is not None:
+            raise error
+
+    def watching(self):
+        """
+        Check if all directories are watched.
+        """
+        return len(self.wds) == len(set(self.paths))
+
+    def read(self):
+        """
+        Read pending events as a list of (mask, name).
+        """
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(buf):
+            wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self.wds.pop(wd, None)
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """
+    Watch a file for edits by others and restore it.
+
+    The directory of the file is watched by inotify, so replacing the
+    file by rename is also seen; the file is checked every interval
+    seconds as well, or only then if inotify is not available. If the
+    path is a symbolic link, the directories of both the link and its
+    target are watched, so replacing either of them is seen. A change is
+    a drift if the SHA-1 digest of the file differs from the expected
+    one, the content is hashed only if the file identity (inode, mtime,
+    size of the link and the file) changed since the last check.
+
+    A drift is restored at once, but if the file drifts again within the
+    backoff after a restore, e.g. another tool keeps rewriting it, the
+    next restore is delayed by the backoff, doubled up to max_backoff. It
+    is reset after a quiet period as long.
+
+    Args:
+        expected: a function returns the expected digest, None if not
+            known yet.
+        restore: a function restores the file.
+    """
+    def __init__(self, path, expected, restore, interval=60, settle=0.05,
+                 min_backoff=1, max_backoff=300):
+        self.path = os.path.abspath(path)
+        self.expected = expected
+        self.restore = restore
+        self.interval = interval
+        self.settle = settle
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.stats = {"events": 0, "checks": 0, "drifts": 0, "restores": 0,
+                      "failures": 0}
+        self._checked = None
+        self._last_restore = None
+        self._inotify = None
+        self._stop_event = Event()
+        self._wakeup = None
+        self._thread = None
+
+    def _watched(self):
+        """
+        Get the directories to watch, and the names of the link and the
+        file in them.
+        """
+        paths = [self.path, os.path.realpath(self.path)]
+        return ([os.path.dirname(path) for path in paths],
+                set(os.path.basename(path) for path in paths))
+
+    def start(self):
+        try:
+            self._inotify = Inotify(self._watched()[0])
+        except (OSError, AttributeError, TypeError) as e:
+            _logger.info("Watch %s by polling: %s" % (self.path, e))
+            self._inotify = None
+        self._stop_event.clear()
+        self._wakeup = os.pipe()
+        self._thread = Thread(target=self._run, name="thread-dns-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            os.write(self._wakeup[1], "\0")
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def _identity(self):
+        try:
+            link = os.lstat(self.path)
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (link.st_ino, link.st_mtime, st.st_ino, st.st_mtime,
+                st.st_size)
+
+    def _digest(self):
+        try:
+            with open(self.path) as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def drifted(self):
+        """
+        Check if the file differs from the expected content.
+        """
+        expected = self.expected()
+        if expected is None:
+            return False
+        identity = self._identity()
+        if self._checked == (identity, expected):
+            return False
+        self.stats["checks"] += 1
+        if self._digest() == expected:
+            self._checked = (identity, expected)
+            return False
+        self._checked = None
+        return True
+
+    def _wait(self, timeout):
+        """
+        Wait for events of the file up to timeout seconds, events within
+        the settle time are taken together.
+
+        Returns:
+            True if the file may be changed.
+        """
+        fds = [self._wakeup[0]]
+        if self._inotify is not None:
+            fds.append(self._inotify.fd)
+        readable = select.select(fds, [], [], timeout)[0]
+        if self._stop_event.is_set():
+            return False
+        if self._inotify is None or self._inotify.fd not in readable:
+            return True
+        names = self._watched()[1]
+        changed = False
+        while True:
+            for mask, name in self._inotify.read():
+                if mask & IN_Q_OVERFLOW or name in names:
+                    changed = True
+            if not changed or self._stop_event.wait(self.settle):
+                break
+            if not select.select([self._inotify.fd], [], [], 0)[0]:
+                break
+        if changed:
+            self.stats["events"] += 1
+        return changed
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if self._inotify is not None:
+                paths = self._watched()[0]
+                if paths != self._inotify.paths or \
+                        not self._inotify.watching():
+                    try:
+                        self._inotify.watch(paths)
+                    except OSError:
+                        pass
+            if not self._wait(self.interval):
+                continue
+            try:
+                if self.drifted():
+                    self._reconcile()
+            except Exception as e:
+                self.stats["failures"] += 1
+                _logger.warning("Failed to restore %s: %s" % (self.path, e))
+
+    def _reconcile(self):
+        self.stats["drifts"] += 1
+        now = time()
+        if self._last_restore is not None \
+                and now - self._last_restore < self.backoff:
+            _logger.warning("%s is rewritten by others, restore in %g s"
+                            % (self.path, self.backoff))
+            if self._stop_event.wait(self.backoff):
+                return
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            if not self.drifted():
+                return
+        elif self._last_restore is not None \
+                and now - self._last_restore >= self.backoff * 2:
+            self.backoff = self.min_backoff
+        _logger.info("%s is modified by others, restore it" % self.path)
+        self.restore()
+        self._last_restore = time()
+        self.stats["restores"] += 1